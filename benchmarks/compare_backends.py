@@ -0,0 +1,293 @@
+"""
+Time the SVG to PDF backends on the badge and certificate templates and
+compare their rendering pixel by pixel.
+
+The templates of each conference module are prepared as its pipeline
+prepares them for each backend: fitted to the text boxes and, for the
+certificates, with the images linked for the backends that load them. Each
+one is filled with a sample attendee, fitted as the CSV stages fit it, and
+converted `--repeat` times by each backend available here. The PDF files
+are rasterized with Ghostscript and compared with the ones of the
+`--reference` backend (Inkscape, what docstamp uses without
+`--unicode_support`):
+
+    python -m benchmarks.compare_backends
+    python -m benchmarks.compare_backends --conferences euroscipy2019 --backends rsvg cairosvg --diff-dir diffs
+
+A backend renders a template correctly when less than `--threshold` of the
+pixels differ from the reference by more than `--tolerance` levels, and the
+fastest correct one is reported for each template, the one to set as
+`SVG_BACKEND` in the conference module. The badges use `rsvg`, the
+`rsvg-convert` docstamp converted them with (`--unicode_support`), check a
+new template here before changing it. `--diff-dir` keeps a grey-level image
+(PGM) of the differences of each template and backend.
+"""
+import argparse
+import importlib
+import inspect
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from benchmarks.run_benchmarks import CONFERENCES, REPO_DIR, RESULTS_DIR
+from conferences import svg_backends, text_layout
+from conferences.render_cache import template_fields
+from conferences.svg_render import SVGTemplate
+
+# the attendees file the role files are named after, it is not read
+SAMPLE_USERS_FILE = 'tito.csv'
+
+# long, accented and XML special values, the text most likely to render differently
+SAMPLE_VALUES = {
+    'first_name': 'Zoë-Łucja',
+    'last_name': 'Ñúñez García',
+    'full_name': 'Zoë-Łucja Ñúñez García',
+    'company': 'Научно-исследовательский Research & Development',
+    'tagline': 'NumPy <3 "SciPy", ask me about Dask',
+    'company1': 'Научно-исследовательский',
+    'company2': 'Research & Development',
+    'tagline1': 'NumPy <3 "SciPy"',
+    'tagline2': 'Ask me about Dask',
+    'order': 'ABCD-1',
+    'uuid': '033b1f81-1ec2-4fd1-9579-b7fb865802ae',
+    'conference_and_tutorials': 'the tutorials and the conference',
+    'Ticket': 'Conference ticket',
+    'Ticket_First_Name': 'Zoë-Łucja',
+    'Ticket_Last_Name': 'Ñúñez García',
+    'Ticket_Company_Name1': 'Research & Development',
+    'Ticket_Company_Name2': 'GmbH',
+}
+
+
+def sample_record(template_file: str, module) -> dict:
+    """ Return the sample attendee of `template_file`, with the font sizes
+    and lines of the `TEXT_BOXES` of `module` as its CSV stages fit them.
+    """
+    record = {field: SAMPLE_VALUES.get(field, field.replace('_', ' ')) for field in template_fields(template_file)}
+    text_boxes = getattr(module, 'TEXT_BOXES', None)
+    if text_boxes:
+        # the prepared template keeps the name of the template of the module
+        source_file = os.path.join(module.TEMPLATES_DIR, os.path.basename(template_file))
+        values = {field: SAMPLE_VALUES.get(field, '') for field in text_boxes}
+        try:
+            record.update(text_layout.TextFitter(source_file, text_boxes).fit_record(values))
+        except FileNotFoundError:
+            # without the fonts the CSV stages do not fit the texts either, the template keeps its sizes
+            for field, box in text_boxes.items():
+                record.pop(f'{field}_font_size', None)
+                for line_field in text_layout.line_fields(field, box):
+                    record.pop(f'{line_field}_x', None)
+    return record
+
+
+def prepared_templates(module, backend: str, work_dir: str, templates_dir: str) -> OrderedDict:
+    """ Return {role: template file} of the conference `module`, prepared in
+    `work_dir` as its pipeline prepares them for `backend`, with
+    `templates_dir` linked as its `templates` folder.
+    """
+    templates_link = os.path.join(work_dir, 'templates')
+    if not os.path.lexists(templates_link):
+        os.symlink(templates_dir, templates_link)
+
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        # the certificates link their images only for the backends that load them
+        if 'backend' in inspect.signature(module.role_files).parameters:
+            role_files = module.role_files(SAMPLE_USERS_FILE, backend=backend)
+        else:
+            role_files = module.role_files(SAMPLE_USERS_FILE)
+        return OrderedDict((role, os.path.abspath(template_file))
+                           for role, (_, template_file) in role_files.items() if os.path.exists(template_file))
+    finally:
+        os.chdir(cwd)
+
+
+def read_pnm(content: bytes):
+    """ Return the image of the binary PPM (P6) or PGM (P5) `content` as a
+    (height, width, channels) uint8 array.
+    """
+    import numpy as np
+
+    tokens = []
+    position = 0
+    while len(tokens) < 4:
+        while content[position:position + 1].isspace():
+            position += 1
+        if content[position:position + 1] == b'#':
+            position = content.index(b'\n', position)
+            continue
+        end = position
+        while not content[end:end + 1].isspace():
+            end += 1
+        tokens.append(content[position:end])
+        position = end
+    magic, width, height = tokens[0], int(tokens[1]), int(tokens[2])
+    channels = 3 if magic == b'P6' else 1
+    pixels = np.frombuffer(content, dtype=np.uint8, count=width * height * channels, offset=position + 1)
+    return pixels.reshape(height, width, channels)
+
+
+def rasterize(pdf_file: str, dpi: int):
+    """ Return the first page of `pdf_file` rendered by Ghostscript at `dpi`. """
+    cmd = ['gs', '-q', '-dNOPAUSE', '-dBATCH', '-dSAFER', '-sDEVICE=ppmraw', f'-r{dpi}',
+           '-dFirstPage=1', '-dLastPage=1', '-sOutputFile=-', pdf_file]
+    process = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    return read_pnm(process.stdout)
+
+
+def compare(image, reference, tolerance: int) -> dict:
+    """ Return the fraction of the pixels of `image` that differ from
+    `reference` by more than `tolerance` levels, and the largest difference.
+    """
+    import numpy as np
+
+    if image.shape != reference.shape:
+        return {'changed': 1.0, 'max_diff': 255, 'note': f'page size {image.shape[1::-1]} '
+                                                         f'instead of {reference.shape[1::-1]}'}
+    difference = np.abs(image.astype(np.int16) - reference.astype(np.int16)).max(axis=2)
+    return {'changed': float((difference > tolerance).mean()), 'max_diff': int(difference.max()),
+            'difference': difference}
+
+
+def write_pgm(path: str, difference):
+    """ Write the differences as a grey-level image, black where the images match. """
+    import numpy as np
+
+    height, width = difference.shape
+    with open(path, 'wb') as pgm:
+        pgm.write(f'P5\n{width} {height}\n255\n'.encode('ascii'))
+        pgm.write(np.clip(difference.astype(np.int32) * 4, 0, 255).astype(np.uint8).tobytes())
+
+
+def time_backend(backend: svg_backends.SVGBackend, svg_file: str, pdf_file: str, repeat: int, dpi: int) -> dict:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        backend.convert(svg_file, pdf_file, dpi=dpi)
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+    return {'files_per_s': round(1 / best, 2) if best else None, 'ms_per_file': round(best * 1000, 2),
+            'pdf_bytes': os.path.getsize(pdf_file)}
+
+
+def run(conferences, backends, reference: str, repeat: int, dpi: int, raster_dpi: int, tolerance: int,
+        threshold: float, diff_dir: str = None) -> OrderedDict:
+    results = OrderedDict()
+    work_dir = tempfile.mkdtemp(prefix='svg-backends-')
+    try:
+        for conference in conferences:
+            module = importlib.import_module(f'conferences.{conference}')
+            conference_dir = os.path.join(work_dir, conference)
+            os.makedirs(conference_dir)
+            templates_dir = os.path.join(REPO_DIR, CONFERENCES[conference].get('templates', 'templates'))
+            templates = {backend.name: prepared_templates(module, backend.name, conference_dir, templates_dir)
+                         for backend in backends}
+
+            for role in templates[backends[0].name]:
+                name = f'{conference}/{role}'
+                stem = f'{conference}-{role}'
+                template_results = OrderedDict()
+                images = {}
+                for backend in backends:
+                    template_file = templates[backend.name][role]
+                    svg_file = os.path.join(conference_dir, f'{stem}-{backend.name}.svg')
+                    pdf_file = os.path.join(conference_dir, f'{stem}-{backend.name}.pdf')
+                    try:
+                        with open(svg_file, 'w', encoding='utf-8') as svg:
+                            svg.write(SVGTemplate(template_file).fill(sample_record(template_file, module)))
+                        template_results[backend.name] = time_backend(backend, svg_file, pdf_file, repeat, dpi)
+                        images[backend.name] = rasterize(pdf_file, raster_dpi)
+                    except (subprocess.CalledProcessError, OSError, ValueError) as exc:
+                        template_results[backend.name] = {'error': repr(exc)}
+
+                for backend_name, image in images.items():
+                    if reference not in images:
+                        break
+                    comparison = compare(image, images[reference], tolerance)
+                    difference = comparison.pop('difference', None)
+                    if diff_dir and difference is not None and backend_name != reference:
+                        os.makedirs(diff_dir, exist_ok=True)
+                        write_pgm(os.path.join(diff_dir, f'{stem}-{backend_name}.pgm'), difference)
+                    comparison['correct'] = comparison['changed'] <= threshold
+                    template_results[backend_name].update(comparison)
+
+                correct = [(result['ms_per_file'], backend_name) for backend_name, result in template_results.items()
+                           if result.get('correct')]
+                results[name] = {'backends': template_results,
+                                 'fastest_correct': min(correct)[1] if correct else None}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def print_summary(results: dict, reference: str):
+    print(f'\n{"template":<45} {"backend":<10} {"files/s":>8} {"ms":>8} {"KB":>7} {"changed":>8}  vs {reference}')
+    for name, result in results.items():
+        for backend_name, backend_result in result['backends'].items():
+            if 'error' in backend_result:
+                print(f'{name:<45} {backend_name:<10} {backend_result["error"]}')
+                continue
+            changed = backend_result.get('changed')
+            verdict = '' if changed is None else ('ok' if backend_result['correct'] else 'DIFFERS')
+            print(f'{name:<45} {backend_name:<10} {backend_result["files_per_s"]:>8} '
+                  f'{backend_result["ms_per_file"]:>8} {backend_result["pdf_bytes"] / 1024:>7.1f} '
+                  f'{"" if changed is None else f"{changed:.2%}":>8}  {verdict} {backend_result.get("note", "")}')
+        print(f'{"":<45} fastest correct: {result["fastest_correct"]}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--conferences', nargs='+', default=list(CONFERENCES), choices=list(CONFERENCES),
+                        help='conference modules whose templates are compared')
+    parser.add_argument('--backends', nargs='+', default=list(svg_backends.BACKENDS), help='backends to compare')
+    parser.add_argument('--reference', default='inkscape', help='backend the others are compared to')
+    parser.add_argument('--repeat', type=int, default=5, help='conversions per template and backend')
+    parser.add_argument('--dpi', type=int, default=72, help='DPI of the conversion')
+    parser.add_argument('--raster-dpi', type=int, default=100, help='DPI of the pixel comparison')
+    parser.add_argument('--tolerance', type=int, default=48, help='levels a pixel can differ, for antialiasing')
+    parser.add_argument('--threshold', type=float, default=0.005, help='fraction of pixels that can differ')
+    parser.add_argument('--diff-dir', help='folder to write the difference images to')
+    parser.add_argument('--output', help='JSON results file, by default in benchmarks/results')
+    args = parser.parse_args(argv)
+
+    unknown = [name for name in args.backends if name not in svg_backends.BACKENDS]
+    if unknown:
+        parser.error(f'unknown backends {unknown}, use some of {list(svg_backends.BACKENDS)}')
+    backends = [svg_backends.BACKENDS[name] for name in args.backends if svg_backends.BACKENDS[name].available()]
+    missing = [name for name in args.backends if name not in [backend.name for backend in backends]]
+    if missing:
+        print(f'Not available here, skipped: {missing}')
+    if not backends:
+        print('No SVG backend available.')
+        return 1
+    if shutil.which('gs') is None:
+        print('Ghostscript (gs) is needed to compare the PDF files.')
+        return 1
+    if args.reference not in [backend.name for backend in backends]:
+        print(f'The reference backend {args.reference} is not available, comparing to {backends[0].name}.')
+        args.reference = backends[0].name
+
+    results = run(args.conferences, backends, args.reference, args.repeat, args.dpi, args.raster_dpi, args.tolerance,
+                  args.threshold, diff_dir=args.diff_dir)
+    print_summary(results, args.reference)
+
+    output = args.output or os.path.join(RESULTS_DIR, f'backends-{datetime.now().strftime("%Y%m%d-%H%M%S")}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as json_file:
+        json.dump({'host': platform.node(), 'python': platform.python_version(), 'reference': args.reference,
+                   'dpi': args.dpi, 'raster_dpi': args.raster_dpi, 'tolerance': args.tolerance,
+                   'threshold': args.threshold, 'templates': results}, json_file, indent=2)
+    print(f'\nResults written to {output}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,293 @@
+"""
+Time every stage of the conference pipelines on synthetic Ti.to exports.
+
+Each (conference, rows) case runs in its own Python process inside a
+temporary working directory, so module state, the current directory and
+the peak RSS of one case do not leak into the next one.
+
+Usage:
+
+    python -m benchmarks.run_benchmarks --rows 1000 10000 100000
+    python -m benchmarks.run_benchmarks --render real --conferences euroscipy2019
+    python -m benchmarks.run_benchmarks --compare benchmarks/results/baseline.json
+
+With `--render stub` (the default) docstamp, Ghostscript, Inkscape and the
+PDF merging are replaced by functions that only write placeholder files, so
+the numbers measure our own code. `--render real` calls the real tools.
+"""
+import argparse
+import csv
+import importlib
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from datetime import datetime
+from glob import glob
+
+from benchmarks.tito_generator import GENERATORS
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+RESULTS_DIR = os.path.join(REPO_DIR, 'benchmarks', 'results')
+
+DEFAULT_ROWS = [1000, 10000, 100000]
+
+# conference module -> entry task, the column docstamp uses for the file names
+# and the templates linked as `templates` in the working directory
+CONFERENCES = OrderedDict([
+    ('euroscipy2019', {'entry': 'all', 'filename_field': 'email'}),
+    ('pyconweb2019', {'entry': 'all', 'filename_field': 'Number', 'templates': 'templates/pyconweb2019'}),
+    ('euroscipy2019_certificates', {'entry': 'certificates', 'filename_field': 'email'}),
+])
+
+STUB_PDF = b'%PDF-1.4\n% tito-docstamp benchmark stub\n%%EOF\n'
+
+
+def _stub_docstamp(input_file, outdir, template_file, filename_field, output_type='pdf'):
+    """ Write one placeholder file per row of `input_file`, named the way
+    `docstamp create` names them.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    basename = os.path.splitext(os.path.basename(template_file))[0]
+    with open(input_file, newline='', encoding='utf-8') as csvfile:
+        for row in csv.DictReader(csvfile):
+            file_name = os.path.join(outdir, f'{basename}_{row[filename_field]}.{output_type}')
+            with open(file_name, 'wb') as out:
+                out.write(STUB_PDF)
+
+
+def _stub_copy(input_file, output_file):
+    shutil.copyfile(input_file, output_file)
+
+
+def _stub_merge_pdfs(filepaths, out_filepath):
+    with open(out_filepath, 'wb') as out:
+        for filepath in filepaths:
+            with open(filepath, 'rb') as pdf:
+                out.write(pdf.read())
+    return out_filepath
+
+
+def stub_renderers(module, filename_field):
+    """ Replace the functions of `module` that shell out to docstamp, gs or
+    inkscape, or that merge PDFs, with cheap placeholders.
+    """
+    def create_badge_set(input_file, outdir, template_file):
+        _stub_docstamp(input_file, outdir, template_file, filename_field)
+
+    def render_files(input_file, output_dir, template_file, output_type='svg'):
+        _stub_docstamp(input_file, output_dir, template_file, filename_field, output_type=output_type)
+
+    stubs = {
+        'create_badge_set': create_badge_set,
+        'render_files': render_files,
+        '_pdf_to_cmyk': _stub_copy,
+    }
+    for name, stub in stubs.items():
+        if hasattr(module, name):
+            setattr(module, name, stub)
+
+    # the conference modules import these inside the tasks
+    import docstamp.pdf_utils
+    docstamp.pdf_utils.pdf_to_cmyk = _stub_copy
+    docstamp.pdf_utils.merge_pdfs = _stub_merge_pdfs
+
+    import conferences.svg_backends
+    conferences.svg_backends.convert = lambda svg_file, pdf_file, backend, dpi=72: _stub_copy(svg_file, pdf_file)
+
+    import conferences.pdf_optimize
+    conferences.pdf_optimize.duplex_pdf = lambda pdf_filepath, output_filepath: _stub_merge_pdfs(
+        [pdf_filepath] * 2, output_filepath)
+
+
+def time_tasks(module):
+    """ Wrap every invoke task of `module` so that each call is timed.
+    The tasks call each other through the module globals, so the nested
+    stages of `all` are timed too. Times are inclusive of nested stages.
+
+    Return
+    ------
+    stages: OrderedDict of stage name -> {'calls': int, 'total_s': float}
+    """
+    from invoke import Task
+
+    stages = OrderedDict()
+
+    def timed(name, body):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return body(*args, **kwargs)
+            finally:
+                stage = stages.setdefault(name, {'calls': 0, 'total_s': 0.0})
+                stage['calls'] += 1
+                stage['total_s'] += time.perf_counter() - start
+        return wrapper
+
+    for name, obj in list(vars(module).items()):
+        if isinstance(obj, Task):
+            setattr(module, name, timed(name, obj))
+    return stages
+
+
+def run_case(conference: str, rows: int, render: str, seed: int = 0) -> dict:
+    """ Generate an export of `rows` tickets and run the entry task of
+    `conference` on it in a temporary directory.
+    """
+    from invoke import Context
+
+    sys.path.insert(0, REPO_DIR)
+    spec = CONFERENCES[conference]
+    module = importlib.import_module(f'conferences.{conference}')
+
+    workdir = tempfile.mkdtemp(prefix=f'bench_{conference}_')
+    cwd = os.getcwd()
+    try:
+        os.chdir(workdir)
+        os.symlink(os.path.join(REPO_DIR, spec.get('templates', 'templates')), 'templates')
+        for outdir in ('stamped', 'blank', 'certificates'):
+            os.makedirs(outdir)
+
+        input_file = 'tito.csv'
+        start = time.perf_counter()
+        GENERATORS[conference](input_file, rows, module, seed=seed)
+        generate_s = time.perf_counter() - start
+
+        if render == 'stub':
+            stub_renderers(module, spec['filename_field'])
+        stages = time_tasks(module)
+
+        # the tasks import pandas lazily, do not charge it to the first stage
+        import pandas  # noqa: F401
+
+        start = time.perf_counter()
+        getattr(module, spec['entry'])(Context(), input_file=input_file)
+        total_s = time.perf_counter() - start
+
+        outputs = [path for path in glob(os.path.join('**', '*.pdf'), recursive=True)]
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'conference': conference,
+        'entry': spec['entry'],
+        'rows': rows,
+        'render': render,
+        'generate_s': generate_s,
+        'total_s': total_s,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'output_pdfs': len(outputs),
+        'stages': stages,
+    }
+
+
+def _run_case_subprocess(conference: str, rows: int, render: str, seed: int) -> dict:
+    cmd = [sys.executable, '-m', 'benchmarks.run_benchmarks', '--case',
+           '--conferences', conference, '--rows', str(rows), '--render', render, '--seed', str(seed)]
+    print('Calling {}'.format(' '.join(cmd)), file=sys.stderr)
+    # time the renders, not the render cache
+    env = dict(os.environ, DOCSTAMP_CACHE_DIR='')
+    output = subprocess.run(cmd, cwd=REPO_DIR, env=env, stdout=subprocess.PIPE, check=True).stdout
+    return json.loads(output.decode('utf-8').splitlines()[-1])
+
+
+def compare(results: dict, baseline: dict, threshold: float = 1.25, min_delta_s: float = 0.05) -> list:
+    """ Return a list of regressions of `results` with respect to `baseline`.
+    A stage regresses when it is `threshold` times slower than in the
+    baseline and at least `min_delta_s` seconds slower.
+    """
+    def key(case):
+        return case['conference'], case['rows'], case['render']
+
+    old_cases = {key(case): case for case in baseline['cases']}
+    regressions = []
+    for case in results['cases']:
+        old = old_cases.get(key(case))
+        if old is None:
+            continue
+
+        timings = [('total', old['total_s'], case['total_s'])]
+        timings += [(name, old['stages'][name]['total_s'], stage['total_s'])
+                    for name, stage in case['stages'].items() if name in old['stages']]
+        for stage, old_s, new_s in timings:
+            if new_s > old_s * threshold and new_s - old_s >= min_delta_s:
+                regressions.append({
+                    'conference': case['conference'],
+                    'rows': case['rows'],
+                    'render': case['render'],
+                    'stage': stage,
+                    'baseline_s': old_s,
+                    'current_s': new_s,
+                    'ratio': new_s / old_s if old_s else float('inf'),
+                })
+    return regressions
+
+
+def print_summary(results: dict, regressions: list):
+    for case in results['cases']:
+        print(f'\n{case["conference"]}.{case["entry"]} - {case["rows"]} rows, {case["render"]} render: '
+              f'{case["total_s"]:.3f} s, peak RSS {case["peak_rss_kb"] / 1024:.1f} MB')
+        for name, stage in case['stages'].items():
+            print(f'    {name:<40} {stage["calls"]:>5} calls {stage["total_s"]:>10.3f} s')
+
+    if regressions:
+        print('\nRegressions:')
+        for reg in regressions:
+            print(f'    {reg["conference"]} {reg["rows"]} rows {reg["stage"]}: '
+                  f'{reg["baseline_s"]:.3f} s -> {reg["current_s"]:.3f} s ({reg["ratio"]:.2f}x)')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--conferences', nargs='+', default=list(CONFERENCES), choices=list(CONFERENCES))
+    parser.add_argument('--rows', nargs='+', type=int, default=DEFAULT_ROWS)
+    parser.add_argument('--render', choices=['stub', 'real'], default='stub')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None,
+                        help='JSON results file, by default benchmarks/results/<timestamp>.json')
+    parser.add_argument('--compare', default=None, help='baseline JSON results file to flag regressions against')
+    parser.add_argument('--threshold', type=float, default=1.25)
+    parser.add_argument('--case', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.case:
+        result = run_case(args.conferences[0], args.rows[0], args.render, seed=args.seed)
+        sys.stdout.write('\n' + json.dumps(result) + '\n')
+        return 0
+
+    results = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'render': args.render,
+        'cases': [_run_case_subprocess(conference, rows, args.render, args.seed)
+                  for conference in args.conferences
+                  for rows in args.rows],
+    }
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), threshold=args.threshold)
+    results['regressions'] = regressions
+
+    output = args.output or os.path.join(RESULTS_DIR, datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as out:
+        json.dump(results, out, indent=2)
+
+    print_summary(results, regressions)
+    print(f'\nResults written to {output}')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,207 @@
+"""
+Synthetic Ti.to attendee exports for the benchmarks.
+
+The generated files mimic what the Ti.to "Export attendees" button gives us:
+the columns each conference module reads (`COLUMNS` / `COLUMNS_RENAME`),
+a bunch of columns nobody reads, ticket names taken from `FILTER_TICKETS`
+plus a few that must be filtered out, people holding more than one ticket
+with the same email (for `merge_tickets`) and long unicode company names.
+"""
+import csv
+import random
+import string
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+FIRST_NAMES = [
+    'Ana', 'Jonas', 'Maël', 'Zoë', 'Nikolaj', 'Ærin', 'Łukasz', 'Ömer', 'Siobhán', 'Žofia',
+    'Chidi', 'Mei', 'Takeshi', 'Priya', 'Guðrún', 'José', 'Björn', 'Renée', 'Wojciech', 'Iñaki',
+    'Alexandre', 'Giulia', 'Kateřina', 'Dmitrij', 'Hélène', 'Yusuf', 'Małgorzata', 'Søren',
+]
+
+LAST_NAMES = [
+    'García', 'Müller', 'Øvergaard', 'Nakamura', 'Van der Berg', 'O\'Connor', 'Srinivasan',
+    'Kowalczyk-Wiśniewska', 'Dubois', 'Ždanov', 'Jóhannsdóttir', 'Papadopoulos', 'Rossi',
+    'Fernández de la Cruz', 'Nguyễn', 'Smith', 'Abadie', 'Schönberger', 'Đorđević',
+]
+
+COMPANY_WORDS = [
+    'Institut', 'für', 'Angewandte', 'Strömungsmechanik', 'Università', 'degli', 'Studi',
+    'Laboratoire', 'd\'Informatique', 'École', 'Polytechnique', 'Fédérale', 'Département',
+    'Научно-исследовательский', 'институт', 'Research', '&', 'Development', 'GmbH', 'S.L.',
+    'Société', 'Générale', 'Κέντρο', 'Ερευνών', '東京大学', 'Data', 'Science', 'Centre',
+]
+
+TAGLINES = [
+    'I ♥ NumPy', 'Ask me about Dask', 'Scientific Python for everyone', 'Pandas & friends', 'NumPy <3 "SciPy"',
+    'Jupyter all the things', '', '', '', '', '',
+]
+
+EXTRA_TICKETS = [
+    'Sprints (Fri)',
+    'Social event',
+    'Conference T-shirt',
+]
+
+TITO_EXTRA_COLUMNS = [
+    'Ticket Created Date',
+    'Ticket Last Updated Date',
+    'Ticket Phone Number',
+    'Event',
+    'Void Status',
+    'Price',
+    'Discount Status',
+    'Ticket Reference',
+    'Unique Ticket URL',
+    'Order Name',
+    'Order Email',
+    'Order Company Name',
+    'Order Discount Code',
+    'Order Created Date',
+    'Payment Reference',
+]
+
+
+def _company_name(rnd: random.Random) -> str:
+    if rnd.random() < 0.1:
+        return '-'
+    if rnd.random() < 0.2:
+        return ''
+    return ' '.join(rnd.choice(COMPANY_WORDS) for _ in range(rnd.randint(2, 9)))
+
+
+def _email(rnd: random.Random, first_name: str, last_name: str, idx: int) -> str:
+    user = ''.join(ch for ch in f'{first_name}.{last_name}'.lower() if ch in string.ascii_lowercase + '.')
+    return f'{user or "attendee"}.{idx}@{rnd.choice(["example.org", "uni.example.edu", "corp.example.com"])}'
+
+
+def _reference(rnd: random.Random) -> str:
+    return ''.join(rnd.choice(string.ascii_uppercase + string.digits) for _ in range(4))
+
+
+def _people(rnd: random.Random, n_rows: int, duplicate_ratio: float) -> List[Dict[str, str]]:
+    """ Return `n_rows` ticket holders, where about `duplicate_ratio` of the
+    rows re-use the email of a previous one.
+    """
+    people = []
+    for idx in range(n_rows):
+        if people and rnd.random() < duplicate_ratio:
+            people.append(dict(rnd.choice(people)))
+            continue
+
+        first_name = rnd.choice(FIRST_NAMES)
+        last_name = rnd.choice(LAST_NAMES)
+        people.append({
+            'first_name': first_name,
+            'last_name': last_name,
+            'email': _email(rnd, first_name, last_name, idx),
+            'company': _company_name(rnd),
+            'tagline': rnd.choice(TAGLINES),
+        })
+    return people
+
+
+def _base_row(rnd: random.Random, number: int, person: Dict[str, str], ticket: str, tags: str) -> Dict[str, str]:
+    created = datetime(2019, 3, 1) + timedelta(minutes=rnd.randint(0, 200000))
+    order_reference = _reference(rnd)
+    return {
+        'Number': str(number),
+        'Ticket': ticket,
+        'Ticket Full Name': f'{person["first_name"]} {person["last_name"]}',
+        'Ticket First Name': person['first_name'],
+        'Ticket Last Name': person['last_name'],
+        'Ticket Email': person['email'],
+        'Ticket Company Name': person['company'],
+        'Tagline': person['tagline'],
+        'Tags': tags,
+        'Order Reference': order_reference,
+        'Ticket Reference': f'{order_reference}-{rnd.randint(1, 4)}',
+        'Ticket Created Date': created.strftime('%d %b %Y %H:%M'),
+        'Ticket Last Updated Date': created.strftime('%d %b %Y %H:%M'),
+        'Ticket Phone Number': '',
+        'Event': 'Synthetic Conference',
+        'Void Status': '',
+        'Price': f'{rnd.choice([0, 150, 250, 450])}.0',
+        'Discount Status': '',
+        'Unique Ticket URL': f'https://ti.to/tickets/{order_reference.lower()}',
+        'Order Name': f'{person["first_name"]} {person["last_name"]}',
+        'Order Email': person['email'],
+        'Order Company Name': person['company'],
+        'Order Discount Code': '',
+        'Order Created Date': created.strftime('%d %b %Y %H:%M'),
+        'Payment Reference': f'ch_{_reference(rnd).lower()}',
+        'Badge information': '',
+    }
+
+
+def _write_csv(output_file: str, columns: List[str], rows: List[Dict[str, str]], delimiter: str = ',',
+               quoting: int = csv.QUOTE_MINIMAL):
+    with open(output_file, 'w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=columns, delimiter=delimiter, quoting=quoting,
+                                extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def generate_euroscipy2019(output_file: str, n_rows: int, conference, seed: int = 0, duplicate_ratio: float = 0.25):
+    """ Write a euroscipy-like export with `n_rows` tickets to `output_file`.
+    `conference` is the conference module, its `COLUMNS_RENAME` and
+    `FILTER_TICKETS` decide the columns and ticket names.
+    """
+    rnd = random.Random(seed)
+    tickets = sorted(conference.FILTER_TICKETS['Ticket'])
+    tags = ['organizer', 'keynote', 'speaker', 'trainer']
+
+    rows = []
+    for number, person in enumerate(_people(rnd, n_rows, duplicate_ratio), start=1):
+        ticket = rnd.choice(tickets) if rnd.random() < 0.95 else rnd.choice(EXTRA_TICKETS)
+        tag = rnd.choice(tags) if rnd.random() < 0.05 else ''
+        rows.append(_base_row(rnd, number, person, ticket, tag))
+
+    columns = list(conference.COLUMNS_RENAME) + [col for col in TITO_EXTRA_COLUMNS
+                                                 if col not in conference.COLUMNS_RENAME]
+    _write_csv(output_file, columns, rows)
+
+
+def generate_pyconweb2019(output_file: str, n_rows: int, conference, seed: int = 0, duplicate_ratio: float = 0.1):
+    """ Write a pyconweb-like (semicolon separated) export with `n_rows`
+    tickets to `output_file`, with the columns in `conference.COLUMNS`.
+    """
+    rnd = random.Random(seed)
+    tickets = list(conference.FILTER_TICKETS['Ticket'])
+    tags = ['crew', 'organizer', 'speaker', 'crew, organizer', 'speaker, crew']
+
+    rows = []
+    for number, person in enumerate(_people(rnd, n_rows, duplicate_ratio), start=1):
+        tag = rnd.choice(tags) if rnd.random() < 0.08 else ''
+        rows.append(_base_row(rnd, number, person, rnd.choice(tickets), tag))
+
+    # quote everything, like the semicolon separated exports
+    columns = list(conference.COLUMNS) + [col for col in TITO_EXTRA_COLUMNS if col not in conference.COLUMNS]
+    _write_csv(output_file, columns, rows, delimiter=';', quoting=csv.QUOTE_ALL)
+
+
+def generate_default(output_file: str, n_rows: int, conference, seed: int = 0, duplicate_ratio: float = 0.1):
+    """ Write an export for `conferences/default.py` with `n_rows` tickets. """
+    rnd = random.Random(seed)
+    tickets = list(conference.FILTER_TICKETS['Ticket']) + ['Business Late']
+    tags = ['crew', 'crew, organizer', 'speaker']
+
+    rows = []
+    for number, person in enumerate(_people(rnd, n_rows, duplicate_ratio), start=1):
+        tag = rnd.choice(tags) if rnd.random() < 0.08 else ''
+        row = _base_row(rnd, number, person, rnd.choice(tickets), tag)
+        if not person['company']:
+            row['Badge information'] = ' '.join(rnd.choice(COMPANY_WORDS) for _ in range(3))
+        rows.append(row)
+
+    columns = list(conference.COLUMNS) + [col for col in TITO_EXTRA_COLUMNS if col not in conference.COLUMNS]
+    _write_csv(output_file, columns, rows)
+
+
+GENERATORS = {
+    'euroscipy2019': generate_euroscipy2019,
+    'euroscipy2019_certificates': generate_euroscipy2019,
+    'pyconweb2019': generate_pyconweb2019,
+    'default': generate_default,
+}
@@ -0,0 +1,275 @@
+"""
+Attendee lookup index for check-in and reprints.
+
+The index is built from the merged attendee table (the output of
+`merge_tickets`) into a small SQLite file, which opens instantly and answers
+prefix and fuzzy queries over the full name, email, company and order
+references in a few milliseconds:
+
+    inv index-attendees --users-file tito_cleaned_renamed_retagged_merged.csv
+    inv find-attendee "garcia muel"
+
+    from conferences.attendee_index import AttendeeIndex
+    AttendeeIndex('attendees.sqlite').search('ana garc')
+
+Every word of the query must be the start of a word of the attendee
+(prefix search). When that does not give enough results, the words are
+looked up with trigram similarity over the names and companies (fuzzy search),
+so typos and missing accents still find the attendee.
+Each attendee is mapped to the role and the rendered badge file in the
+`stamped` folder.
+"""
+import difflib
+import importlib
+import logging
+import os
+import re
+import sqlite3
+import unicodedata
+from collections import namedtuple
+from typing import Dict, List, Set
+
+from conferences.instrument import task
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONFERENCE = os.environ.get('DOCSTAMP_CONFERENCE', 'euroscipy2019')
+
+INDEX_FILE = 'attendees.sqlite'
+
+# index field -> the columns it can come from, after or before `rename_columns`
+FIELD_COLUMNS = {
+    'full_name': ('full_name', 'Ticket Full Name', 'Ticket_Full_Name'),
+    'email': ('email', 'Ticket Email', 'Ticket_Email'),
+    'company': ('company', 'Ticket Company Name', 'Ticket_Company_Name'),
+    'orders': ('order', 'Order Reference', 'Order_Reference'),
+    'tags': ('tags', 'Tags'),
+}
+
+# the fields also searched with typos
+FUZZY_FIELDS = ('full_name', 'company')
+
+FUZZY_CUTOFF = 0.7
+
+Attendee = namedtuple('Attendee', ['id', 'full_name', 'email', 'company', 'orders', 'role', 'badge_file', 'score'])
+
+SCHEMA = """
+CREATE TABLE attendees (
+    id INTEGER PRIMARY KEY,
+    full_name TEXT, email TEXT, company TEXT, orders TEXT, role TEXT, badge_file TEXT
+);
+CREATE TABLE terms (id INTEGER PRIMARY KEY, term TEXT UNIQUE);
+CREATE TABLE postings (
+    term_id INTEGER, attendee_id INTEGER, PRIMARY KEY (term_id, attendee_id)
+) WITHOUT ROWID;
+CREATE TABLE grams (gram TEXT, term_id INTEGER, PRIMARY KEY (gram, term_id)) WITHOUT ROWID;
+"""
+
+
+def normalize(text: str) -> str:
+    """ Return `text` case folded and without accents. """
+    text = unicodedata.normalize('NFKD', str(text))
+    return ''.join(ch for ch in text if not unicodedata.combining(ch)).casefold()
+
+
+def words(text: str) -> List[str]:
+    return re.findall(r'\w+', normalize(text))
+
+
+def trigrams(term: str) -> Set[str]:
+    padded = f' {term} '
+    return {padded[idx:idx + 3] for idx in range(len(padded) - 2)}
+
+
+def badge_files(stamped_dir: str) -> Dict[str, str]:
+    """ Return the joined badge files in `stamped_dir` by their docstamp name,
+    "<template>_<filename field>", without the '_cmyk' and '-joined' suffixes.
+    """
+    if not stamped_dir or not os.path.isdir(stamped_dir):
+        return {}
+
+    files = {}
+    for file_name in sorted(os.listdir(stamped_dir)):
+        if not file_name.endswith('-joined.pdf'):
+            continue
+        key = file_name[:-len('-joined.pdf')]
+        if key.endswith('_cmyk'):
+            key = key[:-len('_cmyk')]
+        files[key] = os.path.join(stamped_dir, file_name)
+    return files
+
+
+def build_index(conference, users_file: str, index_file: str = INDEX_FILE, stamped_dir: str = 'stamped',
+                filename_field: str = None, delimiter: str = ','):
+    """ Write the index of the attendees in `users_file` to `index_file`.
+    `conference` is the conference module, its `ROLE_RULES`,
+    `badge_template_file` and `FILENAME_FIELD` give the role and the badge
+    file of each attendee.
+    """
+    import pandas as pd
+
+    df = pd.read_csv(users_file, delimiter=delimiter, dtype=str).fillna('')
+    columns = {field: next((col for col in candidates if col in df.columns), None)
+               for field, candidates in FIELD_COLUMNS.items()}
+
+    def column(field: str):
+        return df[columns[field]] if columns[field] else pd.Series([''] * len(df), index=df.index)
+
+    role_rules = getattr(conference, 'ROLE_RULES', None)
+    roles = role_rules.classify(column('tags')).roles.fillna('') if role_rules else column('tags')
+    files = badge_files(stamped_dir)
+    filename_field = filename_field or getattr(conference, 'FILENAME_FIELD', 'email')
+    # the column before `rename_columns` or the split in role files, e.g. 'Ticket Reference'
+    filename_column = next((col for col in (filename_field, filename_field.replace('_', ' ')) if col in df.columns),
+                           None)
+    filename_values = df[filename_column] if filename_column else column('email')
+
+    if os.path.exists(index_file):
+        os.remove(index_file)
+    db = sqlite3.connect(index_file)
+    db.executescript(SCHEMA)
+
+    # the attendee ids follow the name order, the order of equally scored results
+    records = sorted(
+        zip(column('full_name'), column('email'), column('company'), column('orders'), roles, filename_values),
+        key=lambda record: (normalize(record[0]), record[1]),
+    )
+
+    attendees = []
+    term_ids = {}
+    postings = set()
+    fuzzy_terms = set()
+    for attendee_id, (full_name, email, company, orders, role, filename_value) in enumerate(records):
+        badge_file = ''
+        if role:
+            template = os.path.splitext(conference.badge_template_file(role))[0]
+            badge_file = files.get(f'{template}_{filename_value.replace(" ", "")}', '')
+        attendees.append((attendee_id, full_name, email, company, orders, role, badge_file))
+
+        fields = {'full_name': full_name, 'email': email, 'company': company, 'orders': orders}
+        for field, value in fields.items():
+            for term in words(value):
+                term_id = term_ids.setdefault(term, len(term_ids))
+                postings.add((term_id, attendee_id))
+                if field in FUZZY_FIELDS:
+                    fuzzy_terms.add(term)
+
+    db.executemany('INSERT INTO attendees VALUES (?, ?, ?, ?, ?, ?, ?)', attendees)
+    db.executemany('INSERT INTO terms VALUES (?, ?)', ((term_id, term) for term, term_id in term_ids.items()))
+    db.executemany('INSERT INTO postings VALUES (?, ?)', sorted(postings))
+    db.executemany('INSERT INTO grams VALUES (?, ?)',
+                   sorted((gram, term_ids[term]) for term in fuzzy_terms for gram in trigrams(term)))
+    db.commit()
+    db.execute('VACUUM')
+    db.close()
+
+    logger.info(f'Indexed {len(attendees)} attendees and {len(term_ids)} words in {index_file}.')
+    return index_file
+
+
+class AttendeeIndex:
+    """ Read-only access to an index written by `build_index`. """
+
+    def __init__(self, index_file: str = INDEX_FILE):
+        if not os.path.exists(index_file):
+            raise FileNotFoundError(f'Could not find the attendee index {index_file}, run `inv index-attendees`.')
+        self.index_file = index_file
+        self.db = sqlite3.connect(f'file:{index_file}?mode=ro', uri=True, check_same_thread=False)
+
+    def close(self):
+        self.db.close()
+
+    def _attendees(self, scores: Dict[int, float], limit: int) -> List[Attendee]:
+        ids = sorted(scores, key=lambda attendee_id: (-scores[attendee_id], attendee_id))[:limit]
+        if not ids:
+            return []
+        rows = self.db.execute(f'SELECT * FROM attendees WHERE id IN ({",".join("?" * len(ids))})', ids)
+        attendees = {row[0]: Attendee(*row, score=scores[row[0]]) for row in rows}
+        return [attendees[attendee_id] for attendee_id in ids]
+
+    def _prefix_ids(self, word: str) -> Set[int]:
+        rows = self.db.execute(
+            'SELECT DISTINCT p.attendee_id FROM terms t JOIN postings p ON p.term_id = t.id '
+            'WHERE t.term >= ? AND t.term < ?', (word, word + '\U0010ffff')
+        )
+        return {attendee_id for attendee_id, in rows}
+
+    def _similar_terms(self, word: str, cutoff: float) -> Dict[int, float]:
+        grams = list(trigrams(word))
+        rows = self.db.execute(
+            f'SELECT t.id, t.term FROM grams g JOIN terms t ON t.id = g.term_id '
+            f'WHERE g.gram IN ({",".join("?" * len(grams))}) '
+            f'GROUP BY g.term_id HAVING COUNT(*) >= ?', grams + [max(1, len(grams) // 3)]
+        )
+        similar = {}
+        for term_id, term in rows:
+            ratio = difflib.SequenceMatcher(None, word, term).ratio()
+            if ratio >= cutoff:
+                similar[term_id] = ratio
+        return similar
+
+    def prefix_search(self, query: str, limit: int = 20) -> List[Attendee]:
+        """ Return the attendees with a word starting with each word of `query`. """
+        ids = None
+        for word in words(query):
+            ids = self._prefix_ids(word) if ids is None else ids & self._prefix_ids(word)
+            if not ids:
+                return []
+        return self._attendees(dict.fromkeys(ids or (), 1.0), limit)
+
+    def fuzzy_search(self, query: str, limit: int = 20, cutoff: float = FUZZY_CUTOFF) -> List[Attendee]:
+        """ Return the attendees with names or companies similar to all the
+        words of `query`, the most similar first.
+        """
+        scores = None
+        query_words = words(query)
+        for word in query_words:
+            word_scores = {}
+            for term_id, ratio in self._similar_terms(word, cutoff).items():
+                for attendee_id, in self.db.execute('SELECT attendee_id FROM postings WHERE term_id = ?', (term_id,)):
+                    word_scores[attendee_id] = max(ratio, word_scores.get(attendee_id, 0))
+            if scores is None:
+                scores = word_scores
+            else:
+                scores = {attendee_id: score + word_scores[attendee_id]
+                          for attendee_id, score in scores.items() if attendee_id in word_scores}
+            if not scores:
+                return []
+        return self._attendees({attendee_id: score / len(query_words) for attendee_id, score in (scores or {}).items()},
+                               limit)
+
+    def search(self, query: str, limit: int = 20) -> List[Attendee]:
+        """ Return the prefix matches of `query`, completed with the fuzzy
+        matches when there are less than `limit`.
+        """
+        found = self.prefix_search(query, limit=limit)
+        if len(found) < limit:
+            seen = {attendee.id for attendee in found}
+            found += [attendee for attendee in self.fuzzy_search(query, limit=limit)
+                      if attendee.id not in seen][:limit - len(found)]
+        return found
+
+    def by_email(self, email: str) -> List[Attendee]:
+        rows = self.db.execute('SELECT * FROM attendees WHERE email = ?', (email,))
+        return [Attendee(*row, score=1.0) for row in rows]
+
+
+@task
+def index_attendees(ctx, users_file, index_file=INDEX_FILE, stamped_dir='stamped', conference=DEFAULT_CONFERENCE,
+                    filename_field='', delimiter=','):
+    """ Build the attendee lookup index from the merged attendee table,
+    the badges are named after the `FILENAME_FIELD` of the conference by default.
+    """
+    module = importlib.import_module(f'conferences.{conference}')
+    build_index(module, users_file, index_file=index_file, stamped_dir=stamped_dir,
+                filename_field=filename_field or None, delimiter=delimiter)
+
+
+@task
+def find_attendee(ctx, query, index_file=INDEX_FILE, limit=10):
+    """ Print the attendees matching `query` and their badge file. """
+    index = AttendeeIndex(index_file)
+    for attendee in index.search(query, limit=int(limit)):
+        print(f'{attendee.score:.2f}  {attendee.full_name:30}  {attendee.email:35}  {attendee.company[:30]:30}  '
+              f'{attendee.role:20}  {attendee.badge_file or "-"}')
+    index.close()
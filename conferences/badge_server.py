@@ -0,0 +1,240 @@
+"""
+Warm badge render server for reprints and walk-ins at the registration desk.
+
+The server loads the badge templates of a conference module once, and
+renders one attendee per HTTP request to a print ready duplex PDF (CMYK, two
+faces), reusing the role -> template mapping of the conference module
+(`ROLETAG_TEMPLATES` or `ROLES`, and `badge_template_file`):
+
+    inv serve-badges --conference euroscipy2019 --outdir reprints
+
+    curl -X POST http://127.0.0.1:8042/badge -o badge.pdf -d '{
+        "first_name": "Ada", "last_name": "Lovelace", "company": "Analytical Engines",
+        "tagline": "", "email": "ada@example.org", "tags": "speaker"
+    }'
+
+The record uses the column names of the conference after `rename_columns`.
+The role is taken from the `role` field if given, otherwise from the tags
+with the `ROLE_RULES` of the conference. The badge is named after the
+`FILENAME_FIELD` of the conference, as in the batch pipeline, and a value
+that is not a file name gets a 422 response.
+"""
+import importlib
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple
+
+from conferences import pdf_optimize, text_layout, validation
+from conferences.instrument import task
+from conferences.svg_render import SVGTemplate, rsvg_convert
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONFERENCE = os.environ.get('DOCSTAMP_CONFERENCE', 'euroscipy2019')
+
+
+def conference_templates(conference) -> Dict[str, str]:
+    """ Return the role -> template file path mapping of the `conference` module. """
+    templates_dir = getattr(conference, 'TEMPLATES_DIR', 'templates')
+    roles = getattr(conference, 'ROLETAG_TEMPLATES', None) or conference.ROLES
+    return {role: os.path.join(templates_dir, conference.badge_template_file(role)) for role in roles}
+
+
+def pdf_to_cmyk_bytes(pdf: bytes) -> bytes:
+    """ Convert the `pdf` content to CMYK with Ghostscript. """
+    with tempfile.TemporaryDirectory(prefix='badge_') as tmpdir:
+        input_file = os.path.join(tmpdir, 'rgb.pdf')
+        output_file = os.path.join(tmpdir, 'cmyk.pdf')
+        with open(input_file, 'wb') as rgb:
+            rgb.write(pdf)
+        cmd = ['gs', '-dSAFER', '-dBATCH', '-dNOPAUSE', '-dNOCACHE', '-sDEVICE=pdfwrite',
+               '-sColorConversionStrategy=CMYK', '-dProcessColorModel=/DeviceCMYK',
+               f'-sOutputFile={output_file}', input_file]
+        subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        with open(output_file, 'rb') as cmyk:
+            return cmyk.read()
+
+
+def duplex_pdf_bytes(pdf: bytes) -> bytes:
+    """ Return the `pdf` content with both faces of the badge, as the batch pipeline joins them. """
+    with tempfile.TemporaryDirectory(prefix='badge_') as tmpdir:
+        input_file = os.path.join(tmpdir, 'badge.pdf')
+        output_file = os.path.join(tmpdir, 'badge-joined.pdf')
+        with open(input_file, 'wb') as badge:
+            badge.write(pdf)
+        pdf_optimize.duplex_pdf(input_file, output_file)
+        with open(output_file, 'rb') as joined:
+            return joined.read()
+
+
+class BadgeRenderer:
+    """ Renders single badges of the `conference` module with its templates
+    compiled once.
+    """
+    def __init__(self, conference, cmyk: bool = True, dpi: int = 72):
+        self.conference = conference
+        self.cmyk = cmyk
+        self.dpi = dpi
+        self.templates = {}
+        self.fitters = {}
+        text_boxes = getattr(conference, 'TEXT_BOXES', None)
+        for role, template_file in conference_templates(conference).items():
+            if text_boxes:
+                try:
+                    self.fitters[role] = text_layout.TextFitter(template_file, text_boxes)
+                    template_file = text_layout.fit_template(template_file, text_boxes,
+                                                             conference.FITTED_TEMPLATES_DIR)
+                except FileNotFoundError as exc:
+                    logger.warning(f'{exc} Splitting the texts of the {role} badges by number of characters.')
+            self.templates[role] = SVGTemplate(template_file)
+
+    def role(self, record: Dict[str, str]) -> str:
+        if record.get('role'):
+            return record['role']
+
+        tags = record.get('tags', record.get('Tags', '')) or ''
+        ticket_type_tags = getattr(self.conference, 'TICKET_TYPE_TEMPLATES', {})
+        if not tags and record.get('ticket_type') in ticket_type_tags:
+            tags = ticket_type_tags[record['ticket_type']]
+        return self.conference.ROLE_RULES.role(tags)
+
+    def prepare(self, role: str, record: Dict[str, str]) -> Dict[str, str]:
+        """ Fit the long fields in the `role` template the way `split_users_csv` does. """
+        record = dict(record)
+        if role in self.fitters:
+            record.update(self.fitters[role].fit_record(record))
+            return record
+
+        two_lines = [col.replace(' ', '_') for col in self.conference.COLS_WITH_2_LINES]
+        for field, max_length in self.conference.MAXLENGTHS.items():
+            field = field.replace(' ', '_')
+            line1, line2 = self.conference.split_in_two(record.get(field, ''), max_length=max_length)
+            if field in two_lines:
+                record[field + '1'] = line1
+                record[field + '2'] = line2
+            else:
+                record[field] = line1
+        return record
+
+    def render(self, record: Dict[str, str]) -> Tuple[str, bytes]:
+        """ Return the role and the print ready PDF content of the badge of `record`. """
+        role = self.role(record)
+        if role not in self.templates:
+            raise KeyError(f'No badge template for the role {role!r} of {record}.')
+
+        svg = self.templates[role].fill(self.prepare(role, record))
+        pdf = rsvg_convert(svg, output_type='pdf', dpi=self.dpi)
+        if self.cmyk:
+            pdf = pdf_to_cmyk_bytes(pdf)
+        return role, duplex_pdf_bytes(pdf)
+
+    def badge_file_name(self, role: str, record: Dict[str, str]) -> str:
+        """ Return the name the pipeline gives to the joined badge of `record`,
+        raise ValueError when its filename field is not a file name.
+        """
+        filename_field = getattr(self.conference, 'FILENAME_FIELD', 'email')
+        name = str(record.get(filename_field) or '').replace(' ', '')
+        if not validation.is_file_name(name):
+            raise ValueError(f'The {filename_field} {name!r} of the attendee cannot name the badge file.')
+        suffix = '_cmyk-joined.pdf' if self.cmyk else '-joined.pdf'
+        return f'{self.templates[role].name}_{name}{suffix}'
+
+
+def content_disposition(file_name: str) -> str:
+    """ Return the Content-Disposition header of the download of `file_name`,
+    with an ASCII fallback name and the UTF-8 one.
+    """
+    fallback = ''.join(char if ' ' <= char < '\x7f' and char not in '"\\' else '_' for char in file_name)
+    return f'attachment; filename="{fallback}"; filename*=UTF-8\'\'{urllib.parse.quote(file_name)}'
+
+
+def make_handler(renderer: BadgeRenderer, outdir: str = ''):
+    class BadgeRequestHandler(BaseHTTPRequestHandler):
+        def _send(self, status: int, body: bytes, content_type: str = 'application/json', headers=None):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_json(self, status: int, content):
+            self._send(status, json.dumps(content).encode('utf-8'))
+
+        def do_GET(self):
+            if self.path == '/roles':
+                self._send_json(200, sorted(renderer.templates))
+            elif self.path == '/health':
+                self._send_json(200, {'status': 'ok'})
+            else:
+                self._send_json(404, {'error': f'Unknown path {self.path}.'})
+
+        def do_POST(self):
+            if self.path != '/badge':
+                return self._send_json(404, {'error': f'Unknown path {self.path}.'})
+
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                record = json.loads(self.rfile.read(length).decode('utf-8'))
+                if not isinstance(record, dict):
+                    raise ValueError('The attendee record must be a JSON object.')
+            except ValueError as exc:
+                return self._send_json(400, {'error': str(exc)})
+
+            start = time.perf_counter()
+            try:
+                role, pdf = renderer.render(record)
+                file_name = renderer.badge_file_name(role, record)
+            except (KeyError, ValueError) as exc:
+                return self._send_json(422, {'error': str(exc)})
+            except (OSError, subprocess.CalledProcessError) as exc:
+                logger.exception(f'Error rendering the badge of {record}.')
+                return self._send_json(500, {'error': str(exc)})
+            elapsed = time.perf_counter() - start
+
+            if outdir:
+                try:
+                    os.makedirs(outdir, exist_ok=True)
+                    with open(os.path.join(outdir, file_name), 'wb') as badge:
+                        badge.write(pdf)
+                except OSError as exc:
+                    logger.exception(f'Error writing the badge {file_name}.')
+                    return self._send_json(500, {'error': str(exc)})
+
+            logger.info(f'Rendered {file_name} in {elapsed:.3f} s.')
+            self._send(200, pdf, content_type='application/pdf', headers={
+                'Content-Disposition': content_disposition(file_name),
+                'X-Badge-Role': role,
+                'X-Render-Seconds': f'{elapsed:.3f}',
+            })
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return BadgeRequestHandler
+
+
+@task
+def serve_badges(ctx, conference=DEFAULT_CONFERENCE, host='127.0.0.1', port=8042, cmyk=True, outdir=''):
+    """ Serve single badge renders of `conference` on http://host:port/badge. """
+    module = importlib.import_module(f'conferences.{conference}')
+    renderer = BadgeRenderer(module, cmyk=cmyk)
+
+    # warm up the converters, the fonts and the imports
+    renderer.render({'role': next(iter(renderer.templates)), 'email': 'warmup'})
+
+    server = ThreadingHTTPServer((host, int(port)), make_handler(renderer, outdir=outdir))
+    logger.info(f'Serving {conference} badges for {sorted(renderer.templates)} on http://{host}:{port}/badge')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,272 @@
+"""
+Several conferences rendered side by side on one pool of worker processes.
+
+Instead of editing `tasks.py` and running `inv all` for one event after the
+other, list the events in a JSON file and render them together:
+
+    {"events": [
+        {"name": "euroscipy", "conference": "euroscipy2019", "directory": "euroscipy",
+         "package": "print/badges.zip"},
+        {"name": "certificates", "conference": "euroscipy2019_certificates", "directory": "certificates"},
+        {"name": "reprints", "conference": "pyconweb2019", "directory": "reprints",
+         "input_file": "reprints.csv", "priority": 1}
+    ]}
+
+    inv batch --config batch.json --workers 8
+
+Each event runs in its own `directory`, the folder `inv all` would run in,
+with its input file (`tito.csv` by default) and, for the conferences that
+read them from there, its `templates`. The CSV stages, the fitted templates
+and the outputs of an event stay in its folder, the settings are the ones of
+its conference module, so two events never share a file.
+
+An event is a chain of jobs: the CSV stages and the validation, the render of
+its attendees in units of `unit_size` (render, CMYK and faces, as the work
+queue units), the blank badges and the archive of `package`. All the jobs go
+to one pool of `workers` processes. When a worker is free, the ready job of
+the highest `priority` runs first, and among the events of the same priority
+the one using the fewest workers for its `weight`, so a small event is never
+stuck behind the units of a big one.
+
+A worker process killed while it runs a job (by the OOM killer, say) breaks
+the pool. The events with a job running on it fail, the pool is started
+again and the other events go on.
+"""
+import importlib
+import json
+import logging
+import os
+import shutil
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List
+
+from conferences import packaging, work_queue
+from conferences.instrument import task
+
+logger = logging.getLogger(__name__)
+
+# smaller than the work queue units, a free worker goes to the next event sooner
+UNIT_SIZE = 50
+
+UNITS_DIR = '.batch-units'
+
+EVENT_DEFAULTS = {
+    'input_file': 'tito.csv',
+    'priority': 0,
+    'weight': 1,
+    'package': None,
+    'part_mb': 0,
+}
+
+
+class Event:
+    """ A conference rendered in its own `directory`, and its jobs. """
+    def __init__(self, name: str, conference: str, directory: str, input_file: str, priority: int = 0,
+                 weight: float = 1, package: str = None, part_mb: int = 0, unit_size: int = UNIT_SIZE):
+        if weight <= 0:
+            raise ValueError(f'The weight of {name} must be positive, not {weight}.')
+        self.name = name
+        self.conference = conference if '.' in conference else f'conferences.{conference}'
+        self.directory = os.path.abspath(directory)
+        self.input_file = input_file
+        self.priority = priority
+        self.weight = weight
+        self.package = package
+        self.part_mb = part_mb
+        self.unit_size = unit_size
+
+        self.jobs = deque()
+        self.running = 0
+        self.busy_seconds = 0.0
+        self.tickets_file = None
+        self.done_seconds = None
+        self.error = None
+
+    @property
+    def outdir(self) -> str:
+        return os.path.join(self.directory, importlib.import_module(self.conference).OUTPUT_DIRS[0])
+
+    def share(self):
+        """ Return the sort key of the event for the next free worker. """
+        return -self.priority, self.running / self.weight, self.busy_seconds / self.weight
+
+
+def read_events(config_file: str, unit_size: int = UNIT_SIZE) -> List[Event]:
+    """ Return the events of the JSON `config_file`, relative to its folder. """
+    with open(config_file, encoding='utf-8') as config:
+        specs = json.load(config)['events']
+
+    base_dir = os.path.dirname(os.path.abspath(config_file))
+    events = []
+    for spec in specs:
+        settings = dict(EVENT_DEFAULTS, unit_size=unit_size)
+        settings.update(spec)
+        settings.setdefault('name', settings['conference'])
+        settings['directory'] = os.path.join(base_dir, settings.get('directory', settings['name']))
+        events.append(Event(**settings))
+
+    for key in ('name', 'directory'):
+        values = [getattr(event, key) for event in events]
+        duplicated = sorted({value for value in values if values.count(value) > 1})
+        if duplicated:
+            raise ValueError(f'Each event needs its own {key}, {duplicated} are used by several events.')
+    return events
+
+
+def run_job(directory: str, conference: str, kind: str, params: dict):
+    """ Run the `kind` job of the `conference` event in `directory`, in a
+    worker process, and return its result and duration.
+    """
+    from invoke import Context
+
+    start = time.perf_counter()
+    os.chdir(directory)
+    module = importlib.import_module(conference)
+    ctx = Context()
+    result = None
+    if kind == 'prepare':
+        tickets_file = module.prepare(ctx, params['input_file'])
+        role_files = {role: (os.path.abspath(input_file), os.path.abspath(template_file))
+                      for role, (input_file, template_file) in module.role_files(tickets_file).items()}
+        result = os.path.abspath(tickets_file), role_files
+    elif kind == 'render':
+        result = work_queue.render(ctx, params['unit'])
+    elif kind == 'finish':
+        finish = getattr(module, 'finish', None)
+        if finish is not None:
+            finish(ctx, params['tickets_file'], params['outdir'])
+    elif kind == 'package':
+        packager = packaging.Packager(params['package'], part_size=int(params['part_mb']) * 1024 ** 2,
+                                      names=packaging.template_names(module))
+        for output_dir in module.OUTPUT_DIRS:
+            packager.add_files(output_dir, packaging.STAGE_PATTERNS[module.OUTPUT_STAGE])
+        packager.close()
+    else:
+        raise ValueError(f'Unknown job {kind}.')
+    return result, time.perf_counter() - start
+
+
+def _unit_jobs(event: Event, role_files: Dict) -> List[tuple]:
+    units_dir = os.path.join(event.directory, UNITS_DIR)
+    shutil.rmtree(units_dir, ignore_errors=True)
+    os.makedirs(units_dir)
+    os.makedirs(event.outdir, exist_ok=True)
+
+    jobs = []
+    for role, (input_file, template_file) in role_files.items():
+        for unit_file in work_queue.split_csv(input_file, event.unit_size, units_dir, role):
+            jobs.append(('render', {'unit': {
+                'id': os.path.splitext(os.path.basename(unit_file))[0],
+                'conference': event.conference,
+                'role': role,
+                'input_file': unit_file,
+                'template_file': template_file,
+                'outdir': event.outdir,
+            }}))
+    return jobs
+
+
+def _next_jobs(event: Event, kind: str, result) -> List[tuple]:
+    """ Return the jobs that follow the `kind` job of `event`, once all the
+    jobs of that kind are done.
+    """
+    if kind == 'prepare':
+        event.tickets_file, role_files = result
+        jobs = _unit_jobs(event, role_files)
+        if jobs:
+            return jobs
+    if kind in ('prepare', 'render'):
+        return [('finish', {'tickets_file': event.tickets_file, 'outdir': event.outdir})]
+    if kind == 'finish' and event.package:
+        return [('package', {'package': event.package, 'part_mb': event.part_mb})]
+    return []
+
+
+def run_batch(events: List[Event], workers: int = None) -> Dict[str, dict]:
+    """ Render `events` on a pool of `workers` processes, fairly shared, and
+    return the jobs, seconds and worker seconds of each event.
+    """
+    workers = workers or os.cpu_count()
+    start = time.perf_counter()
+    for event in events:
+        event.jobs.append(('prepare', {'input_file': event.input_file}))
+
+    running = {}
+    pool = ProcessPoolExecutor(max_workers=workers)
+    try:
+        while True:
+            while len(running) < workers:
+                ready = [event for event in events if event.jobs and event.error is None]
+                if not ready:
+                    break
+                event = min(ready, key=Event.share)
+                kind, params = event.jobs.popleft()
+                try:
+                    future = pool.submit(run_job, event.directory, event.conference, kind, params)
+                except BrokenProcessPool:
+                    # a worker died, the jobs running on the pool fail, the next ones go to a new pool
+                    event.jobs.appendleft((kind, params))
+                    pool.shutdown(wait=False)
+                    pool = ProcessPoolExecutor(max_workers=workers)
+                    continue
+                running[future] = (event, kind)
+                event.running += 1
+
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                event, kind = running.pop(future)
+                event.running -= 1
+                if event.error is not None:
+                    continue
+                try:
+                    result, seconds = future.result()
+                except BrokenProcessPool as exc:
+                    event.error = exc
+                    event.jobs.clear()
+                    logger.error(f'A worker process died while the {kind} job of {event.name} was running, '
+                                 f'its other jobs are cancelled: {exc!r}')
+                    continue
+                except Exception as exc:
+                    event.error = exc
+                    event.jobs.clear()
+                    logger.error(f'The {kind} job of {event.name} failed, its other jobs are cancelled: {exc!r}')
+                    continue
+
+                event.busy_seconds += seconds
+                # the units of an event run together, the next stage waits for all of them
+                if not any(other_event is event and other_kind == kind
+                           for other_event, other_kind in running.values()) \
+                        and not any(job_kind == kind for job_kind, _ in event.jobs):
+                    event.jobs.extend(_next_jobs(event, kind, result))
+                if not event.jobs and not event.running:
+                    event.done_seconds = time.perf_counter() - start
+                    shutil.rmtree(os.path.join(event.directory, UNITS_DIR), ignore_errors=True)
+                    logger.info(f'{event.name} is done in {event.done_seconds:.1f} s, '
+                                f'{event.busy_seconds:.1f} s of work.')
+    finally:
+        pool.shutdown()
+
+    report = {event.name: {'conference': event.conference, 'seconds': event.done_seconds,
+                           'busy_seconds': round(event.busy_seconds, 3),
+                           'error': repr(event.error) if event.error is not None else None}
+              for event in events}
+    failed = [f'{name}: {result["error"]}' for name, result in report.items() if result['error'] is not None]
+    if failed:
+        raise RuntimeError(f'{len(failed)} of {len(events)} events failed, the others are done:\n' + '\n'.join(failed))
+    return report
+
+
+@task
+def batch(ctx, config='batch.json', workers=0, unit_size=UNIT_SIZE):
+    """ Render the events listed in the JSON `config` file on one pool of `workers` processes. """
+    events = read_events(config, unit_size=int(unit_size))
+    logger.info(f'Rendering {len(events)} events: {", ".join(event.name for event in events)}.')
+    report = run_batch(events, workers=int(workers) or None)
+    for name, result in report.items():
+        logger.info(f'{name}: {result["seconds"]:.1f} s, {result["busy_seconds"]:.1f} s of work.')
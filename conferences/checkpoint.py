@@ -0,0 +1,191 @@
+"""
+Journal of the completed render units, to resume an interrupted run.
+
+Every badge goes through three units of work: `rendered` (docstamp),
+`cmyk` (Ghostscript) and `joined` (the two faces). Each unit writes its
+output to a hidden partial file, renames it over the final name when it is
+complete and appends a line to the journal. A run with `--resume` skips the
+units in the journal, even if their inputs were already cleaned up, and the
+partial files of the interrupted run are never picked up by the next stage:
+
+    checkpoint.enable(resume=True)
+
+    with checkpoint.atomic_output(cmyk_file) as partial_file:
+        pdf_to_cmyk(pdf_file, partial_file)
+    checkpoint.record('cmyk', cmyk_file)
+
+The journal is only kept when it is enabled, the tasks called on their own
+work as before. The functions given to `subscribe` are called with every
+unit recorded, journal or not.
+"""
+import json
+import logging
+import os
+import shutil
+import socket
+import threading
+from contextlib import contextmanager
+from glob import glob
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_FILE = 'render_journal.jsonl'
+
+PARTIAL_PREFIX = '.partial-'
+
+
+class IncompleteOutputError(RuntimeError):
+    """ A unit of work ended without writing its complete output file. """
+
+
+class Journal:
+    """ Append-only file of the (stage, output file) units done. """
+    def __init__(self, journal_file: str, resume: bool = False):
+        self.journal_file = journal_file
+        self.units = set()
+        if resume and os.path.exists(journal_file):
+            self.units = self._load(journal_file)
+
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND | (0 if resume else os.O_TRUNC)
+        self._fd = os.open(journal_file, flags, 0o644)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _load(journal_file: str) -> set:
+        units = set()
+        with open(journal_file, encoding='utf-8') as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line of a run killed while writing it
+                    continue
+                units.add((entry['stage'], entry['unit']))
+        return units
+
+    def done(self, stage: str, unit: str) -> bool:
+        return (stage, os.path.normpath(unit)) in self.units
+
+    def record(self, stage: str, unit: str):
+        """ Mark `unit` done. Each entry is one `write` on a file opened for
+        appending, so a killed run leaves at most a torn last line.
+        """
+        unit = os.path.normpath(unit)
+        line = json.dumps({'stage': stage, 'unit': unit}) + '\n'
+        with self._lock:
+            os.write(self._fd, line.encode('utf-8'))
+            self.units.add((stage, unit))
+
+    def close(self):
+        os.close(self._fd)
+
+
+_journal = None
+
+
+def enable(journal_file: str = JOURNAL_FILE, resume: bool = False) -> Journal:
+    """ Start journaling the render units to `journal_file`, after the units
+    of the previous run if `resume`.
+    """
+    global _journal
+
+    if _journal is not None:
+        _journal.close()
+    _journal = Journal(journal_file, resume=resume)
+    if resume:
+        logger.info(f'Resuming after {len(_journal.units)} units done in {journal_file}.')
+    return _journal
+
+
+def current() -> Optional[Journal]:
+    return _journal
+
+
+def done(stage: str, unit: str) -> bool:
+    """ Return True if the journal has `unit` done for `stage`. """
+    return _journal is not None and _journal.done(stage, unit)
+
+
+_listeners = []
+
+
+def subscribe(listener):
+    """ Call `listener(stage, unit)` for every unit recorded. """
+    _listeners.append(listener)
+
+
+def unsubscribe(listener):
+    if listener in _listeners:
+        _listeners.remove(listener)
+
+
+def record(stage: str, unit: str):
+    if _journal is not None:
+        _journal.record(stage, unit)
+    for listener in _listeners:
+        listener(stage, unit)
+
+
+# the bytes a complete file ends with, docstamp leaves a truncated file when it is killed
+TRAILERS = {
+    '.pdf': b'%%EOF',
+    '.svg': b'</svg>',
+    '.png': b'IEND',
+}
+
+
+def is_complete(path: str) -> bool:
+    """ Return True if `path` is not empty and ends the way its file type ends. """
+    size = os.path.getsize(path)
+    trailer = TRAILERS.get(os.path.splitext(path)[1].lower())
+    if trailer is None or size == 0:
+        return size > 0
+
+    with open(path, 'rb') as content:
+        content.seek(max(0, size - 1024))
+        return trailer in content.read()
+
+
+def partial_file(output_file: str, unique: bool = False) -> str:
+    """ Return the hidden file the output is written to until it is complete.
+    It keeps the extension, and the `*.pdf` globs of the stages skip it.
+    With `unique`, the name is also unique to the host, process and thread.
+    """
+    directory, name = os.path.split(output_file)
+    if unique:
+        name = f'{socket.gethostname()}-{os.getpid()}-{threading.get_ident()}-{name}'
+    return os.path.join(directory, PARTIAL_PREFIX + name)
+
+
+@contextmanager
+def atomic_output(output_file: str, unique: bool = False):
+    """ Give a partial file name to write `output_file` to, and rename it to
+    `output_file` if the block ends without errors, or raise
+    `IncompleteOutputError` if the block did not write a complete file.
+    Use `unique` for the files several workers can write at the same time,
+    each one writes its own partial file and the last rename wins.
+    """
+    partial = partial_file(output_file, unique=unique)
+    if os.path.lexists(partial):
+        os.remove(partial)
+    try:
+        yield partial
+    except BaseException:
+        if os.path.lexists(partial):
+            os.remove(partial)
+        raise
+    if not os.path.exists(partial) or not is_complete(partial):
+        if os.path.lexists(partial):
+            os.remove(partial)
+        raise IncompleteOutputError(f'{output_file} was not written, or not completely.')
+    os.replace(partial, output_file)
+
+
+def remove_partial_files(directory: str):
+    """ Remove the partial files and folders left in `directory` by an interrupted run. """
+    for path in glob(os.path.join(directory, PARTIAL_PREFIX + '*')):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
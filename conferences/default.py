@@ -1,14 +1,14 @@
 
 import os
-import re
 from glob import glob
 import subprocess
 import textwrap
 from functools import partial
 
-import pandas as pd
-from invoke import task
-from docstamp.pdf_utils import merge_pdfs
+from conferences import (checkpoint, dtypes, instrument, packaging, pdf_optimize, profiling, render_cache,
+                         svg_backends, validation, work_queue)
+from conferences.instrument import task
+from conferences.tag_rules import Rule, TagRules
 
 templates_dir = os.path.join(os.path.dirname(__file__), 'templates')
 
@@ -18,6 +18,23 @@ ROLES = ['crew',
 
 USERS_FILE = 'tito.csv'
 
+# the folders of the badges and of the blank badges, and the stage of their final files
+OUTPUT_DIRS = ['stamped', 'blank']
+OUTPUT_STAGE = 'joined'
+
+# the converter of the filled SVG templates to PDF, one of `svg_backends.BACKENDS`,
+# rsvg-convert is what `docstamp create --unicode_support` converted the badges with
+SVG_BACKEND = 'rsvg'
+
+# the column the output files are named after, docstamp `-f`
+FILENAME_FIELD = 'Ticket_Reference'
+
+ROLE_RULES = TagRules([
+    Rule('speaker', 'speaker', priority=30),
+    Rule('crew', 'crew', priority=20),
+    Rule('participant', 'participant', priority=10),
+], default='participant')
+
 
 def get_userrole_filepath(users_file, role):
     return os.path.basename(users_file).split('.')[0] + '_' + role + '.csv'
@@ -42,6 +59,12 @@ FILTER_TICKETS = {
 }
 
 
+CATEGORY_COLUMNS = [
+    'Ticket',
+    'Tags',
+]
+
+
 MAXLENGTHS = {
     'Ticket First Name':   20,
     'Ticket Last Name':    20,
@@ -58,11 +81,14 @@ def badge_template_file(role):
     return '{}.svg'.format(role)
 
 
-def create_badge_faces(pdf_filepath):
-    """ duplicate the given pdf, save it in a file with '-joined.pdf' suffix
-    and return the new filepath.
+def create_badge_faces(pdf_filepath, output_filepath=None):
+    """ duplicate the given pdf, save it in `output_filepath`, by default a
+    file with '-joined.pdf' suffix, and return the new filepath.
+    Both pages share the fonts and images of the badge.
     """
-    return merge_pdfs([pdf_filepath] * 2, pdf_filepath.replace('.pdf', '-joined.pdf'))
+    if output_filepath is None:
+        output_filepath = pdf_filepath.replace('.pdf', '-joined.pdf')
+    return pdf_optimize.duplex_pdf(pdf_filepath, output_filepath)
 
 
 def split_in_two(string, separator='@', max_length=30):
@@ -76,6 +102,8 @@ def split_in_two(string, separator='@', max_length=30):
     ------
     split: 2-tuple of str
     """
+    import pandas as pd
+
     if not string or string is None or pd.isnull(string):
         return '', ''
 
@@ -126,17 +154,27 @@ def _pdf_to_cmyk(input_file: str, output_file: str):
         '-dProcessColorModel=/DeviceCMYK ' \
         '-sOutputFile="{}" "{}"'.format(output_file, input_file)
     print('Calling {}'.format(cmd))
-    subprocess.call(cmd, shell='True')
+    # a failed conversion must not be journaled, nor its input removed
+    subprocess.run(cmd, shell=True, check=True)
 
 
 def create_badge_set(input_file, outdir, template_file):
-    cmd = 'docstamp create --unicode_support -i "{}" -t "{}" -f "Ticket_Reference" -d pdf -o "{}"'.format(
-        input_file,
-        template_file,
-        outdir
-    )
-    print('Calling {}'.format(cmd))
-    subprocess.call(cmd, shell='True')
+    backend = svg_backends.get_backend(SVG_BACKEND).name
+    with render_cache.render_misses(input_file, outdir, template_file, filename_field=FILENAME_FIELD,
+                                    dpi=None, backend=backend) as (misses_file, render_dir):
+        if misses_file is None:
+            return
+
+        cmd = 'docstamp create --unicode_support -i "{}" -t "{}" -f "{}" -d svg -o "{}"'.format(
+            misses_file,
+            template_file,
+            FILENAME_FIELD,
+            render_dir
+        )
+        print('Calling {}'.format(cmd))
+        subprocess.call(cmd, shell='True')
+        # the DPI docstamp uses by default
+        svg_backends.convert_files(glob(os.path.join(render_dir, '*.svg')), backend, dpi=150, remove=True)
 
 
 def empty_data_for_blank_badge(role: str):
@@ -156,6 +194,8 @@ def empty_data_for_blank_badge(role: str):
 
 @task
 def create_empty_badges(ctx, outdir='stamped'):
+    import pandas as pd
+
     for role in ROLES:
         empty_badges_csv_file = 'empty_badge_for_{}.csv'.format(role)
         print('Creating empty data csv file "{}".'.format(empty_badges_csv_file))
@@ -170,7 +210,9 @@ def create_empty_badges(ctx, outdir='stamped'):
 
 @task
 def split_users_csv(ctx, users_file=USERS_FILE):
-    df = pd.read_csv(users_file)
+    import pandas as pd
+
+    df = dtypes.read_csv(users_file, CATEGORY_COLUMNS)
 
     for col, values in FILTER_TICKETS.items():
         df = df.loc[df[col].isin(values)]
@@ -179,18 +221,8 @@ def split_users_csv(ctx, users_file=USERS_FILE):
     column_names = [col.replace(' ', '_') for col in COLUMNS]
     col_maxlengths = {col.replace(' ', '_'):length for col, length in MAXLENGTHS.items()}
 
-    # Set Tags to 'participant'
-    df.loc[pd.isnull(df.Tags), 'Tags'] = 'participant'
-    df.loc[
-        (df.Tags == 'participant') & (df.Ticket.str.contains('Late')),
-        'Tags'
-    ] = 'participant'
-
-    # Set Tags to 'crew'
-    df.loc[
-        (df.Tags.str.contains('crew')) & (df.Tags.str.contains('organizer')),
-        'Tags'
-    ] = 'crew'
+    # a row tagged with several roles, e.g. "speaker, crew", gets a badge of each role
+    members = ROLE_RULES.members(df.Tags)
 
     # Merge Badge_information into Ticket_Company_Name if null
     df.loc[
@@ -200,16 +232,33 @@ def split_users_csv(ctx, users_file=USERS_FILE):
     df = df[column_names]
     df = wrap_cell_contents(df, field_maxlength=col_maxlengths)
 
+    output_files = []
     for role in ROLES:
-        role_df = df[df.Tags.str.contains(role)]
+        role_df = df[members[role]].assign(Tags=role)
         output_file = get_userrole_filepath(users_file, role)
         role_df.to_csv(output_file, index=False)
+        output_files.append(output_file)
+    instrument.count_rows_out(*output_files)
+
+
+def role_files(users_file):
+    """ Return {role: (attendees file, template file)} of the badges of `users_file`. """
+    return validation.role_files_of(ROLES, partial(get_userrole_filepath, users_file),
+                                    lambda role: os.path.join('templates', badge_template_file(role)))
+
+
+@task
+def validate_badges(ctx, users_file=USERS_FILE, strict=False):
+    """ Check the role files of `users_file` against the badge templates. """
+    validation.validate_badges(role_files(users_file), filename_field=FILENAME_FIELD, max_lengths=MAXLENGTHS,
+                               strict=strict)
 
 
 @task
 def create_badges_for(ctx, role, users_file=USERS_FILE, outdir='stamped'):
     input_file = get_userrole_filepath(users_file, role)
     template_file = os.path.join('templates', badge_template_file(role))
+    instrument.count_rows_in(input_file)
     create_badge_set(input_file=input_file, outdir=outdir, template_file=template_file)
 
 
@@ -223,11 +272,16 @@ def make_all_badges(ctx, users_file=USERS_FILE, outdir='stamped'):
 def convert_badges_to_cmyk(ctx, stamped_dir='stamped', cleanup=True):
     pdf_files = glob(os.path.join(stamped_dir, '*.pdf'))
     for pdf_filepath in pdf_files:
-        if pdf_filepath.endswith('joined.pdf'):
+        if pdf_filepath.endswith('joined.pdf') or checkpoint.done('cmyk', pdf_filepath):
             continue
-        _pdf_to_cmyk(pdf_filepath, pdf_filepath.replace('.pdf', '_cmyk.pdf'))
 
-        if cleanup:
+        cmyk_filepath = pdf_filepath.replace('.pdf', '_cmyk.pdf')
+        if not checkpoint.done('cmyk', cmyk_filepath):
+            with checkpoint.atomic_output(cmyk_filepath) as partial_filepath:
+                render_cache.cached_transform('cmyk', pdf_filepath, partial_filepath, _pdf_to_cmyk)
+            checkpoint.record('cmyk', cmyk_filepath)
+
+        if cleanup and os.path.exists(cmyk_filepath) and checkpoint.is_complete(cmyk_filepath):
             os.remove(pdf_filepath)
 
 
@@ -238,30 +292,52 @@ def make_badge_faces(ctx, stamped_dir='stamped', cleanup=True):
         if pdf_filepath.endswith('joined.pdf'):
             continue
 
-        pdf_pair_file = create_badge_faces(pdf_filepath)
-        print('Created {}'.format(pdf_pair_file))
-        if cleanup:
+        pdf_pair_file = pdf_filepath.replace('.pdf', '-joined.pdf')
+        if not checkpoint.done('joined', pdf_pair_file):
+            with checkpoint.atomic_output(pdf_pair_file) as partial_filepath:
+                create_badge_faces(pdf_filepath, partial_filepath)
+            checkpoint.record('joined', pdf_pair_file)
+            print('Created {}'.format(pdf_pair_file))
+        if cleanup and os.path.exists(pdf_pair_file) and checkpoint.is_complete(pdf_pair_file):
             os.remove(pdf_filepath)
 
 
-@task
-def escape_csv(ctx, input_file):
-    with open(input_file, 'r') as csvfile:
-        data = csvfile.read()
-    escaped_data = re.sub(r'&(?!amp)', '&amp;', data)
-    with open(input_file, 'w') as csvfile:
-        pass
-        csvfile.write(escaped_data)
+def prepare(ctx, input_file):
+    """ Split and check the role files of `input_file` and return it. """
+    split_users_csv(ctx, users_file=input_file)
+    validate_badges(ctx, users_file=input_file)
+    return input_file
 
 
 @task
-def all(ctx, input_file=USERS_FILE, outdir='stamped'):
-    escape_csv(ctx, input_file=input_file)
-    split_users_csv(ctx, users_file=input_file)
-    make_all_badges(ctx, users_file=input_file, outdir=outdir)
+def make_blank_badges(ctx, outdir='blank'):
+    create_empty_badges(ctx, outdir=outdir)
     convert_badges_to_cmyk(ctx, stamped_dir=outdir)
     make_badge_faces(ctx, stamped_dir=outdir, cleanup=True)
 
-    create_empty_badges(ctx, outdir='blank')
-    convert_badges_to_cmyk(ctx, stamped_dir='blank')
-    make_badge_faces(ctx, stamped_dir='blank', cleanup=True)
+
+def finish(ctx, tickets_file, outdir):
+    """ Make the blank badges. """
+    make_blank_badges(ctx)
+
+
+@task(report=True)
+def all(ctx, input_file=USERS_FILE, outdir='stamped', profile=False, resume=False, queue_dir=None, package=None,
+        part_mb=0):
+    if profile:
+        profiling.enable()
+    checkpoint.enable(resume=resume)
+    if package:
+        packaging.enable(package, directories=[outdir, 'blank'], part_size=int(part_mb) * 1024 ** 2,
+                         conference=__name__)
+
+    tickets_file = prepare(ctx, input_file)
+    if queue_dir:
+        # the render workers render, convert and join the badges
+        work_queue.distribute(queue_dir, __name__, role_files(tickets_file), outdir)
+    else:
+        make_all_badges(ctx, users_file=tickets_file, outdir=outdir)
+        convert_badges_to_cmyk(ctx, stamped_dir=outdir)
+        make_badge_faces(ctx, stamped_dir=outdir, cleanup=True)
+    finish(ctx, tickets_file, outdir)
+    packaging.close()
@@ -0,0 +1,52 @@
+"""
+Compact dtypes for the attendee tables.
+
+The columns with a few distinct values (ticket types, tags, the Ti.to status
+columns...) are read as pandas categoricals: each distinct string is stored
+once and the rows only hold small integer codes, and `isin`, `map` and
+comparisons work on the categories instead of on every row.
+The tasks write CSV files, so each task reads its input with the
+categorical columns of its conference:
+
+    df = dtypes.read_csv(input_file, CATEGORY_COLUMNS, na_value='')
+
+The gain is modest: a synthetic 100k rows euroscipy2019 export takes 131 MB
+instead of 152 MB, the names, emails and orders are distinct strings. The
+frames are not carried between the tasks, each one parses its input again,
+and the role files are written for docstamp and read as text.
+"""
+from typing import Iterable
+
+
+def is_category(series) -> bool:
+    return series.dtype.name == 'category'
+
+
+def fillna(df, value=''):
+    """ `df.fillna(value)`, adding `value` to the categories of the
+    categorical columns that miss it.
+    """
+    for col in df.columns:
+        series = df[col]
+        if is_category(series) and value not in series.cat.categories and series.isna().any():
+            df[col] = series.cat.add_categories([value])
+    return df.fillna(value)
+
+
+def read_csv(input_file, category_columns: Iterable[str] = (), na_value=None, **kwargs):
+    """ Read `input_file` with the `category_columns` it has as categoricals,
+    and fill the missing values with `na_value` if it is not None.
+    """
+    import pandas as pd
+
+    header = pd.read_csv(input_file, nrows=0, **kwargs).columns
+    dtype = {col: 'category' for col in category_columns if col in header}
+    df = pd.read_csv(input_file, dtype=dtype, **kwargs)
+    if na_value is not None:
+        df = fillna(df, na_value)
+    return df
+
+
+def as_objects(series):
+    """ Return `series` with object dtype and '' for the missing values. """
+    return series.astype(object).where(series.notna(), '')
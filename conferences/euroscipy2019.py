@@ -1,7 +1,5 @@
 
 import os
-import re
-import sys
 import logging
 import subprocess
 import textwrap
@@ -9,16 +7,14 @@ from glob import glob
 from typing import Tuple, List, Any
 from functools import partial
 
-import pandas as pd
-from invoke import task
-from docstamp.pdf_utils import merge_pdfs, pdf_to_cmyk
+from conferences import (checkpoint, dtypes, instrument, packaging, pdf_optimize, profiling, render_cache, svg_backends,
+                         text_layout, validation, work_queue)
+from conferences.attendee_index import index_attendees
+from conferences.instrument import task
+from conferences.tag_rules import Rule, TagRules
+from conferences.text_layout import TextBox
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-handler = logging.StreamHandler(sys.stdout)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
 
 
 def first_true(iterable, default='', pred=None):
@@ -29,6 +25,8 @@ def first_true(iterable, default='', pred=None):
     If *pred* is not None, returns the first item
     for which pred(item) is true.
     """
+    import pandas as pd
+
     # first_true([a,b,c], x) --> a or b or c or x
     # first_true([a,b], x, f) --> a if f(a) else b if f(b) else x
     return next(filter(pd.notna, iterable), default)
@@ -53,8 +51,30 @@ ROLETAG_TEMPLATES = {
     'tutorials': 'tutorials_participant',
 }
 
+ROLE_RULES = TagRules([
+    Rule('organizer', 'organizer', priority=80),
+    Rule('keynote', 'keynote', priority=70),
+    Rule('speaker+trainer', 'speaker+trainer', priority=60),
+    Rule('conference+tutorials', 'conference+tutorials', priority=50),
+    Rule('speaker', 'speaker', priority=40),
+    Rule('trainer', 'trainer', priority=30),
+    Rule('conference', 'conference', priority=20),
+    Rule('tutorials', 'tutorials', priority=10),
+])
+
 USERS_FILE = 'tito.csv'
 
+# the folders of the badges and of the blank badges, and the stage of their final files
+OUTPUT_DIRS = ['stamped', 'blank']
+OUTPUT_STAGE = 'joined'
+
+# the converter of the filled SVG templates to PDF, one of `svg_backends.BACKENDS`,
+# rsvg-convert is what `docstamp create --unicode_support` converted the badges with
+SVG_BACKEND = 'rsvg'
+
+# the column the output files are named after, docstamp `-f`
+FILENAME_FIELD = 'email'
+
 COLUMNS_RENAME = {
     'Number': 'number',
     'Ticket': 'ticket_type',
@@ -68,6 +88,19 @@ COLUMNS_RENAME = {
     'Order Reference': 'order',
 }
 
+# the columns with a few distinct values, before and after `rename_columns`
+CATEGORY_COLUMNS = [
+    'Ticket',
+    'ticket_type',
+    'Tags',
+    'tags',
+    'Event',
+    'Void Status',
+    'Price',
+    'Discount Status',
+    'Order Discount Code',
+]
+
 FILTER_TICKETS = {
     'Ticket': {
         'Financial Aid Ticket',
@@ -143,6 +176,16 @@ COLS_WITH_2_LINES = [
     'tagline'
 ]
 
+# the badge is 482px wide, the texts start 30.5px from its left side
+TEXT_BOXES = {
+    'first_name': TextBox(width=420, max_lines=1, min_font_size=16),
+    'last_name': TextBox(width=420, max_lines=1, min_font_size=14),
+    'company': TextBox(width=420, max_lines=2, min_font_size=10),
+    'tagline': TextBox(width=420, max_lines=2, min_font_size=10),
+}
+
+FITTED_TEMPLATES_DIR = 'fitted_templates'
+
 
 def add_suffix(input_file: str, suffix: str) -> str:
     extension = input_file.split('.')[-1]
@@ -153,11 +196,14 @@ def badge_template_file(role):
     return f'{ROLETAG_TEMPLATES[role]}.svg'
 
 
-def create_badge_faces(pdf_filepath):
-    """ duplicate the given pdf, save it in a file with '-joined.pdf' suffix
-    and return the new filepath.
+def create_badge_faces(pdf_filepath, output_filepath=None):
+    """ duplicate the given pdf, save it in `output_filepath`, by default a
+    file with '-joined.pdf' suffix, and return the new filepath.
+    Both pages share the fonts and images of the badge.
     """
-    return merge_pdfs([pdf_filepath] * 2, pdf_filepath.replace('.pdf', '-joined.pdf'))
+    if output_filepath is None:
+        output_filepath = pdf_filepath.replace('.pdf', '-joined.pdf')
+    return pdf_optimize.duplex_pdf(pdf_filepath, output_filepath)
 
 
 def split_in_two(string: str, max_length: int=30) -> Tuple[str, str]:
@@ -168,6 +214,8 @@ def split_in_two(string: str, max_length: int=30) -> Tuple[str, str]:
     ------
     split: 2-tuple of str
     """
+    import pandas as pd
+
     if not string or pd.isnull(string):
         return '', ''
 
@@ -200,16 +248,41 @@ def wrap_cell_contents(df, field_maxlength):
     return df
 
 
+def fit_text_boxes(df, role):
+    """ Fit the `TEXT_BOXES` fields of `df` in the badge template of `role`,
+    or split them by number of characters if its fonts are not installed.
+    """
+    template_file = os.path.join(TEMPLATES_DIR, badge_template_file(role))
+    try:
+        return text_layout.TextFitter(template_file, TEXT_BOXES).fit_table(df)
+    except FileNotFoundError as exc:
+        logger.warning(f'{exc} Splitting the texts of the {role} badges by number of characters.')
+        col_maxlengths = {col.replace(' ', '_'): length for col, length in MAXLENGTHS.items()}
+        return wrap_cell_contents(df, field_maxlength=col_maxlengths)
+
+
+def fitted_template_file(role):
+    template_file = os.path.join(TEMPLATES_DIR, badge_template_file(role))
+    return text_layout.fit_template(template_file, TEXT_BOXES, FITTED_TEMPLATES_DIR)
+
+
 def create_badge_set(input_file, outdir, template_file):
-    cmd = 'docstamp create --unicode_support '
-    cmd += f'-i "{input_file}" '
-    cmd += f'-t "{template_file}" '
-    cmd += f'-f "email" '
-    cmd += f'--dpi 72 '
-    cmd += f'-o "{outdir}" '
-    cmd += f'-d pdf'
-    logger.info('Calling {}'.format(cmd))
-    subprocess.call(cmd, shell='True')
+    backend = svg_backends.get_backend(SVG_BACKEND).name
+    with render_cache.render_misses(input_file, outdir, template_file, filename_field=FILENAME_FIELD,
+                                    dpi=72, backend=backend) as (misses_file, render_dir):
+        if misses_file is None:
+            return
+
+        cmd = 'docstamp create --unicode_support '
+        cmd += f'-i "{misses_file}" '
+        cmd += f'-t "{template_file}" '
+        cmd += f'-f "{FILENAME_FIELD}" '
+        cmd += f'--dpi 72 '
+        cmd += f'-o "{render_dir}" '
+        cmd += f'-d svg'
+        logger.info('Calling {}'.format(cmd))
+        subprocess.call(cmd, shell='True')
+        svg_backends.convert_files(glob(os.path.join(render_dir, '*.svg')), backend, dpi=72, remove=True)
 
 
 def empty_data_for_blank_badge(role: str):
@@ -220,6 +293,8 @@ def empty_data_for_blank_badge(role: str):
 
 @task
 def create_empty_badges(ctx, outdir='stamped'):
+    import pandas as pd
+
     for role, template in ROLETAG_TEMPLATES.items():
         empty_badges_csv_file = 'empty_badge_for_{}.csv'.format(role)
         logger.info('Creating empty data csv file "{}".'.format(empty_badges_csv_file))
@@ -234,22 +309,35 @@ def create_empty_badges(ctx, outdir='stamped'):
 
 @task
 def split_users_csv(ctx, users_file=USERS_FILE):
-    df = pd.read_csv(users_file)
-
-    col_maxlengths = {col.replace(' ', '_'):length for col, length in MAXLENGTHS.items()}
-    df = wrap_cell_contents(df, field_maxlength=col_maxlengths)
+    df = dtypes.read_csv(users_file, CATEGORY_COLUMNS)
 
+    roles = ROLE_RULES.classify(df.tags).roles
+    output_files = []
     for role, template in ROLETAG_TEMPLATES.items():
-        role_df = df[df.tags.str.contains(role, regex=False)]
-        df = df.drop(role_df.index)
+        role_df = fit_text_boxes(df[roles == role].copy(), role)
         output_file = add_suffix(users_file, role)
         role_df.to_csv(output_file, index=False)
+        output_files.append(output_file)
+    instrument.count_rows_out(*output_files)
+
+
+def role_files(users_file):
+    """ Return {role: (attendees file, template file)} of the badges of `users_file`. """
+    return validation.role_files_of(list(ROLETAG_TEMPLATES), partial(add_suffix, users_file), fitted_template_file)
+
+
+@task
+def validate_badges(ctx, users_file=USERS_FILE, strict=False):
+    """ Check the role files of `users_file` against the badge templates. """
+    validation.validate_badges(role_files(users_file), filename_field=FILENAME_FIELD, max_lengths=MAXLENGTHS,
+                               expected_rows=validation.count_rows(users_file), strict=strict)
 
 
 @task
 def create_badges_for(ctx, role, users_file=USERS_FILE, outdir='stamped'):
     input_file = add_suffix(users_file, role)
-    template_file = os.path.join(TEMPLATES_DIR, badge_template_file(role))
+    template_file = fitted_template_file(role)
+    instrument.count_rows_in(input_file)
     create_badge_set(input_file=input_file, outdir=outdir, template_file=template_file)
 
 
@@ -259,15 +347,31 @@ def make_all_badges(ctx, users_file=USERS_FILE, outdir='stamped'):
         create_badges_for(ctx, role, users_file=users_file, outdir=outdir)
 
 
+def _pdf_to_cmyk(input_file: str, output_file: str):
+    """ Convert `input_file` to CMYK with Ghostscript, as docstamp
+    `pdf_to_cmyk`, but raise CalledProcessError when gs fails.
+    """
+    cmd = ['gs', '-dSAFER', '-dBATCH', '-dNOPAUSE', '-dNOCACHE', '-sDEVICE=pdfwrite',
+           '-sColorConversionStrategy=CMYK', '-dProcessColorModel=/DeviceCMYK',
+           f'-sOutputFile={output_file}', input_file]
+    logger.info('Calling {}'.format(' '.join(cmd)))
+    subprocess.run(cmd, check=True)
+
+
 @task
 def convert_badges_to_cmyk(ctx, stamped_dir='stamped', cleanup=True):
     pdf_files = glob(os.path.join(stamped_dir, '*.pdf'))
     for pdf_filepath in pdf_files:
-        if pdf_filepath.endswith('joined.pdf'):
+        if pdf_filepath.endswith('joined.pdf') or checkpoint.done('cmyk', pdf_filepath):
             continue
-        pdf_to_cmyk(pdf_filepath, add_suffix(pdf_filepath, 'cmyk'))
 
-        if cleanup:
+        cmyk_filepath = add_suffix(pdf_filepath, 'cmyk')
+        if not checkpoint.done('cmyk', cmyk_filepath):
+            with checkpoint.atomic_output(cmyk_filepath) as partial_filepath:
+                render_cache.cached_transform('cmyk', pdf_filepath, partial_filepath, _pdf_to_cmyk)
+            checkpoint.record('cmyk', cmyk_filepath)
+
+        if cleanup and os.path.exists(cmyk_filepath) and checkpoint.is_complete(cmyk_filepath):
             os.remove(pdf_filepath)
 
 
@@ -278,52 +382,50 @@ def make_badge_faces(ctx, stamped_dir='stamped', cleanup=True):
         if pdf_filepath.endswith('joined.pdf'):
             continue
 
-        pdf_pair_file = create_badge_faces(pdf_filepath)
-        logger.info('Created {}'.format(pdf_pair_file))
-        if cleanup:
+        pdf_pair_file = pdf_filepath.replace('.pdf', '-joined.pdf')
+        if not checkpoint.done('joined', pdf_pair_file):
+            with checkpoint.atomic_output(pdf_pair_file) as partial_filepath:
+                create_badge_faces(pdf_filepath, partial_filepath)
+            checkpoint.record('joined', pdf_pair_file)
+            logger.info('Created {}'.format(pdf_pair_file))
+        if cleanup and os.path.exists(pdf_pair_file) and checkpoint.is_complete(pdf_pair_file):
             os.remove(pdf_filepath)
 
 
 @task
 def merge_tickets(ctx, input_file, output_file, on=['email'], column_concat={'order': '+'}):
-    df = pd.read_csv(input_file).fillna('')
+    df = dtypes.read_csv(input_file, CATEGORY_COLUMNS, na_value='')
+    # the string joins are slower on categoricals, and the joined values are mostly distinct
+    for col in column_concat:
+        if dtypes.is_category(df[col]):
+            df[col] = df[col].astype(object)
     df = df.groupby(by=on).agg(column_concat).reset_index()
     df.to_csv(output_file, index=False)
 
 
 @task
 def add_tags(ctx, input_file, output_file):
-    df = pd.read_csv(input_file)
-    for ticket_type, new_tag in TICKET_TYPE_TEMPLATES.items():
-        df.loc[(df.ticket_type == ticket_type) & (df.tags.isna()), 'tags'] = new_tag
+    df = dtypes.read_csv(input_file, CATEGORY_COLUMNS)
+    df['tags'] = df.tags.astype(object).fillna(df.ticket_type.map(TICKET_TYPE_TEMPLATES).astype(object))
     df.to_csv(output_file, index=False)
 
 
 @task
 def rename_columns(ctx, input_file, output_file):
-    df = pd.read_csv(input_file).fillna('')
+    df = dtypes.read_csv(input_file, CATEGORY_COLUMNS, na_value='')
     df.rename(columns=COLUMNS_RENAME, inplace=True)
     df.to_csv(output_file, index=False)
 
 
 @task
 def filter_tickets(ctx, input_file, output_file):
-    df = pd.read_csv(input_file, na_values='-').fillna('')
+    df = dtypes.read_csv(input_file, CATEGORY_COLUMNS, na_value='', na_values='-')
     for col, values in FILTER_TICKETS.items():
         logger.debug(f'Filtering {col} columns that do not contain any of {values}.')
         df = df.loc[df[col].isin(values)]
     df.to_csv(output_file, index=False)
 
 
-@task
-def escape_csv(ctx, input_file):
-    with open(input_file, 'r') as csvfile:
-        data = csvfile.read()
-    escaped_data = re.sub(r'&(?!amp)', '&amp;', data)
-    with open(input_file, 'w') as csvfile:
-        csvfile.write(escaped_data)
-
-
 @task
 def make_blank_badges(ctx, outdir='blank'):
     create_empty_badges(ctx, outdir=outdir)
@@ -331,9 +433,10 @@ def make_blank_badges(ctx, outdir='blank'):
     make_badge_faces(ctx, stamped_dir=outdir, cleanup=True)
 
 
-@task
-def all(ctx, input_file=USERS_FILE, outdir='stamped'):
-    # escape_csv(ctx, input_file=input_file)
+def prepare(ctx, input_file):
+    """ Run the CSV stages on `input_file`, split and check the role files
+    and return the attendee table to render.
+    """
     cleaned_file = add_suffix(input_file, 'cleaned')
     filter_tickets(ctx, input_file=input_file, output_file=cleaned_file)
 
@@ -357,9 +460,33 @@ def all(ctx, input_file=USERS_FILE, outdir='stamped'):
         tickets_file = tagged_file
 
     split_users_csv(ctx, users_file=tickets_file)
-    make_all_badges(ctx, users_file=tickets_file, outdir=outdir)
-    convert_badges_to_cmyk(ctx, stamped_dir=outdir)
-    make_badge_faces(ctx, stamped_dir=outdir, cleanup=True)
+    validate_badges(ctx, users_file=tickets_file)
+    return tickets_file
+
 
+def finish(ctx, tickets_file, outdir):
+    """ Index the attendees of the badges rendered to `outdir` and make the blank badges. """
+    index_attendees(ctx, users_file=tickets_file, stamped_dir=outdir, conference=__name__.rsplit('.', 1)[-1])
     make_blank_badges(ctx)
 
+
+@task(report=True)
+def all(ctx, input_file=USERS_FILE, outdir='stamped', profile=False, resume=False, queue_dir=None, package=None,
+        part_mb=0):
+    if profile:
+        profiling.enable()
+    checkpoint.enable(resume=resume)
+    if package:
+        packaging.enable(package, directories=[outdir, 'blank'], part_size=int(part_mb) * 1024 ** 2,
+                         conference=__name__)
+
+    tickets_file = prepare(ctx, input_file)
+    if queue_dir:
+        # the render workers render, convert and join the badges
+        work_queue.distribute(queue_dir, __name__, role_files(tickets_file), outdir)
+    else:
+        make_all_badges(ctx, users_file=tickets_file, outdir=outdir)
+        convert_badges_to_cmyk(ctx, stamped_dir=outdir)
+        make_badge_faces(ctx, stamped_dir=outdir, cleanup=True)
+    finish(ctx, tickets_file, outdir)
+    packaging.close()
@@ -2,24 +2,18 @@ import logging
 import os
 import shutil
 import subprocess
-import sys
-import urllib
+import tempfile
+import urllib.parse
 from glob import glob
 from typing import Any, List
 from uuid import uuid4
 
-import pandas as pd
-from invoke import task
-
-from docstamp.inkscape import svg2pdf
+from conferences import (checkpoint, dtypes, packaging, profiling, render_cache, svg_assets, svg_backends, text_layout,
+                         validation, work_queue)
+from conferences.instrument import task
+from conferences.text_layout import TextBox
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-handler = logging.StreamHandler(sys.stdout)
-log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-formatter = logging.Formatter(log_format)
-handler.setFormatter(formatter)
-logger.addHandler(handler)
 
 
 def first_true(iterable, default='', pred=None):
@@ -30,6 +24,8 @@ def first_true(iterable, default='', pred=None):
     If *pred* is not None, returns the first item
     for which pred(item) is true.
     """
+    import pandas as pd
+
     # first_true([a,b,c], x) --> a or b or c or x
     # first_true([a,b], x, f) --> a if f(a) else b if f(b) else x
     return next(filter(pd.notna, iterable), default)
@@ -49,6 +45,17 @@ CONFERENCE_NAME = 'euroscipy'
 
 USERS_FILE = 'tito.csv'
 
+# the folder of the certificates and the stage of their final files
+OUTPUT_DIRS = ['certificates']
+OUTPUT_STAGE = 'certificate'
+
+# the converter of the rendered SVG certificates to PDF, one of `svg_backends.BACKENDS`,
+# pinned: `DOCSTAMP_SVG_BACKEND` does not change it
+SVG_BACKEND = 'inkscape'
+
+# the column the output files are named after, docstamp `-f`
+FILENAME_FIELD = 'email'
+
 COLUMNS_RENAME = {
     'Order Reference': 'order',
     'Number': 'number',
@@ -84,8 +91,30 @@ FILTER_TICKETS = {
     },
 }
 
+# the columns with a few distinct values, before and after `rename_columns`
+CATEGORY_COLUMNS = [
+    'Ticket',
+    'ticket',
+    'conference_and_tutorials',
+    'Event',
+    'Void Status',
+    'Price',
+    'Discount Status',
+    'Order Discount Code',
+]
+
 TEMPLATE = 'certificate_of_attendance.svg'
 
+# the full name is centred on the page, 264.4 wide in the units of its group
+TEXT_BOXES = {
+    'full_name': TextBox(width=264.4, align='center', min_font_size=8),
+}
+
+FITTED_TEMPLATES_DIR = 'fitted_templates'
+
+# the template with its images decoded to files, linked from every certificate instead of embedded
+SHARED_TEMPLATES_DIR = os.path.join(FITTED_TEMPLATES_DIR, 'shared')
+
 GROUP_ROWS_BY = ['email']
 
 GROUP_FUNC = {
@@ -110,39 +139,45 @@ def get_file_url(base_url, file_path) -> str:
 
 
 def render_files(input_file, output_dir, template_file, output_type='svg'):
-    cmd = 'docstamp create --unicode_support '
-    cmd += f'-i "{input_file}" '
-    cmd += f'-t "{template_file}" '
-    cmd += f'-f "email" '
-    cmd += f'--dpi 150 '
-    cmd += f'-o "{output_dir}" '
-    cmd += f'-d {output_type}'
-    logger.info('Calling {}'.format(cmd))
-    subprocess.call(cmd, shell='True')
-
-
-# def _center_object(object_id, filepath):
-#     cmd = 'inkscape '
-#     cmd += f'--verb=EditSelect '
-#     cmd += f'--select={object_id} '
-#     cmd += f'--verb=AlignHorizontalCenter '
-#     cmd += f'--verb=FileSave '
-#     cmd += f'--verb=FileQuit '
-#     cmd += filepath
-#     logger.info('Calling {}'.format(cmd))
-#     subprocess.call(cmd, shell='True')
-
-
-# @task
-# def center_names(ctx, output_dir):
-#     for filepath in glob(os.path.join(output_dir, '*.svg')):
-#         _center_object('full_name', filepath)
+    # each certificate prints its own random uuid, caching them would only fill the cache
+    with render_cache.render_misses(input_file, output_dir, template_file, filename_field=FILENAME_FIELD, dpi=150,
+                                    output_type=output_type, use_cache=False) as (misses_file, render_dir):
+        if misses_file is None:
+            return
+
+        cmd = 'docstamp create --unicode_support '
+        cmd += f'-i "{misses_file}" '
+        cmd += f'-t "{template_file}" '
+        cmd += f'-f "{FILENAME_FIELD}" '
+        cmd += f'--dpi 150 '
+        cmd += f'-o "{render_dir}" '
+        cmd += f'-d {output_type}'
+        logger.info('Calling {}'.format(cmd))
+        subprocess.call(cmd, shell='True')
+
+
+@task
+def center_names(ctx, input_file, output_file):
+    """ Add the font size and the x offset that fit and centre the full
+    names in the certificate template.
+    """
+    df = dtypes.read_csv(input_file, CATEGORY_COLUMNS, na_value='')
+    template_file = os.path.join(TEMPLATES_DIR, badge_template_file())
+    try:
+        df = text_layout.TextFitter(template_file, TEXT_BOXES).fit_table(df)
+    except FileNotFoundError as exc:
+        logger.warning(f'{exc} The names will not be centred.')
+    df.to_csv(output_file, index=False)
 
 
 @task
 def svg_to_pdf(ctx, output_dir):
+    backend = svg_backends.get_backend(SVG_BACKEND, pinned=True).name
     for filepath in glob(os.path.join(output_dir, '**', '*.svg')):
-        svg2pdf(filepath, filepath.replace('.svg', '.pdf'))
+        pdf_file = filepath.replace('.svg', '.pdf')
+        # the DPI of docstamp `svg2pdf`, not cached, the SVG has the uuid of the certificate
+        svg_backends.convert(filepath, pdf_file, backend, 150)
+        checkpoint.record('certificate', pdf_file)
 
 
 @task
@@ -153,21 +188,25 @@ def delete_svg_files(ctx, input_dir):
 
 @task
 def merge_tickets(ctx, input_file, output_file, on=['email'], column_concat={'order': '+'}):
-    df = pd.read_csv(input_file).fillna('')
+    df = dtypes.read_csv(input_file, CATEGORY_COLUMNS, na_value='')
+    # the string joins are slower on categoricals, and the joined values are mostly distinct
+    for col in column_concat:
+        if dtypes.is_category(df[col]):
+            df[col] = df[col].astype(object)
     df = df.groupby(by=on).agg(column_concat).reset_index()
     df.to_csv(output_file, index=False)
 
 
 @task
 def rename_columns(ctx, input_file, output_file):
-    df = pd.read_csv(input_file).fillna('')
+    df = dtypes.read_csv(input_file, CATEGORY_COLUMNS, na_value='')
     df.rename(columns=COLUMNS_RENAME, inplace=True)
     df.to_csv(output_file, index=False)
 
 
 @task
 def filter_tickets(ctx, input_file, output_file):
-    df = pd.read_csv(input_file, na_values='-').fillna('')
+    df = dtypes.read_csv(input_file, CATEGORY_COLUMNS, na_value='', na_values='-')
     for col, values in FILTER_TICKETS.items():
         logger.debug(f'Filtering {col} columns that do not contain any of {values}.')
         df = df.loc[df[col].isin(values)]
@@ -176,8 +215,7 @@ def filter_tickets(ctx, input_file, output_file):
 
 @task
 def add_conference_and_tutorials_column(ctx, input_file, output_file):
-    def column_value(entry):
-        tickets = entry.ticket
+    def column_value(tickets):
         if 'Conference' in tickets and 'Tutorials' in tickets:
             return 'conference and tutorials'
         if 'Conference' in tickets:
@@ -191,46 +229,85 @@ def add_conference_and_tutorials_column(ctx, input_file, output_file):
         if 'Bronze sponsorship' in tickets:
             return 'conference and tutorials'
 
-    df = pd.read_csv(input_file).fillna('')
-    df['conference_and_tutorials'] = df.apply(column_value, axis=1)
+    df = dtypes.read_csv(input_file, CATEGORY_COLUMNS, na_value='')
+    # the merged ticket lists repeat a lot, compute the value once per distinct list
+    tickets = df.ticket.astype('category')
+    values = {ticket: column_value(ticket) for ticket in tickets.cat.categories}
+    df['conference_and_tutorials'] = tickets.map(values)
     df.to_csv(output_file, index=False)
 
 
 @task
 def add_uuid(ctx, input_file, output_file):
-    df = pd.read_csv(input_file).fillna('')
+    df = dtypes.read_csv(input_file, CATEGORY_COLUMNS, na_value='')
     df['uuid'] = [uuid4() for i in range(len(df))]
     df.to_csv(output_file, index=False)
 
 
 @task
 def add_url(ctx, input_file, output_file):
-    def get_certificate_url(entry):
-        file_path = urllib.parse.quote(f'{entry.uuid}/certificate_of_attendance_{entry.email}.pdf')
+    def get_certificate_url(uuid, email):
+        file_path = urllib.parse.quote(f'{uuid}/certificate_of_attendance_{email}.pdf')
         return f'{STORAGE_URL}/{file_path}'
 
-    df = pd.read_csv(input_file).fillna('')
-    df['url'] = df.apply(get_certificate_url, axis=1)
+    df = dtypes.read_csv(input_file, CATEGORY_COLUMNS, na_value='')
+    df['url'] = [get_certificate_url(uuid, email) for uuid, email in zip(df.uuid, df.email)]
     df.to_csv(output_file, index=False)
 
 
 @task
 def move_to_uuid_folders(ctx, input_file, input_dir, output_dir):
-    def move_to_uuid_folder(entry):
-        file = list(glob(os.path.join(input_dir, f'*{entry.email}.svg')))[0]
-        uuid = entry.uuid
+    # the name docstamp gives to the certificate of each email, instead of a glob per row
+    basename = os.path.splitext(badge_template_file())[0]
+
+    def move_to_uuid_folder(uuid, email):
+        file = os.path.join(input_dir, f'{basename}_{email.replace(" ", "")}.svg')
         new_dir = os.path.join(output_dir, uuid)
         os.makedirs(new_dir)
         shutil.move(file, new_dir)
 
-    df = pd.read_csv(input_file).fillna('')
-    df.apply(move_to_uuid_folder, axis=1)
-    # for entry in df.itertuples():
-    #     move_to_uuid_folder(entry)
+    df = dtypes.read_csv(input_file, CATEGORY_COLUMNS, na_value='')
+    for uuid, email in zip(df.uuid, df.email):
+        move_to_uuid_folder(uuid, email)
 
 
-@task
-def certificates(ctx, input_file=USERS_FILE, output_dir='certificates'):
+def render_unit(ctx, input_file, template_file, output_dir):
+    """ Render the certificates of `input_file`, a unit of the work queue,
+    to their uuid folders in `output_dir`, and return the folders.
+    """
+    work_dir = tempfile.mkdtemp(prefix=checkpoint.PARTIAL_PREFIX, dir=output_dir)
+    try:
+        render_files(input_file, output_dir=work_dir, template_file=template_file, output_type='svg')
+        move_to_uuid_folders(ctx, input_file, input_dir=work_dir, output_dir=work_dir)
+        svg_to_pdf(ctx, output_dir=work_dir)
+        delete_svg_files(ctx, input_dir=work_dir)
+
+        outputs = []
+        for uuid in os.listdir(work_dir):
+            uuid_dir = os.path.join(output_dir, uuid)
+            # rendered by a worker whose lease expired
+            shutil.rmtree(uuid_dir, ignore_errors=True)
+            os.replace(os.path.join(work_dir, uuid), uuid_dir)
+            outputs.append(uuid_dir)
+        return outputs
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def role_files(users_file, backend=None):
+    """ Return {'attendee': (attendees file, fitted template file)} of the
+    certificates of `users_file`, the template prepared for the `backend`
+    converting it, by default the one of the module.
+    """
+    template_file = text_layout.fit_template(os.path.join(TEMPLATES_DIR, badge_template_file()),
+                                             TEXT_BOXES, FITTED_TEMPLATES_DIR)
+    backend = backend or svg_backends.get_backend(SVG_BACKEND, pinned=True).name
+    template_file = svg_assets.share_images(template_file, SHARED_TEMPLATES_DIR, backend=backend)
+    return {'attendee': (users_file, template_file)}
+
+
+def prepare(ctx, input_file):
+    """ Run the CSV stages on `input_file`, check the attendee table and return it. """
     cleaned_file = add_suffix(input_file, 'cleaned')
     filter_tickets(ctx, input_file=input_file, output_file=cleaned_file)
 
@@ -250,11 +327,30 @@ def certificates(ctx, input_file=USERS_FILE, output_dir='certificates'):
     add_conference_and_tutorials_column(ctx, input_file=merged_file, output_file=tagged_file)
     add_uuid(ctx, input_file=tagged_file, output_file=tagged_file)
     add_url(ctx, input_file=tagged_file, output_file=tagged_file)
-
-    tickets_file = tagged_file
-    template_file = os.path.join(TEMPLATES_DIR, badge_template_file())
-    render_files(tickets_file, output_dir=output_dir, template_file=template_file, output_type='svg')
-    move_to_uuid_folders(ctx, tickets_file, input_dir=output_dir, output_dir=output_dir)
-    # center_names(ctx, output_dir=output_dir)
-    svg_to_pdf(ctx, output_dir=output_dir)
-    delete_svg_files(ctx, input_dir=output_dir)
+    center_names(ctx, input_file=tagged_file, output_file=tagged_file)
+
+    validation.validate_badges(role_files(tagged_file), filename_field=FILENAME_FIELD)
+    return tagged_file
+
+
+@task(report=True)
+def certificates(ctx, input_file=USERS_FILE, output_dir='certificates', profile=False, queue_dir=None, package=None,
+                 part_mb=0):
+    if profile:
+        profiling.enable()
+    if package:
+        packaging.enable(package, directories=[output_dir], stage='certificate', part_size=int(part_mb) * 1024 ** 2,
+                         conference=__name__)
+
+    tickets_file = prepare(ctx, input_file)
+    files = role_files(tickets_file)
+    if queue_dir:
+        # the render workers call `render_unit`
+        work_queue.distribute(queue_dir, __name__, files, output_dir)
+    else:
+        template_file = files['attendee'][1]
+        render_files(tickets_file, output_dir=output_dir, template_file=template_file, output_type='svg')
+        move_to_uuid_folders(ctx, tickets_file, input_dir=output_dir, output_dir=output_dir)
+        svg_to_pdf(ctx, output_dir=output_dir)
+        delete_svg_files(ctx, input_dir=output_dir)
+    packaging.close()
@@ -0,0 +1,346 @@
+"""
+Per-stage instrumentation for the conference tasks.
+
+Use `task` from this module instead of `invoke.task` and every call to the
+task is recorded: wall and CPU time, the RSS high-water mark of the process
+and how much the task raised it, rows of the CSV files read and written,
+subprocesses spawned (docstamp, gs, inkscape...) and bytes written to the
+output files and folders. The rows are the ones of the `input_file` or
+`users_file` and `output_file` arguments, or of the files the task gives to
+`count_rows_in` and `count_rows_out`.
+
+The subprocesses are counted by replacing `subprocess.Popen` only while an
+instrumented task runs, and the records are cleared when a task starts with
+no other one running, so the report of a run only has its own stages. The
+stages are tracked per thread, the functions a task runs in a thread pool
+are wrapped with `in_current_stages` to count their subprocesses in it.
+
+A task declared with `@task(report=True)` writes the records as a JSON file
+(`<task>_report.json`) and logs a summary table when it finishes, e.g. the
+`all` and `certificates` tasks.
+"""
+import csv
+import functools
+import inspect
+import itertools
+import json
+import logging
+import os
+import resource
+import shlex
+import subprocess
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+import invoke
+
+from conferences import profiling
+
+logger = logging.getLogger(__name__)
+
+INPUT_FILE_ARGS = ('input_file', 'users_file')
+
+OUTPUT_FILE_ARGS = ('output_file',)
+
+OUTPUT_DIR_ARGS = ('outdir', 'output_dir', 'stamped_dir')
+
+SUBPROCESS_NAMES = ('docstamp', 'gs', 'inkscape', 'rsvg-convert')
+
+_records = []
+_records_lock = threading.Lock()
+_active_tasks = 0
+_original_popen = subprocess.Popen
+_call_counter = itertools.count()
+_local = threading.local()
+
+
+def _stage_stack() -> list:
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def in_current_stages(func):
+    """ Return `func` counting its subprocesses in the stages running in the
+    calling thread, to run it in other threads, e.g. a thread pool.
+    """
+    stages = list(_stage_stack())
+
+    @functools.wraps(func)
+    def in_stages(*args, **kwargs):
+        previous = getattr(_local, 'stack', None)
+        _local.stack = list(stages)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if previous is None:
+                del _local.stack
+            else:
+                _local.stack = previous
+    return in_stages
+
+
+def _program_name(args) -> str:
+    if isinstance(args, (str, bytes)):
+        args = args.decode() if isinstance(args, bytes) else args
+        try:
+            args = shlex.split(args)
+        except ValueError:
+            args = args.split()
+    program = os.path.basename(str(args[0])) if args else ''
+    return program if program in SUBPROCESS_NAMES else 'other'
+
+
+class _CountingPopen(subprocess.Popen):
+    """ `subprocess.Popen` that counts the spawned processes in the
+    running stages of the current thread, and times them when profiling.
+    """
+    _profiled_call = None
+
+    def __init__(self, args, *posargs, **kwargs):
+        program = _program_name(args)
+        stack = _stage_stack()
+        # the stages of a task can spawn from several threads
+        with _records_lock:
+            for record in stack:
+                record['subprocesses'][program] += 1
+        if profiling.enabled:
+            stage = stack[-1]['stage'] if stack else None
+            self._profiled_call = (stage, args, time.time(), time.perf_counter())
+        super().__init__(args, *posargs, **kwargs)
+
+    def wait(self, timeout=None):
+        returncode = super().wait(timeout=timeout)
+        if self._profiled_call is not None:
+            stage, args, start, start_counter = self._profiled_call
+            self._profiled_call = None
+            profiling.record_subprocess(stage, args, start, time.perf_counter() - start_counter, returncode)
+        return returncode
+
+
+def _begin_task():
+    """ Start counting the subprocesses, and a new set of records when
+    no other task is running.
+    """
+    global _active_tasks
+    with _records_lock:
+        if not _active_tasks:
+            _records.clear()
+            subprocess.Popen = _CountingPopen
+        _active_tasks += 1
+
+
+def _end_task():
+    global _active_tasks
+    with _records_lock:
+        _active_tasks -= 1
+        if not _active_tasks:
+            subprocess.Popen = _original_popen
+
+
+def count_csv_rows(filepath: str):
+    """ Return the number of records in the CSV file `filepath`,
+    None if it does not exist.
+    """
+    if not filepath or not os.path.isfile(filepath):
+        return None
+    with open(filepath, newline='', encoding='utf-8', errors='replace') as csvfile:
+        return max(sum(1 for _ in csv.reader(csvfile)) - 1, 0)
+
+
+def count_rows_in(*csv_files: str):
+    """ Record the rows of `csv_files` as the rows read by the running task,
+    e.g. the role file a task named after the users file renders.
+    """
+    stack = _stage_stack()
+    if stack:
+        stack[-1]['rows_in'] = sum(count_csv_rows(csv_file) or 0 for csv_file in csv_files)
+
+
+def count_rows_out(*csv_files: str):
+    """ Record the rows of `csv_files` as the rows written by the running
+    task, e.g. the role files of `split_users_csv`.
+    """
+    stack = _stage_stack()
+    if stack:
+        stack[-1]['rows_out'] = sum(count_csv_rows(csv_file) or 0 for csv_file in csv_files)
+
+
+def bytes_written_since(paths, since: float) -> int:
+    """ Return the total size of the files in `paths` (files or folders,
+    recursively) modified after the `since` timestamp.
+    """
+    total = 0
+    for path in paths:
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            total += stat.st_size if stat.st_mtime >= since else 0
+            continue
+
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                total += stat.st_size if stat.st_mtime >= since else 0
+    return total
+
+
+def _children_cpu_s() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class InstrumentedTask(invoke.Task):
+    """ invoke Task that records the metrics of each of its calls. """
+    report = False
+
+    def __call__(self, *args, **kwargs):
+        try:
+            call_args = inspect.signature(self.body).bind(*args, **kwargs)
+            call_args.apply_defaults()
+            call_args = call_args.arguments
+        except TypeError:
+            call_args = {}
+
+        input_files = [call_args[arg] for arg in INPUT_FILE_ARGS if call_args.get(arg)]
+        output_paths = [call_args[arg] for arg in OUTPUT_FILE_ARGS + OUTPUT_DIR_ARGS if call_args.get(arg)]
+
+        stack = _stage_stack()
+        record = OrderedDict([
+            ('stage', self.body.__name__),
+            ('call', next(_call_counter)),
+            ('depth', len(stack)),
+            ('parent', stack[-1]['stage'] if stack else None),
+            ('rows_in', count_csv_rows(input_files[0]) if input_files else None),
+            ('rows_out', None),
+            ('subprocesses', defaultdict(int)),
+        ])
+
+        _begin_task()
+        stack.append(record)
+        profile = profiling.start(record['stage']) if profiling.enabled else None
+        start_time = time.time()
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        start_children_cpu = _children_cpu_s()
+        start_max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        try:
+            return super().__call__(*args, **kwargs)
+        finally:
+            if profile is not None:
+                profiling.stop(profile)
+            record['wall_s'] = time.perf_counter() - start_wall
+            record['cpu_s'] = time.process_time() - start_cpu
+            record['children_cpu_s'] = _children_cpu_s() - start_children_cpu
+            # ru_maxrss is the high-water mark of the whole process, not of the task
+            record['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            record['rss_growth_kb'] = record['max_rss_kb'] - start_max_rss
+            record['children_max_rss_kb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+            if call_args.get('output_file'):
+                record['rows_out'] = count_csv_rows(call_args['output_file'])
+            record['bytes_written'] = bytes_written_since(output_paths, start_time)
+            record['subprocesses'] = dict(record['subprocesses'])
+            stack.pop()
+            with _records_lock:
+                _records.append(record)
+
+            try:
+                if self.report and not stack:
+                    write_report(f'{self.body.__name__}_report.json')
+                if profiling.enabled and not stack:
+                    profiling.write()
+            finally:
+                _end_task()
+
+
+def task(*args, **kwargs):
+    """ Same as `invoke.task` but creating `InstrumentedTask`s.
+    Use `report=True` to write the report when the task finishes.
+    """
+    report = kwargs.pop('report', False)
+    kwargs.setdefault('klass', InstrumentedTask)
+    decorated = invoke.task(*args, **kwargs)
+    if isinstance(decorated, invoke.Task):
+        decorated.report = report
+        return decorated
+
+    def decorator(body):
+        instrumented = decorated(body)
+        instrumented.report = report
+        return instrumented
+    return decorator
+
+
+def get_records() -> list:
+    with _records_lock:
+        return list(_records)
+
+
+def summarize(records: list) -> list:
+    """ Aggregate the `records` of the same stage called from the same parent
+    stage, in order of first call. The RSS high-water mark and growth are the
+    maximum, everything else is summed.
+    """
+    summary = OrderedDict()
+    for record in sorted(records, key=lambda rec: rec['call']):
+        group = (record['depth'], record['parent'], record['stage'])
+        stage = summary.setdefault(group, {
+            'stage': record['stage'],
+            'parent': record['parent'],
+            'depth': record['depth'],
+            'calls': 0,
+            'wall_s': 0.0,
+            'cpu_s': 0.0,
+            'children_cpu_s': 0.0,
+            'max_rss_kb': 0,
+            'rss_growth_kb': 0,
+            'rows_in': 0,
+            'rows_out': 0,
+            'subprocesses': defaultdict(int),
+            'bytes_written': 0,
+        })
+        stage['calls'] += 1
+        for key in ('wall_s', 'cpu_s', 'children_cpu_s', 'bytes_written'):
+            stage[key] += record[key]
+        for key in ('rows_in', 'rows_out'):
+            stage[key] += record[key] or 0
+        for key in ('max_rss_kb', 'rss_growth_kb'):
+            stage[key] = max(stage[key], record[key])
+        for program, count in record['subprocesses'].items():
+            stage['subprocesses'][program] += count
+    return list(summary.values())
+
+
+def format_table(summary: list) -> str:
+    header = f'{"stage":<40} {"calls":>5} {"wall s":>9} {"cpu s":>9} {"child s":>9} ' \
+             f'{"maxRSS MB":>9} {"+RSS MB":>7} {"rows in":>8} {"rows out":>8} ' \
+             f'{"docstamp":>8} {"gs":>6} {"inkscape":>8} {"rsvg":>6} {"other":>6} {"MB out":>8}'
+    lines = [header, '-' * len(header)]
+    for stage in summary:
+        subprocesses = stage['subprocesses']
+        lines.append(
+            f'{"  " * stage["depth"] + stage["stage"]:<40} {stage["calls"]:>5} '
+            f'{stage["wall_s"]:>9.2f} {stage["cpu_s"]:>9.2f} {stage["children_cpu_s"]:>9.2f} '
+            f'{stage["max_rss_kb"] / 1024:>9.1f} {stage["rss_growth_kb"] / 1024:>7.1f} '
+            f'{stage["rows_in"]:>8} {stage["rows_out"]:>8} '
+            f'{subprocesses.get("docstamp", 0):>8} {subprocesses.get("gs", 0):>6} '
+            f'{subprocesses.get("inkscape", 0):>8} {subprocesses.get("rsvg-convert", 0):>6} '
+            f'{subprocesses.get("other", 0):>6} '
+            f'{stage["bytes_written"] / 2**20:>8.2f}'
+        )
+    return '\n'.join(lines)
+
+
+def write_report(output_file: str):
+    """ Write the JSON report of all the recorded stages to `output_file`
+    and log the summary table.
+    """
+    records = get_records()
+    summary = summarize(records)
+    with open(output_file, 'w') as report:
+        json.dump({'stages': records, 'summary': summary}, report, indent=2)
+
+    logger.info('Stage report written to {}:\n{}'.format(output_file, format_table(summary)))
@@ -0,0 +1,262 @@
+"""
+Zip or tar archives of the rendered badges and certificates.
+
+The joined badges (and the certificate PDFs) are added to the archive as
+each stage records them complete, while they are still in the page cache,
+instead of zipping the output folders by hand at the end. Each file is read
+once, in chunks, for the archive and its SHA-256 at the same time:
+
+    inv all --package print/badges.zip --part-mb 500
+    inv package-outputs --archive-file print/badges.tar.gz --remove
+
+The archive can be split in parts of at most `--part-mb` MB, each of them
+a complete archive (`badges-001.zip`, `badges-002.zip`...), and comes with
+a `<archive>.manifest.csv` mapping every attendee to its archive member and
+checksum. The outputs that were not recorded by this process, those of a
+resumed run or of the render workers, are added at the end.
+"""
+import csv
+import hashlib
+import importlib
+import logging
+import os
+import tarfile
+import threading
+import time
+import zipfile
+from glob import glob
+from typing import Iterable, List
+
+from conferences import checkpoint
+from conferences.instrument import task
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONFERENCE = os.environ.get('DOCSTAMP_CONFERENCE', 'euroscipy2019')
+
+CHUNK_SIZE = 1024 * 1024
+
+# archive extension -> tarfile mode, None for zip
+FORMATS = {
+    '.zip': None,
+    '.tar': 'w',
+    '.tar.gz': 'w:gz',
+    '.tgz': 'w:gz',
+}
+
+# already compressed, deflating them again only costs time
+STORED_EXTENSIONS = ('.pdf', '.png', '.jpg', '.jpeg')
+
+MANIFEST_COLUMNS = ['part', 'member', 'attendee', 'bytes', 'sha256']
+
+# the stages whose outputs are archived, and their file patterns
+STAGE_PATTERNS = {
+    'joined': '*-joined.pdf',
+    'certificate': os.path.join('*', '*.pdf'),
+}
+
+
+def split_extension(archive_file: str):
+    for extension in sorted(FORMATS, key=len, reverse=True):
+        if archive_file.endswith(extension):
+            return archive_file[:-len(extension)], extension
+    raise ValueError(f'Unknown archive type of {archive_file}, use one of {list(FORMATS)}.')
+
+
+def template_names(conference) -> List[str]:
+    """ Return the names of the templates of `conference`, the start of the
+    names docstamp gives to its outputs, longest first.
+    """
+    from conferences.badge_server import conference_templates
+
+    try:
+        templates = conference_templates(conference).values()
+    except AttributeError:
+        templates = [conference.badge_template_file()]
+    return sorted({os.path.splitext(os.path.basename(template))[0] for template in templates},
+                  key=len, reverse=True)
+
+
+def attendee_of(file_path: str, names: Iterable[str]) -> str:
+    """ Return the file name field of the output `file_path`, "<template>_<field>". """
+    stem = os.path.splitext(os.path.basename(file_path))[0]
+    for suffix in ('-joined', '_cmyk'):
+        if stem.endswith(suffix):
+            stem = stem[:-len(suffix)]
+    for name in names:
+        if stem.startswith(name + '_'):
+            return stem[len(name) + 1:]
+    return ''
+
+
+class HashingReader:
+    """ File wrapper updating `digest` with the bytes read. """
+    def __init__(self, fileobj, digest):
+        self.fileobj = fileobj
+        self.digest = digest
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.digest.update(data)
+        return data
+
+
+class Packager:
+    """ Streams files into `archive_file`, in parts of at most `part_size`
+    bytes if it is not 0, with a manifest CSV file.
+    """
+    def __init__(self, archive_file: str, part_size: int = 0, manifest: bool = True, names: Iterable[str] = (),
+                 remove: bool = False):
+        self.base, self.extension = split_extension(archive_file)
+        self.archive_file = archive_file
+        self.part_size = part_size
+        self.names = list(names)
+        self.remove = remove
+        self.members = set()
+        self.parts = []
+        self.bytes = 0
+        self._archive = None
+        self._part_file = None
+        self._part_bytes = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(archive_file)), exist_ok=True)
+        self._manifest = None
+        if manifest:
+            self._manifest = open(f'{archive_file}.manifest.csv', 'w', newline='', encoding='utf-8')
+            self._manifest_writer = csv.writer(self._manifest)
+            self._manifest_writer.writerow(MANIFEST_COLUMNS)
+
+    def _entry_bytes(self, size: int, member: str) -> int:
+        """ Return about how many bytes the member takes in the archive, at most. """
+        if self.extension == '.zip':
+            # local header, central directory entry and zip64 extras
+            return size + 2 * len(member.encode('utf-8')) + 150
+        return 512 + (size + 511) // 512 * 512
+
+    def _open_part(self):
+        number = len(self.parts) + 1
+        part_file = f'{self.base}-{number:03d}{self.extension}' if self.part_size else self.archive_file
+        self._part_file = part_file
+        partial = checkpoint.partial_file(part_file)
+        if self.extension == '.zip':
+            self._archive = zipfile.ZipFile(partial, 'w', allowZip64=True)
+        else:
+            self._archive = tarfile.open(partial, FORMATS[self.extension])
+        # the end of central directory, or the end blocks padded to a tar record
+        self._part_bytes = 100 if self.extension == '.zip' else tarfile.RECORDSIZE
+        self.parts.append(part_file)
+
+    def _close_part(self):
+        if self._archive is None:
+            return
+        self._archive.close()
+        os.replace(checkpoint.partial_file(self._part_file), self._part_file)
+        self._archive = None
+
+    def _write(self, path: str, member: str, size: int, digest):
+        with open(path, 'rb') as source:
+            if self.extension == '.zip':
+                info = zipfile.ZipInfo.from_file(path, member)
+                stored = path.lower().endswith(STORED_EXTENSIONS)
+                info.compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+                with self._archive.open(info, 'w', force_zip64=size > 2 ** 31) as target:
+                    for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+                        digest.update(chunk)
+                        target.write(chunk)
+            else:
+                self._archive.addfile(self._archive.gettarinfo(path, member), HashingReader(source, digest))
+
+    def add(self, path: str, member: str = None):
+        """ Add the file `path` as `member`, by default its path relative to
+        the current folder. A member is only added once.
+        """
+        member = (member or os.path.relpath(path)).replace(os.sep, '/')
+        with self._lock:
+            if member in self.members:
+                return
+            size = os.path.getsize(path)
+            entry_bytes = self._entry_bytes(size, member)
+            if self._archive is not None and self.part_size and self._part_bytes + entry_bytes > self.part_size:
+                self._close_part()
+            if self._archive is None:
+                self._open_part()
+            if self.part_size and entry_bytes > self.part_size:
+                logger.warning(f'{path} is larger than the parts of {self.part_size} bytes.')
+
+            digest = hashlib.sha256()
+            self._write(path, member, size, digest)
+            self._part_bytes += entry_bytes
+            self.bytes += size
+            self.members.add(member)
+            if self._manifest:
+                self._manifest_writer.writerow([os.path.basename(self._part_file), member,
+                                                attendee_of(path, self.names), size, digest.hexdigest()])
+            if self.remove:
+                os.remove(path)
+
+    def add_files(self, directory: str, pattern: str):
+        """ Add the complete files of `directory` matching `pattern` not added yet. """
+        for path in sorted(glob(os.path.join(directory, pattern))):
+            if not os.path.basename(path).startswith(checkpoint.PARTIAL_PREFIX) and checkpoint.is_complete(path):
+                self.add(path)
+
+    def close(self):
+        with self._lock:
+            self._close_part()
+            if self._manifest:
+                self._manifest.close()
+        logger.info(f'Packaged {len(self.members)} files of {self.bytes / 1024 ** 2:.1f} MB '
+                    f'in {len(self.parts)} archives: {", ".join(self.parts)}.')
+
+
+_packager = None
+_stage = None
+_sweeps = []
+
+
+def _add_recorded(stage: str, unit: str):
+    if stage == _stage and os.path.exists(unit):
+        _packager.add(unit)
+
+
+def enable(archive_file: str, directories: Iterable[str], stage: str = 'joined', part_size: int = 0,
+           conference: str = None, remove: bool = False) -> Packager:
+    """ Start adding the outputs recorded by `stage` to `archive_file`, with
+    the attendees of the templates of the `conference` module in the
+    manifest. `close` also adds the outputs of `stage` found in `directories`.
+    """
+    global _packager, _stage, _sweeps
+
+    names = template_names(importlib.import_module(conference)) if conference else ()
+    _packager = Packager(archive_file, part_size=part_size, names=names, remove=remove)
+    _stage = stage
+    _sweeps = [(directory, STAGE_PATTERNS[stage]) for directory in directories]
+    checkpoint.subscribe(_add_recorded)
+    return _packager
+
+
+def close():
+    global _packager
+
+    if _packager is None:
+        return
+    checkpoint.unsubscribe(_add_recorded)
+    for directory, pattern in _sweeps:
+        _packager.add_files(directory, pattern)
+    _packager.close()
+    _packager = None
+
+
+@task
+def package_outputs(ctx, archive_file, input_dirs='stamped,blank', stage='joined', part_mb=0, manifest=True,
+                    remove=False, conference=DEFAULT_CONFERENCE):
+    """ Archive the outputs of `stage` in the comma separated `input_dirs`. """
+    start = time.perf_counter()
+    names = template_names(importlib.import_module(f'conferences.{conference}'))
+    packager = Packager(archive_file, part_size=int(part_mb) * 1024 ** 2, manifest=manifest, names=names,
+                        remove=remove)
+    for directory in input_dirs.split(','):
+        packager.add_files(directory, STAGE_PATTERNS[stage])
+    packager.close()
+    logger.info(f'Packaged in {time.perf_counter() - start:.1f} s.')
@@ -0,0 +1,106 @@
+"""
+Smaller PDF files for the printer.
+
+`duplex_pdf` writes both faces of a badge from a single reader, so the two
+pages share the fonts and images of the badge instead of carrying a copy
+each, like `merge_pdfs` does with one reader per face.
+
+`bundle_badges` consolidates the joined badges in a few print files with a
+single Ghostscript pass per file. The pdfwrite device keeps one copy of the
+images that are identical across pages (by content hash), subsets the fonts
+to the glyphs used in the whole file and writes it linearized:
+
+    inv bundle-badges --stamped-dir stamped --output-dir print --badges-per-file 500
+"""
+import logging
+import os
+import subprocess
+import tempfile
+from glob import glob
+from typing import List
+
+from conferences import checkpoint
+from conferences.instrument import task
+
+logger = logging.getLogger(__name__)
+
+GS_OPTIMIZE_ARGS = [
+    '-dSAFER',
+    '-dBATCH',
+    '-dNOPAUSE',
+    '-dQUIET',
+    '-sDEVICE=pdfwrite',
+    '-dDetectDuplicateImages=true',
+    '-dSubsetFonts=true',
+    '-dCompressFonts=true',
+    '-dCompressPages=true',
+    # keep the CMYK colors and the image resolution of the badges
+    '-sColorConversionStrategy=LeaveColorUnchanged',
+    '-dAutoFilterColorImages=false',
+    '-dColorImageFilter=/FlateEncode',
+    '-dAutoFilterGrayImages=false',
+    '-dGrayImageFilter=/FlateEncode',
+    '-dDownsampleColorImages=false',
+    '-dDownsampleGrayImages=false',
+    '-dDownsampleMonoImages=false',
+    # linearized, the RIP can start on the first pages while the rest is uploaded
+    '-dFastWebView=true',
+]
+
+
+def duplex_pdf(pdf_filepath: str, output_filepath: str) -> str:
+    """ Write the pages of `pdf_filepath` twice to `output_filepath`, sharing
+    their resources, and return `output_filepath`.
+    """
+    from PyPDF2 import PdfFileReader, PdfFileWriter
+
+    with open(pdf_filepath, 'rb') as pdf:
+        reader = PdfFileReader(pdf)
+        writer = PdfFileWriter()
+        for _ in range(2):
+            for page_num in range(reader.getNumPages()):
+                writer.addPage(reader.getPage(page_num))
+
+        with open(output_filepath, 'wb') as output:
+            writer.write(output)
+    return output_filepath
+
+
+def optimize_pdfs(pdf_filepaths: List[str], output_filepath: str):
+    """ Write the pages of `pdf_filepaths` to `output_filepath` with
+    Ghostscript, with the shared resources deduplicated and the fonts
+    subset. The file names go in an argument file, there may be thousands.
+    """
+    with tempfile.NamedTemporaryFile('w', suffix='.args', delete=False) as args_file:
+        for pdf_filepath in pdf_filepaths:
+            path = os.path.abspath(pdf_filepath).replace('\\', '\\\\').replace('"', '\\"')
+            args_file.write(f'"{path}"\n')
+    try:
+        cmd = ['gs', *GS_OPTIMIZE_ARGS, f'-sOutputFile={output_filepath}', f'@{args_file.name}']
+        logger.info(f'Calling {" ".join(cmd[:-1])} with {len(pdf_filepaths)} files')
+        subprocess.run(cmd, check=True)
+    finally:
+        os.remove(args_file.name)
+
+
+@task
+def bundle_badges(ctx, stamped_dir='stamped', output_dir='print', badges_per_file=500):
+    """ Consolidate the joined badges of `stamped_dir` in optimized print files. """
+    pdf_files = sorted(glob(os.path.join(stamped_dir, '*joined.pdf')))
+    if not pdf_files:
+        logger.warning(f'No joined badges found in {stamped_dir}.')
+        return
+
+    os.makedirs(output_dir, exist_ok=True)
+    name = os.path.basename(os.path.normpath(stamped_dir))
+    input_bytes = sum(os.path.getsize(pdf_file) for pdf_file in pdf_files)
+    output_bytes = 0
+    for start in range(0, len(pdf_files), badges_per_file):
+        batch = pdf_files[start:start + badges_per_file]
+        output_file = os.path.join(output_dir, f'{name}_{start + 1:05d}-{start + len(batch):05d}.pdf')
+        with checkpoint.atomic_output(output_file) as partial_file:
+            optimize_pdfs(batch, partial_file)
+        output_bytes += os.path.getsize(output_file)
+
+    logger.info(f'Bundled {len(pdf_files)} badges of {input_bytes / 1024 ** 2:.1f} MB '
+                f'in {output_bytes / 1024 ** 2:.1f} MB in {output_dir}.')
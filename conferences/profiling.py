@@ -0,0 +1,177 @@
+"""
+Opt-in cProfile profiling of the conference tasks.
+
+Profiling is switched on by setting the `DOCSTAMP_PROFILE` environment
+variable to an output folder, or with the `--profile` flag of the `all`
+and `certificates` tasks (output folder `profile`):
+
+    DOCSTAMP_PROFILE=profile inv all
+    inv all --profile
+
+Each task runs under its own `cProfile.Profile`, the time spent in nested
+tasks is only counted in the nested one. Also the command line and duration
+of every subprocess (docstamp, gs, inkscape...) are recorded.
+
+When the outermost task finishes, the output folder has:
+- `<task>.prof`: the profile of each task, for `snakeviz` or `pstats`,
+- `merged.prof`: all the profiles merged,
+- `flamegraph.folded`: collapsed stacks in microseconds, for `flamegraph.pl`
+  or speedscope, with the subprocesses under `<task>;subprocess;<command>`,
+- `subprocesses.json`: the subprocess calls.
+
+When profiling is off the tasks only pay for checking `enabled`.
+"""
+import cProfile
+import json
+import logging
+import os
+import pstats
+import threading
+from collections import OrderedDict, defaultdict
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = os.environ.get('DOCSTAMP_PROFILE', '')
+
+enabled = bool(PROFILE_DIR)
+
+MAX_STACK_DEPTH = 64
+
+_profiles = OrderedDict()
+_subprocesses = []
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def enable(output_dir: str = 'profile'):
+    """ Switch profiling on for the tasks called from now on. """
+    global enabled, PROFILE_DIR
+    PROFILE_DIR = PROFILE_DIR or output_dir
+    enabled = True
+
+
+def _profile_stack() -> list:
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def start(stage: str) -> cProfile.Profile:
+    """ Pause the profile of the running task and start (or resume)
+    the profile of `stage`.
+    """
+    stack = _profile_stack()
+    if stack:
+        stack[-1].disable()
+
+    with _lock:
+        profile = _profiles.setdefault(stage, cProfile.Profile())
+    stack.append(profile)
+    profile.enable()
+    return profile
+
+
+def stop(profile: cProfile.Profile):
+    """ Stop `profile` and resume the profile of the calling task. """
+    profile.disable()
+    stack = _profile_stack()
+    stack.pop()
+    if stack:
+        stack[-1].enable()
+
+
+def record_subprocess(stage: str, args, start: float, duration_s: float, returncode):
+    command = args if isinstance(args, str) else ' '.join(str(arg) for arg in args)
+    with _lock:
+        _subprocesses.append({
+            'stage': stage,
+            'command': command,
+            'start': start,
+            'duration_s': duration_s,
+            'returncode': returncode,
+        })
+
+
+def _frame_label(func) -> str:
+    filename, line, name = func
+    label = f'{name}' if filename == '~' else f'{os.path.basename(filename)}:{line}({name})'
+    return label.replace(';', ',').replace(' ', '_')
+
+
+def folded_stacks(stats: pstats.Stats, prefix: str) -> dict:
+    """ Return collapsed stacks (stack -> microseconds) from `stats`.
+
+    cProfile only keeps caller -> callee edges, so the time of a function
+    called from several places is split between its callers in proportion
+    to the time spent from each of them.
+    """
+    folded = defaultdict(int)
+    callees = defaultdict(list)
+    roots = []
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        if not callers:
+            roots.append(func)
+        for caller, caller_stats in callers.items():
+            callees[caller].append((func, caller_stats[3]))
+
+    def visit(func, path, share):
+        total_tt, total_ct = stats.stats[func][2], stats.stats[func][3]
+        path = path + [_frame_label(func)]
+        folded[';'.join(path)] += int(total_tt * share * 1e6)
+        if len(path) >= MAX_STACK_DEPTH:
+            return
+        for callee, edge_ct in callees[func]:
+            callee_ct = stats.stats[callee][3]
+            if callee in visiting or not callee_ct:
+                continue
+            callee_share = edge_ct * share / callee_ct
+            if callee_share * callee_ct < 1e-6:
+                continue
+            visiting.add(callee)
+            visit(callee, path, callee_share)
+            visiting.discard(callee)
+
+    for root in roots:
+        visiting = {root}
+        visit(root, [prefix], 1.0)
+    return {stack: usec for stack, usec in folded.items() if usec > 0}
+
+
+def write(output_dir: str = None):
+    """ Write the per-task profiles, the merged profile, the flamegraph
+    collapsed stacks and the subprocess calls to `output_dir`.
+    """
+    output_dir = output_dir or PROFILE_DIR
+    os.makedirs(output_dir, exist_ok=True)
+
+    with _lock:
+        profiles = list(_profiles.items())
+        subprocesses = list(_subprocesses)
+
+    merged = None
+    folded = {}
+    for stage, profile in profiles:
+        stats = pstats.Stats(profile)
+        stats.dump_stats(os.path.join(output_dir, f'{stage}.prof'))
+        folded.update(folded_stacks(stats, stage))
+        if merged is None:
+            merged = stats
+        else:
+            merged.add(stats)
+
+    if merged is not None:
+        merged.dump_stats(os.path.join(output_dir, 'merged.prof'))
+
+    for call in subprocesses:
+        program = os.path.basename(call['command'].split(' ', 1)[0])
+        stack = f'{call["stage"]};subprocess;{program}'
+        folded[stack] = folded.get(stack, 0) + int(call['duration_s'] * 1e6)
+
+    with open(os.path.join(output_dir, 'flamegraph.folded'), 'w') as out:
+        for stack, usec in sorted(folded.items()):
+            out.write(f'{stack} {usec}\n')
+
+    with open(os.path.join(output_dir, 'subprocesses.json'), 'w') as out:
+        json.dump(subprocesses, out, indent=2)
+
+    logger.info(f'Profiles of {len(profiles)} tasks and {len(subprocesses)} subprocesses written to {output_dir}.')
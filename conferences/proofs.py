@@ -0,0 +1,112 @@
+"""
+Low resolution proofs of the badges, as contact sheets per role.
+
+The attendees go through the `prepare` stages of the conference, the CSV
+stages and the split in role files, so the proofs have the same attendees,
+roles and fitted texts as the printed badges. Each row of a role file fills
+the template of its role and goes straight to a small PNG with
+`rsvg-convert`, in parallel, without the CMYK and faces stages. The PNGs are
+tiled in contact sheets with the attendee email or number under each badge:
+
+    inv proof-badges --users-file tito.csv --output-dir proofs
+
+writes `proofs/<role>_001.png`, `proofs/<role>_002.png`...
+"""
+import base64
+import csv
+import importlib
+import logging
+import os
+import struct
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+from conferences import instrument
+from conferences.badge_server import DEFAULT_CONFERENCE
+from conferences.instrument import task
+from conferences.svg_render import SVGTemplate, rsvg_convert, xml_escape
+
+logger = logging.getLogger(__name__)
+
+# the first of these fields a record has is written under its badge
+LABEL_FIELDS = ['email', 'Ticket_Email', 'number', 'Number']
+
+LABEL_HEIGHT = 14
+
+PADDING = 6
+
+
+def read_records(input_file: str) -> List[Dict[str, str]]:
+    """ Return the rows of the role file `input_file`. """
+    with open(input_file, newline='', encoding='utf-8') as csvfile:
+        return list(csv.DictReader(csvfile))
+
+
+def label(record: Dict[str, str]) -> str:
+    return next((record[field] for field in LABEL_FIELDS if record.get(field)), '')
+
+
+def png_size(png: bytes) -> Tuple[int, int]:
+    """ Return the width and height in the IHDR chunk of `png`. """
+    return struct.unpack('>II', png[16:24])
+
+
+def contact_sheet(thumbnails: List[Tuple[str, bytes]], columns: int) -> str:
+    """ Return an SVG with the (label, PNG) `thumbnails` tiled in `columns`. """
+    width, height = max(png_size(png) for _, png in thumbnails)
+    tile_width, tile_height = width + PADDING, height + LABEL_HEIGHT + PADDING
+    rows = (len(thumbnails) + columns - 1) // columns
+
+    tiles = []
+    for idx, (text, png) in enumerate(thumbnails):
+        x, y = (idx % columns) * tile_width + PADDING, (idx // columns) * tile_height + PADDING
+        href = 'data:image/png;base64,' + base64.b64encode(png).decode('ascii')
+        tiles.append(f'<image x="{x}" y="{y}" width="{width}" height="{height}" xlink:href="{href}"/>')
+        tiles.append(f'<text x="{x + width / 2}" y="{y + height + LABEL_HEIGHT - 4}" text-anchor="middle" '
+                     f'font-family="sans-serif" font-size="9">{xml_escape(text[:40])}</text>')
+
+    sheet_width, sheet_height = columns * tile_width + PADDING, rows * tile_height + PADDING
+    return ('<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+            f'width="{sheet_width}" height="{sheet_height}">'
+            f'<rect width="100%" height="100%" fill="white"/>{"".join(tiles)}</svg>')
+
+
+@task
+def proof_badges(ctx, users_file, conference=DEFAULT_CONFERENCE, output_dir='proofs', dpi=24, columns=8,
+                 rows=6, workers=0):
+    """ Write per role contact sheets of low resolution previews of the badges of `users_file`. """
+    start = time.perf_counter()
+    module = importlib.import_module(f'conferences.{conference}')
+    tickets_file = module.prepare(ctx, users_file)
+
+    def preview(args):
+        template, record = args
+        return label(record), rsvg_convert(template.fill(record), output_type='png', dpi=dpi)
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        by_role = OrderedDict()
+        for role, (input_file, template_file) in module.role_files(tickets_file).items():
+            records = read_records(input_file)
+            if records:
+                template = SVGTemplate(template_file)
+                by_role[role] = list(pool.map(instrument.in_current_stages(preview), ((template, record) for record in records)))
+
+        sheets = []
+        per_sheet = columns * rows
+        for role, thumbnails in by_role.items():
+            for number, first in enumerate(range(0, len(thumbnails), per_sheet), 1):
+                sheet_file = os.path.join(output_dir, f'{role}_{number:03d}.png')
+                sheets.append((sheet_file, contact_sheet(thumbnails[first:first + per_sheet], columns)))
+
+        def write_sheet(sheet):
+            sheet_file, svg = sheet
+            with open(sheet_file, 'wb') as png:
+                png.write(rsvg_convert(svg, output_type='png'))
+
+        os.makedirs(output_dir, exist_ok=True)
+        list(pool.map(instrument.in_current_stages(write_sheet), sheets))
+
+    logger.info(f'Wrote {len(sheets)} contact sheets of {sum(map(len, by_role.values()))} badges '
+                f'to {output_dir} in {time.perf_counter() - start:.1f} s.')
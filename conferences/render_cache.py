@@ -0,0 +1,324 @@
+"""
+Content-addressed cache of the rendered files, shared across runs and
+conferences.
+
+A badge or certificate is keyed by the hash of the template content, the
+values of the fields the template uses, the DPI and the output type; a
+converted file (CMYK, SVG to PDF) by the hash of its input file and the
+conversion. On a hit the cached file is hard linked (or copied) to the
+output folder instead of rendered. The least recently used files are evicted
+when the cache grows over its disk budget.
+
+The cache is off unless `DOCSTAMP_CACHE_DIR` is set, it is only worth its
+disk space for the conferences rendered again and again:
+
+    DOCSTAMP_CACHE_DIR=~/.cache/tito-docstamp
+    DOCSTAMP_CACHE_SIZE=2G
+
+    with render_cache.render_misses(input_file, outdir, template_file, 'email', dpi=72) as (misses, render_dir):
+        if misses:
+            ... docstamp create -i misses -o render_dir ...
+
+    render_cache.cached_transform('cmyk', pdf_file, cmyk_file, pdf_to_cmyk)
+"""
+import csv
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+from conferences import checkpoint
+from conferences.instrument import task
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_SIZE = '2G'
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+# eviction goes down to this fraction of the budget, to not evict on every store
+EVICT_TO = 0.9
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY, file TEXT, size INTEGER, last_used REAL
+);
+CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+"""
+
+
+def parse_size(size: str) -> int:
+    """ Return the number of bytes of `size`, e.g.: '500M', '2G' or '1000000'. """
+    match = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?)i?B?\s*', str(size).upper())
+    if match is None:
+        raise ValueError(f'Invalid size {size!r}, expected e.g. 500M or 2G.')
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def _link(source: str, destination: str):
+    """ Hard link `source` to `destination`, or copy it across file systems. """
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+_digests = {}
+
+
+def file_digest(path: str) -> str:
+    """ Return the SHA-256 of the content of `path`, memoized by size and mtime. """
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    digest = _digests.get(memo_key)
+    if digest is None:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as content:
+            for chunk in iter(lambda: content.read(1 << 20), b''):
+                sha.update(chunk)
+        digest = _digests[memo_key] = sha.hexdigest()
+    return digest
+
+
+def digest(*parts) -> str:
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def template_fields(template_file: str) -> list:
+    """ Return the names of the fields used in the jinja `template_file`. """
+    with open(template_file, encoding='utf-8') as template:
+        return sorted(set(re.findall(r'\{\{\s*([A-Za-z_]\w*)', template.read())))
+
+
+class RenderCache:
+    """ Files stored by key in `cache_dir`, with a SQLite index of their
+    size and last use, within a budget of `max_bytes`.
+    """
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(cache_dir, 'index.sqlite'), timeout=60, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        self.total_bytes = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def _path(self, key: str, extension: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + extension)
+
+    def fetch(self, key: str, output_file: str) -> bool:
+        """ Link the file cached under `key` to `output_file`, return False
+        if there is none.
+        """
+        with self._lock:
+            row = self.db.execute('SELECT file FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return False
+
+            path = os.path.join(self.cache_dir, row[0])
+            if not os.path.exists(path):
+                self.db.execute('DELETE FROM entries WHERE key = ?', (key,))
+                self.db.commit()
+                return False
+
+            _link(path, output_file)
+            self.db.execute('UPDATE entries SET last_used = ? WHERE key = ?', (time.time(), key))
+            self.db.commit()
+            return True
+
+    def store(self, key: str, input_file: str):
+        """ Cache `input_file` under `key`, evicting the least recently used
+        files if the cache goes over budget.
+        """
+        path = self._path(key, os.path.splitext(input_file)[1])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _link(input_file, path)
+        size = os.path.getsize(path)
+
+        with self._lock:
+            old = self.db.execute('SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+            self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                            (key, os.path.relpath(path, self.cache_dir), size, time.time()))
+            self.db.commit()
+            self.total_bytes += size - (old[0] if old else 0)
+
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self, max_bytes: int = None):
+        """ Remove the least recently used files until the cache is under
+        `EVICT_TO` of `max_bytes`.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        with self._lock:
+            self.total_bytes = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+            if self.total_bytes <= max_bytes:
+                return
+
+            evicted = 0
+            target = max_bytes * EVICT_TO
+            rows = self.db.execute('SELECT key, file, size FROM entries ORDER BY last_used').fetchall()
+            for key, file, size in rows:
+                if self.total_bytes <= target:
+                    break
+                path = os.path.join(self.cache_dir, file)
+                if os.path.exists(path):
+                    os.remove(path)
+                self.db.execute('DELETE FROM entries WHERE key = ?', (key,))
+                self.total_bytes -= size
+                evicted += 1
+            self.db.commit()
+        logger.info(f'Evicted {evicted} files from the render cache, {self.total_bytes} bytes left.')
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, size = self.db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        return {'cache_dir': self.cache_dir, 'entries': entries, 'bytes': size, 'max_bytes': self.max_bytes}
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def default_cache() -> Optional[RenderCache]:
+    """ Return the cache configured by `DOCSTAMP_CACHE_DIR` and
+    `DOCSTAMP_CACHE_SIZE`, None if it is not set.
+    """
+    cache_dir = os.environ.get('DOCSTAMP_CACHE_DIR', '')
+    if not cache_dir:
+        return None
+
+    max_bytes = parse_size(os.environ.get('DOCSTAMP_CACHE_SIZE', DEFAULT_CACHE_SIZE))
+    with _caches_lock:
+        cache = _caches.get(cache_dir)
+        if cache is None:
+            cache = _caches[cache_dir] = RenderCache(os.path.expanduser(cache_dir), max_bytes)
+        cache.max_bytes = max_bytes
+    return cache
+
+
+@contextmanager
+def render_misses(input_file: str, outdir: str, template_file: str, filename_field: str, dpi: int = 72,
+                  output_type: str = 'pdf', backend: str = '', use_cache: bool = True):
+    """ Link the cached renders of the rows of `input_file` to `outdir`, named
+    the way `docstamp create` names them, and give a CSV file with the rows
+    left to render, or None if all of them were cached or are done in the
+    checkpoint journal, and the folder to render them to. The files of each
+    SVG `backend` are cached apart. Without `use_cache` only the journal is
+    looked up, for the files that are different in every run.
+    The files rendered there are moved to `outdir` and cached when the block
+    ends, so that `outdir` never has half-written files.
+    """
+    cache = default_cache() if use_cache else None
+    journal = checkpoint.current()
+
+    os.makedirs(outdir, exist_ok=True)
+    checkpoint.remove_partial_files(outdir)
+    render_dir = tempfile.mkdtemp(prefix=checkpoint.PARTIAL_PREFIX, dir=outdir)
+    try:
+        if cache is None and journal is None:
+            yield input_file, render_dir
+            for name in os.listdir(render_dir):
+                if checkpoint.is_complete(os.path.join(render_dir, name)):
+                    os.replace(os.path.join(render_dir, name), os.path.join(outdir, name))
+            return
+
+        with open(input_file, newline='', encoding='utf-8') as csvfile:
+            reader = csv.DictReader(csvfile)
+            fieldnames = reader.fieldnames
+            rows = list(reader)
+
+        fields = template_fields(template_file)
+        template_digest = file_digest(template_file)
+        basename = os.path.splitext(os.path.basename(template_file))[0]
+
+        done = 0
+        misses = []
+        for row in rows:
+            output_file = os.path.join(outdir, f'{basename}_{row[filename_field].replace(" ", "")}.{output_type}')
+            if checkpoint.done('rendered', output_file):
+                done += 1
+                continue
+
+            key = digest(template_digest, {field: row.get(field, '') for field in fields}, dpi, output_type,
+                         *([backend] if backend else []))
+            if cache is not None and cache.fetch(key, output_file):
+                checkpoint.record('rendered', output_file)
+                continue
+            misses.append((row, key, output_file))
+        logger.info(f'{len(rows) - len(misses) - done} of {len(rows)} {basename} files found in the render cache, '
+                    f'{done} done before.')
+
+        if not misses:
+            yield None, render_dir
+            return
+
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', dir=os.path.dirname(input_file) or '.', newline='',
+                                         encoding='utf-8', delete=False) as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(row for row, _, _ in misses)
+        try:
+            yield csvfile.name, render_dir
+        finally:
+            os.remove(csvfile.name)
+
+        for _, key, output_file in misses:
+            rendered_file = os.path.join(render_dir, os.path.basename(output_file))
+            if not os.path.exists(rendered_file) or not checkpoint.is_complete(rendered_file):
+                continue
+            # replaces the directory entry, a cached file linked there is not overwritten
+            os.replace(rendered_file, output_file)
+            if cache is not None:
+                cache.store(key, output_file)
+            checkpoint.record('rendered', output_file)
+    finally:
+        shutil.rmtree(render_dir, ignore_errors=True)
+
+
+def cached_transform(kind: str, input_file: str, output_file: str, transform: Callable, *params):
+    """ Call `transform(input_file, output_file, *params)`, or link the output
+    cached for the same `kind`, `params` and `input_file` content.
+    """
+    cache = default_cache()
+    if cache is None:
+        return transform(input_file, output_file, *params)
+
+    key = digest(kind, file_digest(input_file), params)
+    if cache.fetch(key, output_file):
+        return output_file
+
+    if os.path.lexists(output_file):
+        os.remove(output_file)
+    result = transform(input_file, output_file, *params)
+    if os.path.exists(output_file) and checkpoint.is_complete(output_file):
+        cache.store(key, output_file)
+    return result
+
+
+@task
+def render_cache(ctx, clear=False, size=''):
+    """ Print the size of the render cache, `--clear` it, or evict it down to `--size`. """
+    cache = default_cache()
+    if cache is None:
+        print('The render cache is off, set DOCSTAMP_CACHE_DIR to its folder to use it.')
+        return
+
+    if clear or size:
+        cache.evict(max_bytes=0 if clear else parse_size(size))
+    stats = cache.stats()
+    print(f'{stats["entries"]} files, {stats["bytes"] / 1024 ** 2:.1f} MB of {stats["max_bytes"] / 1024 ** 2:.0f} MB '
+          f'in {stats["cache_dir"]}')
@@ -0,0 +1,83 @@
+"""
+Shared raster assets for the rendered SVG files.
+
+The certificate template embeds its logos as base64 `data:image` URIs, so
+every rendered certificate carries a copy of them and every PDF conversion
+decodes them again. `share_images` decodes them once to files named by
+their content hash and links the template to these files, so the rendered
+SVGs only hold a file URI:
+
+    template_file = svg_assets.share_images(template_file, 'fitted_templates/shared', backend='inkscape')
+
+Only Inkscape loads the images linked from outside the folder of the SVG
+file. librsvg (`rsvg-convert`, and docstamp with `--unicode_support`) refuses
+them for security, and the rendered certificates are in their own uuid
+folders, so for the other backends the template keeps its embedded images.
+"""
+import base64
+import hashlib
+import logging
+import os
+import re
+from pathlib import Path
+
+from conferences import checkpoint
+
+logger = logging.getLogger(__name__)
+
+DATA_URI = re.compile(r'(?P<attr>(?:xlink:)?href)="data:image/(?P<type>[\w+.-]+);base64,(?P<data>[^"]*)"')
+
+EXTENSIONS = {'jpeg': 'jpg', 'svg+xml': 'svg'}
+
+# the SVG backends that load images linked by absolute file URIs
+LINKED_IMAGE_BACKENDS = ('inkscape',)
+
+
+def write_asset(content: bytes, image_type: str, assets_dir: str) -> str:
+    """ Write `content` to `assets_dir`, named by its hash, and return its path.
+    The file is not written again if it exists.
+    """
+    extension = EXTENSIONS.get(image_type, image_type)
+    asset_file = os.path.join(assets_dir, f'{hashlib.sha256(content).hexdigest()[:16]}.{extension}')
+    if not os.path.exists(asset_file):
+        os.makedirs(assets_dir, exist_ok=True)
+        with checkpoint.atomic_output(asset_file, unique=True) as partial_file:
+            with open(partial_file, 'wb') as asset:
+                asset.write(content)
+    return asset_file
+
+
+def share_images(template_file: str, output_dir: str, backend: str) -> str:
+    """ Write a copy of `template_file` with its embedded images moved to
+    `output_dir/assets` and linked with absolute file URIs, and return its
+    path. The copy keeps the name of the template, in a folder of
+    `output_dir` named by the digest of the template. `template_file` is
+    returned as is when the `backend` converting it does not load the linked
+    images.
+    """
+    if backend not in LINKED_IMAGE_BACKENDS:
+        logger.info(f'Keeping the images of {template_file} embedded, {backend} does not load linked images.')
+        return template_file
+
+    with open(template_file, encoding='utf-8') as svg:
+        source = svg.read()
+
+    assets_dir = os.path.join(output_dir, 'assets')
+    template_digest = hashlib.sha256(source.encode('utf-8')).hexdigest()[:16]
+    output_file = os.path.join(output_dir, template_digest, os.path.basename(template_file))
+
+    moved = []
+
+    def link_asset(match):
+        content = base64.b64decode(match.group('data'))
+        asset_file = write_asset(content, match.group('type'), assets_dir)
+        moved.append(len(match.group(0)))
+        return f'{match.group("attr")}="{Path(asset_file).resolve().as_uri()}"'
+
+    shared = DATA_URI.sub(link_asset, source)
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    with checkpoint.atomic_output(output_file, unique=True) as partial_file:
+        with open(partial_file, 'w', encoding='utf-8') as svg:
+            svg.write(shared)
+    logger.info(f'Moved {len(moved)} embedded images ({sum(moved)} bytes) of {template_file} to {assets_dir}.')
+    return output_file
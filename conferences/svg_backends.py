@@ -0,0 +1,139 @@
+"""
+SVG to PDF converters.
+
+docstamp converts with Inkscape, or with `rsvg-convert` (librsvg) when
+`--unicode_support` is given, one process per file. The conversion is done
+here instead, after docstamp wrote the filled SVG files, with the backend
+the conference module selects in `SVG_BACKEND`:
+
+    inkscape  the Inkscape command line, the most complete SVG support
+    rsvg      the `rsvg-convert` command, much faster for simple artwork
+    cairosvg  the cairosvg library, in this process (`pip install cairosvg`)
+
+`DOCSTAMP_SVG_BACKEND=rsvg inv all` overrides it for a run, except for the
+modules that pin their backend because their templates need it (the
+certificates, Inkscape). `python -m benchmarks.compare_backends` times them
+on the templates prepared by the pipelines and compares their rendering
+pixel by pixel.
+"""
+import importlib.util
+import logging
+import os
+import shutil
+import subprocess
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List
+
+from conferences import instrument
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BACKEND = 'rsvg'
+
+
+class SVGBackend:
+    """ Converts SVG files to PDF files. """
+    name = ''
+
+    def available(self) -> bool:
+        raise NotImplementedError
+
+    def convert(self, svg_file: str, pdf_file: str, dpi: int = 72):
+        raise NotImplementedError
+
+
+class InkscapeBackend(SVGBackend):
+    name = 'inkscape'
+
+    def available(self) -> bool:
+        from docstamp.config import get_inkscape_binpath
+
+        binpath = get_inkscape_binpath()
+        return binpath is not None and os.path.exists(binpath)
+
+    def convert(self, svg_file: str, pdf_file: str, dpi: int = 72):
+        from docstamp.inkscape import svg2pdf
+
+        svg2pdf(svg_file, pdf_file, dpi=dpi)
+
+
+class RsvgBackend(SVGBackend):
+    name = 'rsvg'
+
+    def available(self) -> bool:
+        return shutil.which('rsvg-convert') is not None
+
+    def convert(self, svg_file: str, pdf_file: str, dpi: int = 72):
+        # from the file, not stdin, for the images linked relative to it
+        cmd = ['rsvg-convert', '-f', 'pdf', '--dpi-x', str(dpi), '--dpi-y', str(dpi), '-o', pdf_file, svg_file]
+        subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+
+
+class CairoSVGBackend(SVGBackend):
+    name = 'cairosvg'
+
+    def available(self) -> bool:
+        if importlib.util.find_spec('cairosvg') is None:
+            return False
+        try:
+            import cairosvg  # noqa: F401
+        except OSError:
+            # installed without the cairo library
+            return False
+        return True
+
+    def convert(self, svg_file: str, pdf_file: str, dpi: int = 72):
+        import cairosvg
+
+        cairosvg.svg2pdf(url=svg_file, write_to=pdf_file, dpi=dpi)
+
+
+BACKENDS = OrderedDict((backend.name, backend) for backend in (InkscapeBackend(), RsvgBackend(), CairoSVGBackend()))
+
+
+def get_backend(name: str = None, pinned: bool = False) -> SVGBackend:
+    """ Return the backend `DOCSTAMP_SVG_BACKEND`, else `name`, else the
+    default one. A `pinned` backend `name` is never overridden.
+    """
+    override = os.environ.get('DOCSTAMP_SVG_BACKEND')
+    if pinned and name:
+        if override and override != name:
+            logger.warning(f'Ignoring DOCSTAMP_SVG_BACKEND={override}, these files need the {name} backend.')
+        override = None
+    name = override or name or DEFAULT_BACKEND
+    try:
+        return BACKENDS[name]
+    except KeyError:
+        raise ValueError(f'Unknown SVG backend {name}, use one of {list(BACKENDS)}.') from None
+
+
+def available_backends() -> List[SVGBackend]:
+    return [backend for backend in BACKENDS.values() if backend.available()]
+
+
+def convert(svg_file: str, pdf_file: str, backend: str, dpi: int = 72):
+    """ Convert `svg_file` to `pdf_file` with the `backend` named. """
+    BACKENDS[backend].convert(svg_file, pdf_file, dpi=dpi)
+
+
+def convert_files(svg_files: Iterable[str], backend: str, dpi: int = 72, remove: bool = False,
+                  workers: int = None) -> List[str]:
+    """ Convert `svg_files` to PDF files next to them, in parallel for the
+    command line backends, and return the PDF files.
+    """
+    svg_files = list(svg_files)
+    pdf_files = [os.path.splitext(svg_file)[0] + '.pdf' for svg_file in svg_files]
+    # cairosvg holds the GIL, threads would only add overhead
+    workers = 1 if backend == 'cairosvg' else workers or os.cpu_count()
+
+    def convert_one(files):
+        svg_file, pdf_file = files
+        convert(svg_file, pdf_file, backend, dpi)
+        if remove:
+            os.remove(svg_file)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(instrument.in_current_stages(convert_one), zip(svg_files, pdf_files)))
+    logger.info(f'Converted {len(svg_files)} SVG files to PDF with {backend}.')
+    return pdf_files
@@ -0,0 +1,78 @@
+"""
+In-process filling of the SVG templates, without a docstamp process per
+CSV file.
+
+`SVGTemplate` reads and compiles a template once and fills it with one
+record at a time, `rsvg_convert` converts the filled SVG content with the
+`rsvg-convert` (librsvg) command, the same one docstamp uses with
+`--unicode_support`.
+
+Only the values of the template placeholders are XML escaped, like
+docstamp does with the values of the CSV files, so the source files are
+never escaped in place.
+"""
+import os
+import subprocess
+from functools import lru_cache
+from typing import Dict, Iterable
+from xml.sax.saxutils import escape
+
+XML_ESCAPE_TABLE = {
+    '"': '&quot;',
+    "'": '&apos;',
+}
+
+
+# the companies, taglines and tickets repeat across attendees
+@lru_cache(maxsize=65536)
+def _escape(text: str) -> str:
+    return escape(text, XML_ESCAPE_TABLE)
+
+
+def xml_escape(value) -> str:
+    """ Return `value` as a string that can be put in an SVG text or attribute. """
+    if value is None or value != value:  # None or NaN
+        return ''
+    return _escape(str(value))
+
+
+def escape_fields(row: Dict[str, str], fields: Iterable[str]) -> Dict[str, str]:
+    """ Return a copy of `row` with the values of `fields` XML escaped. """
+    escaped = dict(row)
+    for field in fields:
+        if field in escaped:
+            escaped[field] = xml_escape(escaped[field])
+    return escaped
+
+
+class SVGTemplate:
+    """ A jinja2 SVG template, read and compiled once. """
+
+    def __init__(self, template_file: str):
+        import jinja2
+        import jinja2.meta
+
+        self.template_file = template_file
+        with open(template_file, encoding='utf-8') as svg:
+            self.source = svg.read()
+        environment = jinja2.Environment()
+        self.template = environment.from_string(self.source)
+        self.fields = sorted(jinja2.meta.find_undeclared_variables(environment.parse(self.source)))
+
+    @property
+    def name(self) -> str:
+        return os.path.splitext(os.path.basename(self.template_file))[0]
+
+    def fill(self, record: Dict[str, str]) -> str:
+        """ Return the SVG content with the XML escaped values of `record`. """
+        return self.template.render(**escape_fields(record, self.fields))
+
+
+def rsvg_convert(svg_content: str, output_type: str = 'pdf', dpi: int = 72) -> bytes:
+    """ Convert `svg_content` to `output_type` ('pdf', 'png', 'ps'...)
+    with `rsvg-convert` and return the converted file content.
+    """
+    cmd = ['rsvg-convert', '-f', output_type, '--dpi-x', str(dpi), '--dpi-y', str(dpi)]
+    process = subprocess.run(cmd, input=svg_content.encode('utf-8'),
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    return process.stdout
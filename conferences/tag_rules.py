@@ -0,0 +1,138 @@
+"""
+Declarative role assignment from the Ti.to tags.
+
+A rule table maps a pattern found in the tags to a role, with an explicit
+priority deciding the role of the rows matched by several rules:
+
+    ROLE_RULES = TagRules([
+        Rule('speaker', 'speaker', priority=30),
+        Rule('organizer', 'organizer', priority=20),
+        Rule('crew', 'crew', priority=10),
+    ], default='participant')
+
+    df['Tags'] = ROLE_RULES.classify(df.Tags).roles
+
+The rules are compiled once into a single regular expression that finds all
+the rules matching a value in one call, and each distinct tag value is only
+matched once, so the table is classified in one pass whatever the number of
+rules, and the result does not depend on the order of the rules.
+The tag values matched by no rule or by several rules are logged.
+
+A conference giving a badge per matching role, instead of one badge with the
+role of highest priority, selects the rows of each role with `members`:
+
+    for role, rows in ROLE_RULES.members(df.Tags).items():
+        df[rows].assign(Tags=role).to_csv(...)
+"""
+import logging
+import re
+from collections import OrderedDict, namedtuple
+from typing import Dict, Iterable, List, Tuple
+
+from conferences.dtypes import as_objects
+
+logger = logging.getLogger(__name__)
+
+Rule = namedtuple('Rule', ['pattern', 'role', 'priority', 'regex'], defaults=(False,))
+Rule.__doc__ = """ Assign `role` to the tags containing `pattern`, a plain
+substring unless `regex` is True. The matching rule with the highest
+`priority` wins.
+"""
+
+Classification = namedtuple('Classification', ['roles', 'unmatched', 'ambiguous'])
+Classification.__doc__ = """ Result of `TagRules.classify`.
+`roles`: Series with the role of each row, None when no rule matched.
+`unmatched`: {tag value: number of rows} matched by no rule.
+`ambiguous`: {tag value: (winning rule, other matching rules, number of rows)}
+matched by several rules.
+"""
+
+
+class TagRules:
+    """ Rule table assigning roles to tag values. Rows with empty tags get
+    the `default` role.
+    """
+    def __init__(self, rules: Iterable[Rule], default: str = None, ignore_case: bool = False):
+        self.rules = sorted(rules, key=lambda rule: rule.priority, reverse=True)
+        self.default = default
+
+        priorities = [rule.priority for rule in self.rules]
+        if len(set(priorities)) != len(priorities):
+            raise ValueError(f'Every rule must have a different priority, got {priorities}.')
+
+        # one optional lookahead per rule, all of them are tried at the start
+        # of the value, so the groups that matched are all the matching rules.
+        lookaheads = [
+            '(?:(?=.*?(?P<rule{}>{})))?'.format(idx, rule.pattern if rule.regex else re.escape(rule.pattern))
+            for idx, rule in enumerate(self.rules)
+        ]
+        self._matcher = re.compile(''.join(lookaheads), re.DOTALL | (re.IGNORECASE if ignore_case else 0))
+
+    @property
+    def roles(self) -> List[str]:
+        """ The roles, sorted by priority. """
+        roles = []
+        for rule in self.rules:
+            if rule.role not in roles:
+                roles.append(rule.role)
+        if self.default is not None and self.default not in roles:
+            roles.append(self.default)
+        return roles
+
+    def match(self, value: str) -> Tuple[Rule, ...]:
+        """ Return the rules matching `value`, highest priority first. """
+        groups = self._matcher.match(value).groups()
+        return tuple(rule for rule, group in zip(self.rules, groups) if group is not None)
+
+    def role(self, value: str):
+        """ Return the role for the tag `value`, None if no rule matches. """
+        if not value and self.default is not None:
+            return self.default
+        rules = self.match(value)
+        return rules[0].role if rules else None
+
+    def classify(self, tags) -> Classification:
+        """ Classify the pandas Series `tags`. """
+        tags = as_objects(tags).astype(str)
+        counts = tags.value_counts()
+
+        role_by_value = {}
+        unmatched = {}
+        ambiguous = {}
+        for value, count in counts.items():
+            if not value and self.default is not None:
+                role_by_value[value] = self.default
+                continue
+
+            rules = self.match(value)
+            role_by_value[value] = rules[0].role if rules else None
+            if not rules:
+                unmatched[value] = int(count)
+            elif len(rules) > 1:
+                ambiguous[value] = (rules[0], rules[1:], int(count))
+
+        for value, count in unmatched.items():
+            logger.warning(f'{count} rows with tags "{value}" are not matched by any rule.')
+        for value, (rule, others, count) in ambiguous.items():
+            other_roles = ', '.join(other.role for other in others)
+            logger.info(f'{count} rows with tags "{value}" matched several rules, '
+                        f'got role "{rule.role}" over {other_roles}.')
+
+        return Classification(roles=tags.map(role_by_value), unmatched=unmatched, ambiguous=ambiguous)
+
+    def members(self, tags) -> Dict[str, 'pandas.Series']:
+        """ Return {role: boolean Series} of the rows of the pandas Series
+        `tags` matched by a rule of each role, a row matched by the rules
+        of several roles is in all of them.
+        """
+        tags = as_objects(tags).astype(str)
+        roles_by_value = {}
+        for value in tags.unique():
+            if not value and self.default is not None:
+                roles_by_value[value] = {self.default}
+            else:
+                roles_by_value[value] = {rule.role for rule in self.match(value)}
+        return OrderedDict(
+            (role, tags.map({value: role in roles for value, roles in roles_by_value.items()}).astype(bool))
+            for role in self.roles
+        )
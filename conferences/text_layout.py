@@ -0,0 +1,437 @@
+"""
+Text fitting with the glyph advance widths of the template fonts.
+
+`MAXLENGTHS` splits the names and companies by number of characters, which
+overflows the badge with wide letters and leaves space with narrow ones.
+Here the width of the text is measured with the advance widths of the font of
+the template text element (read once from the TrueType/OpenType file, from
+the `fonts` folder or the system fonts), the text is broken in lines of the
+width of its box, shrunk down to a minimum font size if it still overflows,
+and shortened with an ellipsis as a last resort:
+
+    TEXT_BOXES = {
+        'first_name': TextBox(width=420, max_lines=1, min_font_size=16),
+        'company': TextBox(width=420, max_lines=2, min_font_size=10),
+        'full_name': TextBox(width=264, align='center'),
+    }
+
+    fitter = TextFitter(template_file, TEXT_BOXES)
+    df = fitter.fit_table(df)
+    template_file = fit_template(template_file, TEXT_BOXES, 'fitted_templates')
+
+`fit_table` gives the lines of each field (`<field>`, or `<field>1`,
+`<field>2`... for several lines), the `<field>_font_size` and, for
+centred boxes, the `<line>_x` of each line. `fit_template` writes a copy of
+the template using these columns, with the original values as default.
+Kerning is not taken into account.
+"""
+import functools
+import hashlib
+import logging
+import os
+import re
+import struct
+from collections import namedtuple
+from typing import Dict, List, Tuple
+
+from conferences import checkpoint
+
+logger = logging.getLogger(__name__)
+
+FONT_DIRS = [
+    *filter(None, os.environ.get('DOCSTAMP_FONT_DIRS', '').split(os.pathsep)),
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), 'fonts'),
+    os.path.expanduser('~/.fonts'),
+    os.path.expanduser('~/.local/share/fonts'),
+    '/usr/local/share/fonts',
+    '/usr/share/fonts',
+]
+
+FONT_EXTENSIONS = ('.ttf', '.otf')
+
+WEIGHT_NAMES = {
+    '100': 'thin',
+    '200': 'extralight',
+    '300': 'light',
+    'normal': 'regular',
+    '400': 'regular',
+    '500': 'medium',
+    '600': 'semibold',
+    'bold': 'bold',
+    '700': 'bold',
+    '800': 'extrabold',
+    '900': 'black',
+}
+
+# subfamily names of the regular style
+REGULAR_NAMES = ('regular', 'book', 'normal', 'roman', '')
+
+ELLIPSIS = '…'
+
+TextBox = namedtuple('TextBox', ['width', 'max_lines', 'min_font_size', 'align', 'x'],
+                     defaults=(1, None, 'start', None))
+TextBox.__doc__ = """ The box of a template text field: its `width`, the
+maximum number of lines, the minimum font size (the template font size when
+None), the alignment, 'start' or 'center', and the start `x` of the box
+(the x of the template text when None).
+"""
+
+Fit = namedtuple('Fit', ['lines', 'font_size', 'widths'])
+
+TextStyle = namedtuple('TextStyle', ['font_family', 'font_weight', 'font_style', 'font_size', 'x'])
+
+
+class FontMetrics:
+    """ The advance widths of the glyphs of a TrueType/OpenType font file. """
+
+    def __init__(self, font_file: str):
+        self.font_file = font_file
+        with open(font_file, 'rb') as font:
+            self.data = font.read()
+        self.tables = _table_offsets(self.data)
+
+        self.units_per_em = struct.unpack_from('>H', self.data, self.tables['head'] + 18)[0]
+        n_metrics = struct.unpack_from('>H', self.data, self.tables['hhea'] + 34)[0]
+        self.advances = [advance for advance, _ in struct.iter_unpack(
+            '>Hh', self.data[self.tables['hmtx']:self.tables['hmtx'] + 4 * n_metrics]
+        )]
+        self.glyphs = _read_cmap(self.data, self.tables['cmap'])
+        self._widths = {}
+
+    def char_width(self, char: str) -> float:
+        """ Return the advance width of `char` for a font size of 1. """
+        width = self._widths.get(char)
+        if width is None:
+            glyph = self.glyphs.get(ord(char), 0)
+            advance = self.advances[min(glyph, len(self.advances) - 1)]
+            width = self._widths[char] = advance / self.units_per_em
+        return width
+
+    def text_width(self, text: str, font_size: float = 1.0) -> float:
+        return sum(self.char_width(char) for char in text) * font_size
+
+
+def _table_offsets(data: bytes) -> Dict[str, int]:
+    n_tables = struct.unpack_from('>H', data, 4)[0]
+    offsets = {}
+    for idx in range(n_tables):
+        tag, _, offset, _ = struct.unpack_from('>4sIII', data, 12 + 16 * idx)
+        offsets[tag.decode('latin-1')] = offset
+    return offsets
+
+
+def _read_cmap(data: bytes, cmap: int) -> Dict[int, int]:
+    """ Return the code point -> glyph id mapping of the best unicode subtable. """
+    n_subtables = struct.unpack_from('>H', data, cmap + 2)[0]
+    subtables = {}
+    for idx in range(n_subtables):
+        platform, encoding, offset = struct.unpack_from('>HHI', data, cmap + 4 + 8 * idx)
+        subtable = cmap + offset
+        subtables[(platform, encoding, struct.unpack_from('>H', data, subtable)[0])] = subtable
+
+    for key in [(3, 10, 12), (0, 4, 12), (0, 6, 12), (3, 1, 4), (0, 3, 4), (0, 1, 4), (0, 0, 4)]:
+        if key in subtables:
+            read = _read_cmap_format12 if key[2] == 12 else _read_cmap_format4
+            return read(data, subtables[key])
+    raise ValueError('No unicode character map in the font.')
+
+
+def _read_cmap_format4(data: bytes, subtable: int) -> Dict[int, int]:
+    seg_count = struct.unpack_from('>H', data, subtable + 6)[0] // 2
+    ends = struct.unpack_from(f'>{seg_count}H', data, subtable + 14)
+    starts = struct.unpack_from(f'>{seg_count}H', data, subtable + 16 + 2 * seg_count)
+    deltas = struct.unpack_from(f'>{seg_count}h', data, subtable + 16 + 4 * seg_count)
+    range_offsets_start = subtable + 16 + 6 * seg_count
+    range_offsets = struct.unpack_from(f'>{seg_count}H', data, range_offsets_start)
+
+    glyphs = {}
+    for idx, (start, end, delta, range_offset) in enumerate(zip(starts, ends, deltas, range_offsets)):
+        for code in range(start, min(end, 0xFFFE) + 1):
+            if range_offset == 0:
+                glyph = (code + delta) & 0xFFFF
+            else:
+                address = range_offsets_start + 2 * idx + range_offset + 2 * (code - start)
+                glyph = struct.unpack_from('>H', data, address)[0]
+                glyph = (glyph + delta) & 0xFFFF if glyph else 0
+            if glyph:
+                glyphs[code] = glyph
+    return glyphs
+
+
+def _read_cmap_format12(data: bytes, subtable: int) -> Dict[int, int]:
+    n_groups = struct.unpack_from('>I', data, subtable + 12)[0]
+    glyphs = {}
+    for idx in range(n_groups):
+        start, end, glyph = struct.unpack_from('>III', data, subtable + 16 + 12 * idx)
+        for code in range(start, end + 1):
+            glyphs[code] = glyph + code - start
+    return glyphs
+
+
+def _read_names(font_file: str) -> Dict[int, str]:
+    """ Return the family (1, 16), subfamily (2, 17), full (4) and
+    PostScript (6) names of `font_file`.
+    """
+    with open(font_file, 'rb') as font:
+        data = font.read()
+    name = _table_offsets(data)['name']
+    count, string_offset = struct.unpack_from('>HH', data, name + 2)
+
+    names = {}
+    for idx in range(count):
+        platform, encoding, language, name_id, length, offset = struct.unpack_from('>6H', data, name + 6 + 12 * idx)
+        if name_id not in (1, 2, 4, 6, 16, 17) or name_id in names:
+            continue
+        raw = data[name + string_offset + offset:name + string_offset + offset + length]
+        if platform in (0, 3):
+            names[name_id] = raw.decode('utf-16-be', errors='replace')
+        elif platform == 1:
+            names[name_id] = raw.decode('latin-1')
+    return names
+
+
+def _simplify(name: str) -> str:
+    return re.sub(r'[\s_-]', '', name).lower()
+
+
+@functools.lru_cache(maxsize=None)
+def font_index(font_dirs: Tuple[str, ...] = tuple(FONT_DIRS)) -> List[Tuple[str, str, str, str]]:
+    """ Return (family, subfamily, full or PostScript name, file) of the fonts in `font_dirs`. """
+    index = []
+    for font_dir in font_dirs:
+        for root, _, files in os.walk(font_dir):
+            for file_name in sorted(files):
+                if not file_name.lower().endswith(FONT_EXTENSIONS):
+                    continue
+                font_file = os.path.join(root, file_name)
+                try:
+                    names = _read_names(font_file)
+                except (KeyError, struct.error, OSError):
+                    logger.debug(f'Could not read the names of the font {font_file}.')
+                    continue
+                family = names.get(16, names.get(1, ''))
+                subfamily = names.get(17, names.get(2, ''))
+                for name in {names.get(4, ''), names.get(6, '')}:
+                    index.append((_simplify(family), _simplify(subfamily), _simplify(name), font_file))
+    return index
+
+
+def find_font_file(font_family: str, font_weight: str = 'normal', font_style: str = 'normal') -> str:
+    """ Return the font file of the first family of the CSS `font_family`
+    found in `FONT_DIRS`, with the closest weight and style.
+    """
+    subfamily = WEIGHT_NAMES.get(str(font_weight).lower(), 'regular')
+    if font_style in ('italic', 'oblique'):
+        subfamily = 'italic' if subfamily == 'regular' else f'{subfamily}italic'
+
+    index = font_index()
+    for family in font_family.split(','):
+        family = _simplify(family.strip().strip('\'"'))
+        for _, _, name, font_file in index:
+            if family == name:
+                return font_file
+
+        candidates = [(font_subfamily, font_file) for font_family, font_subfamily, _, font_file in index
+                      if family == font_family]
+        for font_subfamily, font_file in candidates:
+            if font_subfamily == subfamily or (subfamily == 'regular' and font_subfamily in REGULAR_NAMES):
+                return font_file
+        if candidates:
+            font_file = sorted(candidates, key=lambda candidate: candidate[0] not in REGULAR_NAMES)[0][1]
+            logger.debug(f'No {subfamily} font for {family}, using {font_file}.')
+            return font_file
+
+    raise FileNotFoundError(f'Could not find the font "{font_family}" in {FONT_DIRS}.')
+
+
+@functools.lru_cache(maxsize=None)
+def font_metrics(font_family: str, font_weight: str = 'normal', font_style: str = 'normal') -> FontMetrics:
+    return FontMetrics(find_font_file(font_family, font_weight, font_style))
+
+
+def _text_element(svg: str, line_field: str):
+    """ Return the match of the `<text>` element holding `{{ line_field }}`. """
+    pattern = r'<text\b(?:(?!</text>).)*?\{\{\s*' + re.escape(line_field) + r'\s*\}\}.*?</text>'
+    return re.search(pattern, svg, re.DOTALL)
+
+
+def _style(element: str) -> Dict[str, str]:
+    """ Return the CSS properties of the style attributes in `element`,
+    the inner ones overriding the outer ones.
+    """
+    style = {}
+    for attribute in re.findall(r'\bstyle="([^"]*)"', element):
+        for declaration in attribute.split(';'):
+            if ':' in declaration:
+                key, value = declaration.split(':', 1)
+                style[key.strip()] = value.strip()
+    return style
+
+
+def line_fields(field: str, box: TextBox) -> List[str]:
+    """ Return the template fields of the lines of `field`. """
+    if box.max_lines == 1:
+        return [field]
+    return [f'{field}{line}' for line in range(1, box.max_lines + 1)]
+
+
+def text_style(svg: str, field: str, box: TextBox) -> TextStyle:
+    """ Return the style of the text element of the first line of `field` in `svg`. """
+    element = _text_element(svg, line_fields(field, box)[0])
+    if element is None:
+        raise KeyError(f'No text element with the field {field} in the template.')
+    style = _style(element.group(0))
+    x = re.search(r'\bx="([-\d.]+)"', element.group(0))
+    return TextStyle(
+        font_family=style.get('font-family', 'sans-serif'),
+        font_weight=style.get('font-weight', 'normal'),
+        font_style=style.get('font-style', 'normal'),
+        font_size=float(style.get('font-size', '16px').rstrip('px')),
+        x=float(x.group(1)) if x else 0.0,
+    )
+
+
+def break_lines(words: List[str], widths: List[float], space: float, max_width: float) -> List[List[str]]:
+    """ Greedy line breaking of `words` of `widths` in lines of `max_width`. """
+    lines = []
+    line, line_width = [], 0.0
+    for word, width in zip(words, widths):
+        if line and line_width + space + width > max_width:
+            lines.append(line)
+            line, line_width = [], 0.0
+        line_width += (space if line else 0.0) + width
+        line.append(word)
+    if line:
+        lines.append(line)
+    return lines
+
+
+def ellipsize(text: str, metrics: FontMetrics, max_width: float) -> str:
+    """ Return `text` shortened with an ellipsis to fit `max_width` (font size 1). """
+    if metrics.text_width(text) <= max_width:
+        return text
+    width = metrics.char_width(ELLIPSIS)
+    for end, char in enumerate(text):
+        width += metrics.char_width(char)
+        if width > max_width:
+            return text[:end].rstrip() + ELLIPSIS
+    return text
+
+
+def fit_text(text: str, metrics: FontMetrics, font_size: float, box: TextBox) -> Fit:
+    """ Break `text` in at most `box.max_lines` lines of `box.width`, with the
+    largest font size between `box.min_font_size` and `font_size`.
+    """
+    words = str(text).split()
+    if not words:
+        return Fit(lines=[''] * box.max_lines, font_size=font_size, widths=[0.0] * box.max_lines)
+
+    min_font_size = box.min_font_size or font_size
+    widths = [metrics.text_width(word) for word in words]
+    space = metrics.char_width(' ')
+
+    size = font_size
+    while True:
+        lines = break_lines(words, widths, space, box.width / size)
+        longest = max(metrics.text_width(' '.join(line)) for line in lines)
+        if len(lines) <= box.max_lines and longest * size <= box.width:
+            break
+        if size <= min_font_size:
+            lines = lines[:box.max_lines - 1] + [[' '.join(' '.join(line) for line in lines[box.max_lines - 1:])]]
+            break
+        # a single line scales exactly, several lines can break differently
+        size = max(min_font_size, min(size * 0.95, box.width / longest))
+
+    lines = [ellipsize(' '.join(line), metrics, box.width / size) for line in lines]
+    lines += [''] * (box.max_lines - len(lines))
+    return Fit(lines=lines, font_size=round(size, 2), widths=[metrics.text_width(line, size) for line in lines])
+
+
+class TextFitter:
+    """ Fits the fields of `boxes` in the text elements of `template_file`. """
+
+    def __init__(self, template_file: str, boxes: Dict[str, TextBox]):
+        with open(template_file, encoding='utf-8') as svg:
+            source = svg.read()
+        self.boxes = boxes
+        self.styles = {field: text_style(source, field, box) for field, box in boxes.items()}
+        self.metrics = {field: font_metrics(style.font_family, style.font_weight, style.font_style)
+                        for field, style in self.styles.items()}
+        self._fits = {}
+
+    def fit(self, field: str, value: str) -> Fit:
+        fit = self._fits.get((field, value))
+        if fit is None:
+            fit = fit_text(value, self.metrics[field], self.styles[field].font_size, self.boxes[field])
+            self._fits[(field, value)] = fit
+        return fit
+
+    def line_x(self, field: str, width: float) -> float:
+        """ Return the x of a line of `width` centred in the box of `field`. """
+        box = self.boxes[field]
+        x = self.styles[field].x if box.x is None else box.x
+        return round(x + (box.width - width) / 2, 3)
+
+    def fit_record(self, record: Dict[str, str]) -> Dict[str, str]:
+        """ Return the lines, font sizes and offsets of the fields of `record`. """
+        fitted = {}
+        for field, box in self.boxes.items():
+            value = record.get(field, '')
+            fit = self.fit(field, '' if value is None or value != value else str(value))
+            fitted[f'{field}_font_size'] = fit.font_size
+            for line_field, line, width in zip(line_fields(field, box), fit.lines, fit.widths):
+                fitted[line_field] = line
+                if box.align == 'center':
+                    fitted[f'{line_field}_x'] = self.line_x(field, width)
+        return fitted
+
+    def fit_table(self, df):
+        """ Add the fitted columns of each field to `df`, each distinct value
+        is fitted once.
+        """
+        for field, box in self.boxes.items():
+            values = df[field].fillna('').astype(str)
+            fits = {value: self.fit(field, value) for value in values.unique()}
+            df[f'{field}_font_size'] = values.map(lambda value: fits[value].font_size)
+            for idx, line_field in enumerate(line_fields(field, box)):
+                df[line_field] = values.map(lambda value: fits[value].lines[idx])
+                if box.align == 'center':
+                    df[f'{line_field}_x'] = values.map(lambda value: self.line_x(field, fits[value].widths[idx]))
+        return df
+
+
+def fit_template(template_file: str, boxes: Dict[str, TextBox], output_dir: str) -> str:
+    """ Write a copy of `template_file` that takes the font sizes and line
+    offsets of `TextFitter`, and return its path. The copy keeps the name of
+    the template, docstamp names the files after it, in a folder of
+    `output_dir` named by the digest of the template and of the `boxes`.
+    """
+    with open(template_file, encoding='utf-8') as svg:
+        source = svg.read()
+
+    digest = hashlib.sha256(source.encode('utf-8'))
+    digest.update(repr(sorted(boxes.items())).encode('utf-8'))
+    output_file = os.path.join(output_dir, digest.hexdigest()[:16], os.path.basename(template_file))
+    if os.path.exists(output_file):
+        return output_file
+
+    for field, box in boxes.items():
+        for line_field in line_fields(field, box):
+            element = _text_element(source, line_field)
+            if element is None:
+                continue
+            text = re.sub(r'font-size:([\d.]+)px',
+                          lambda size: f'font-size:{{{{ {field}_font_size|default({size.group(1)}) }}}}px',
+                          element.group(0))
+            if box.align == 'center':
+                text = re.sub(r'\bx="([-\d.]+)"',
+                              lambda x: f'x="{{{{ {line_field}_x|default({x.group(1)}) }}}}"',
+                              text)
+            source = source[:element.start()] + text + source[element.end():]
+
+    # the work queue and batch workers can fit the same template at the same time
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    with checkpoint.atomic_output(output_file, unique=True) as partial_file:
+        with open(partial_file, 'w', encoding='utf-8') as svg:
+            svg.write(source)
+    return output_file
@@ -0,0 +1,357 @@
+"""
+Incremental ingestion of the tickets from the Ti.to API.
+
+Instead of exporting the whole attendee list from the Ti.to dashboard for
+every run, `ingest_tickets` pulls the tickets updated since the last run
+page by page, keeps every ticket in a local SQLite store and writes only the
+rows that changed, with the columns of the "Export attendees" CSV file, so
+`filter_tickets` and `rename_columns` (or `split_users_csv`) read it as is:
+
+    TITO_API_TOKEN=... inv ingest-tickets --account euroscipy --event 2019 --output-file tito_changes.csv
+    inv all --input-file tito_changes.csv
+
+The tickets come from the API, any server answering like it
+(`--api-url http://127.0.0.1:8043` with `inv serve-tito-fixtures`), or
+pages recorded with `--record-dir` and read back with `--fixtures-dir`.
+A ticket is only written when its row differs from the stored one, the
+cursor only moves when the changes are written, and the cursor is
+inclusive, so a ticket updated twice in the same second is never missed.
+"""
+import csv
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+from datetime import datetime
+from glob import glob
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional
+
+from conferences import checkpoint
+from conferences.instrument import task
+
+logger = logging.getLogger(__name__)
+
+API_URL = 'https://api.tito.io/v3'
+
+PAGE_SIZE = 100
+
+UPDATED_SINCE_PARAM = 'search[updated_since]'
+
+STORE_FILE = 'tito_store.sqlite'
+
+RETRIES = 4
+
+# the Ti.to export writes the dates like this
+EXPORT_DATE_FORMAT = '%d %b %Y %H:%M'
+
+# the export columns of the answers to the Ti.to questions, by question slug
+QUESTION_COLUMNS = {
+    'tagline': 'Tagline',
+    'badge-information': 'Badge information',
+}
+
+
+def parse_datetime(value: str) -> Optional[datetime]:
+    if not value:
+        return None
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def _export_date(value: str) -> str:
+    parsed = parse_datetime(value)
+    return parsed.strftime(EXPORT_DATE_FORMAT) if parsed else ''
+
+
+def _tags(ticket: dict) -> str:
+    tags = ticket.get('tags') or ''
+    return ', '.join(tags) if isinstance(tags, list) else tags
+
+
+def _answer(ticket: dict, slug: str) -> str:
+    responses = ticket.get('responses') or {}
+    if isinstance(responses, list):
+        responses = {response.get('question_slug') or response.get('slug'): response.get('response')
+                     for response in responses}
+    answer = responses.get(slug) or ''
+    return ', '.join(answer) if isinstance(answer, list) else str(answer)
+
+
+def ticket_row(ticket: dict) -> Dict[str, str]:
+    """ Return the row of the Ti.to export of the API `ticket`. """
+    registration = ticket.get('registration') or {}
+    row = OrderedDict([
+        ('Number', str(ticket.get('number') or '')),
+        ('Ticket', ticket.get('release_title') or (ticket.get('release') or {}).get('title') or ''),
+        ('Ticket Full Name', ticket.get('name') or ''),
+        ('Ticket First Name', ticket.get('first_name') or ''),
+        ('Ticket Last Name', ticket.get('last_name') or ''),
+        ('Ticket Email', ticket.get('email') or ''),
+        ('Ticket Company Name', ticket.get('company_name') or ''),
+        ('Tags', _tags(ticket)),
+        ('Order Reference', registration.get('reference') or ticket.get('registration_reference') or ''),
+        ('Ticket Reference', ticket.get('reference') or ''),
+        ('Ticket Created Date', _export_date(ticket.get('created_at'))),
+        ('Ticket Last Updated Date', _export_date(ticket.get('updated_at'))),
+        ('Ticket Phone Number', ticket.get('phone_number') or ''),
+        ('Void Status', 'void' if ticket.get('void') or ticket.get('state') == 'void' else ''),
+        ('Price', str(ticket.get('price') or '')),
+        ('Discount Status', 'discounted' if ticket.get('discount_code_used') else ''),
+        ('Unique Ticket URL', ticket.get('unique_url') or ''),
+        ('Order Name', registration.get('name') or ''),
+        ('Order Email', registration.get('email') or ''),
+        ('Order Company Name', registration.get('company_name') or ''),
+        ('Order Discount Code', ticket.get('discount_code_used') or ''),
+        ('Order Created Date', _export_date(registration.get('created_at'))),
+        ('Payment Reference', registration.get('payment_reference') or ''),
+    ])
+    for slug, column in QUESTION_COLUMNS.items():
+        row[column] = _answer(ticket, slug)
+    return row
+
+
+def _updated_since(tickets: Iterator[dict], updated_since: Optional[str]) -> Iterator[dict]:
+    since = parse_datetime(updated_since)
+    for ticket in tickets:
+        if since is None or parse_datetime(ticket['updated_at']) >= since:
+            yield ticket
+
+
+class TitoAPI:
+    """ The tickets of `account`/`event` from the Ti.to admin API at `api_url`. """
+    def __init__(self, account: str, event: str, token: str = '', api_url: str = API_URL,
+                 page_size: int = PAGE_SIZE, record_dir: str = None):
+        self.url = f'{api_url.rstrip("/")}/{account}/{event}/tickets'
+        self.token = token
+        self.page_size = page_size
+        self.record_dir = record_dir
+
+    def _get(self, url: str) -> dict:
+        request = urllib.request.Request(url, headers={
+            'Accept': 'application/json',
+            'Authorization': f'Token token={self.token}',
+        })
+        for attempt in range(RETRIES):
+            try:
+                with urllib.request.urlopen(request, timeout=60) as response:
+                    return json.loads(response.read().decode('utf-8'))
+            except urllib.error.HTTPError as exc:
+                if exc.code != 429 and exc.code < 500 or attempt == RETRIES - 1:
+                    raise
+                wait = float(exc.headers.get('Retry-After') or 2 ** attempt)
+            except urllib.error.URLError:
+                if attempt == RETRIES - 1:
+                    raise
+                wait = 2 ** attempt
+            logger.warning(f'Retrying {url} in {wait:.0f} s.')
+            time.sleep(wait)
+
+    def pages(self, updated_since: str = None) -> Iterator[dict]:
+        """ Yield the pages of tickets updated since `updated_since`, all of them if None. """
+        number = 1
+        while number:
+            params = {'page[number]': number, 'page[size]': self.page_size}
+            if updated_since:
+                params[UPDATED_SINCE_PARAM] = updated_since
+            page = self._get(f'{self.url}?{urllib.parse.urlencode(params)}')
+            if self.record_dir:
+                os.makedirs(self.record_dir, exist_ok=True)
+                with open(os.path.join(self.record_dir, f'tickets-{number:04d}.json'), 'w') as recording:
+                    json.dump(page, recording)
+            yield page
+            number = (page.get('meta') or {}).get('next_page')
+
+    def tickets(self, updated_since: str = None) -> Iterator[dict]:
+        for page in self.pages(updated_since):
+            # the cursor is inclusive whatever the server does with it
+            yield from _updated_since(page['tickets'], updated_since)
+
+
+class FixtureTickets:
+    """ The tickets of the pages recorded in `fixtures_dir`. """
+    def __init__(self, fixtures_dir: str):
+        self.page_files = sorted(glob(os.path.join(fixtures_dir, 'tickets-*.json')))
+        if not self.page_files:
+            raise FileNotFoundError(f'No tickets-*.json pages in {fixtures_dir}.')
+
+    def all_tickets(self) -> List[dict]:
+        tickets = []
+        for page_file in self.page_files:
+            with open(page_file, encoding='utf-8') as page:
+                tickets.extend(json.load(page)['tickets'])
+        return tickets
+
+    def tickets(self, updated_since: str = None) -> Iterator[dict]:
+        return _updated_since(self.all_tickets(), updated_since)
+
+
+class TicketStore:
+    """ The last row seen of every ticket and the cursor of the next pull. """
+    def __init__(self, store_file: str = STORE_FILE):
+        self.db = sqlite3.connect(store_file)
+        self.db.execute('CREATE TABLE IF NOT EXISTS tickets '
+                        '(id TEXT PRIMARY KEY, updated_at TEXT, digest TEXT, row TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)')
+
+    @property
+    def updated_since(self) -> Optional[str]:
+        found = self.db.execute("SELECT value FROM state WHERE key = 'updated_since'").fetchone()
+        return found[0] if found else None
+
+    def digests(self) -> Dict[str, str]:
+        return dict(self.db.execute('SELECT id, digest FROM tickets'))
+
+    def rows(self) -> Dict[str, Dict[str, str]]:
+        return OrderedDict((ticket_id, json.loads(row, object_pairs_hook=OrderedDict))
+                           for ticket_id, row in self.db.execute('SELECT id, row FROM tickets ORDER BY rowid'))
+
+    def save(self, tickets: List[tuple], updated_since: Optional[str]):
+        """ Store the (id, updated_at, digest, row) `tickets` and the cursor, in one transaction. """
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO tickets VALUES (?, ?, ?, ?)', tickets)
+            if updated_since:
+                self.db.execute("INSERT OR REPLACE INTO state VALUES ('updated_since', ?)", (updated_since,))
+
+    def close(self):
+        self.db.close()
+
+
+def digest(row: Dict[str, str]) -> str:
+    return hashlib.sha1(json.dumps(row, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def write_rows(output_file: str, rows: List[Dict[str, str]], columns: List[str], delimiter: str = ','):
+    with checkpoint.atomic_output(output_file) as partial_file:
+        with open(partial_file, 'w', newline='', encoding='utf-8') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=columns, delimiter=delimiter)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def ingest(source, store: TicketStore, output_file: str, full: bool = False, group_by: str = None,
+           delimiter: str = ',') -> int:
+    """ Pull the tickets of `source` updated since the last pull into `store`
+    and write the rows that changed to `output_file`, or all the rows if
+    `full`. With `group_by`, a column like "Ticket Email", the stored rows
+    sharing its value with a changed row are written too, `merge_tickets`
+    merges them again. Return the number of changed tickets.
+    """
+    updated_since = store.updated_since
+    digests = store.digests()
+    last_updated = parse_datetime(updated_since)
+    cursor = updated_since
+
+    changed = OrderedDict()
+    pulled = 0
+    for ticket in source.tickets(updated_since):
+        pulled += 1
+        row = ticket_row(ticket)
+        ticket_id = str(ticket.get('id') or ticket.get('slug') or row['Ticket Reference'])
+        row_digest = digest(row)
+        if digests.get(ticket_id) != row_digest:
+            changed[ticket_id] = (ticket_id, ticket.get('updated_at'), row_digest, json.dumps(row))
+            digests[ticket_id] = row_digest
+
+        updated = parse_datetime(ticket.get('updated_at'))
+        if updated and (last_updated is None or updated > last_updated):
+            last_updated, cursor = updated, ticket['updated_at']
+
+    changed_rows = OrderedDict((ticket_id, json.loads(row, object_pairs_hook=OrderedDict))
+                               for ticket_id, (*_, row) in changed.items())
+    if full:
+        rows = store.rows()
+        rows.update(changed_rows)
+        rows = list(rows.values())
+    elif group_by:
+        groups = {row[group_by] for row in changed_rows.values()}
+        rows = list(changed_rows.values()) + [row for ticket_id, row in store.rows().items()
+                                              if row[group_by] in groups and ticket_id not in changed_rows]
+    else:
+        rows = list(changed_rows.values())
+
+    columns = list(ticket_row({}))
+    # the changes are written before the cursor moves, a failed run pulls them again
+    write_rows(output_file, rows, columns, delimiter=delimiter)
+    store.save(list(changed.values()), cursor)
+    logger.info(f'Pulled {pulled} tickets updated since {updated_since or "the start"}, {len(changed)} changed, '
+                f'wrote {len(rows)} rows to {output_file}.')
+    return len(changed)
+
+
+@task
+def ingest_tickets(ctx, output_file='tito_changes.csv', account=None, event=None, api_url=API_URL,
+                   fixtures_dir=None, record_dir=None, store_file=STORE_FILE, full=False, group_by=None,
+                   delimiter=','):
+    """ Write the tickets changed since the last ingestion to `output_file`.
+    The API token is read from the TITO_API_TOKEN environment variable.
+    """
+    if fixtures_dir:
+        source = FixtureTickets(fixtures_dir)
+    else:
+        account = account or os.environ.get('TITO_ACCOUNT')
+        event = event or os.environ.get('TITO_EVENT')
+        if not account or not event:
+            raise ValueError('Give the Ti.to --account and --event, or --fixtures-dir.')
+        source = TitoAPI(account, event, token=os.environ.get('TITO_API_TOKEN', ''), api_url=api_url,
+                         record_dir=record_dir)
+
+    store = TicketStore(store_file)
+    try:
+        ingest(source, store, output_file, full=full, group_by=group_by, delimiter=delimiter)
+    finally:
+        store.close()
+
+
+def make_fixtures_handler(fixtures: FixtureTickets):
+    class TitoFixturesHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            if not url.path.endswith('/tickets'):
+                return self._send_json(404, {'error': f'Unknown path {url.path}.'})
+
+            params = dict(urllib.parse.parse_qsl(url.query))
+            number = int(params.get('page[number]', 1))
+            size = int(params.get('page[size]', PAGE_SIZE))
+            tickets = list(fixtures.tickets(params.get(UPDATED_SINCE_PARAM)))
+            total_pages = max(1, (len(tickets) + size - 1) // size)
+            self._send_json(200, {
+                'tickets': tickets[(number - 1) * size:number * size],
+                'meta': {
+                    'current_page': number,
+                    'next_page': number + 1 if number < total_pages else None,
+                    'total_pages': total_pages,
+                    'total_count': len(tickets),
+                },
+            })
+
+        def _send_json(self, status: int, content):
+            body = json.dumps(content).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return TitoFixturesHandler
+
+
+@task
+def serve_tito_fixtures(ctx, fixtures_dir, host='127.0.0.1', port=8043):
+    """ Serve the recorded pages of `fixtures_dir` like the tickets endpoint of the Ti.to API. """
+    server = ThreadingHTTPServer((host, int(port)), make_fixtures_handler(FixtureTickets(fixtures_dir)))
+    logger.info(f'Serving the tickets of {fixtures_dir} on http://{host}:{port}/<account>/<event>/tickets')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
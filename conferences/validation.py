@@ -0,0 +1,223 @@
+"""
+Checks of the split attendee tables against the badge templates, before
+anything is rendered.
+
+Every role file is read with the `csv` module and cross-checked with the
+`{{ ... }}` placeholders of the template of its role, so a missing template,
+a placeholder without column, an empty or duplicated file name field or a
+value that will not fit show up in milliseconds instead of after docstamp
+ran for minutes:
+
+    validation.validate_badges({'speaker': ('tito_speaker.csv', 'templates/speaker.svg')},
+                               filename_field='email', max_lengths=MAXLENGTHS)
+
+Problems that break the run or print broken badges (a role without
+template, a placeholder without column, empty or duplicated file names...)
+raise a `ValidationError` listing all of them. The ones that only print a
+badge badly, or leave attendees with tags of no role without badge as the
+split always did, are logged as warnings, or raised too with `strict=True`.
+"""
+import csv
+import logging
+import os
+import re
+import time
+from collections import OrderedDict, defaultdict
+from typing import Dict, List, Tuple
+
+from conferences.text_layout import ELLIPSIS
+
+logger = logging.getLogger(__name__)
+
+PLACEHOLDER = re.compile(r'{{\s*(?P<name>[A-Za-z_]\w*)\s*(?P<default>\|\s*default\b)?')
+
+# XML 1.0 does not allow these, rsvg-convert and Inkscape refuse the file
+INVALID_XML_CHARS = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+# docstamp escapes the values, an entity in the data is printed as is
+XML_ENTITY = re.compile(r'&(?:amp|lt|gt|quot|apos|#\d+|#x[0-9a-fA-F]+);')
+
+# separators and control characters, a file name value with them would write
+# outside the output folder or break the headers of the badge server
+NOT_FILE_NAME_CHARS = re.compile(r'[/\\\x00-\x1f\x7f]')
+
+# the number of rows quoted in each message
+EXAMPLES = 5
+
+
+class ValidationError(ValueError):
+    pass
+
+
+def template_placeholders(template_file: str) -> Dict[str, bool]:
+    """ Return the placeholders of `template_file`, mapped to True for the
+    ones with a `default`, that can be left out of the table.
+    """
+    with open(template_file, encoding='utf-8') as svg:
+        source = svg.read()
+
+    placeholders = {}
+    for match in PLACEHOLDER.finditer(source):
+        name = match.group('name')
+        placeholders[name] = placeholders.get(name, True) and match.group('default') is not None
+    return placeholders
+
+
+def count_rows(input_file: str, delimiter: str = ',') -> int:
+    """ Return the number of records of the CSV `input_file`. """
+    with open(input_file, newline='', encoding='utf-8') as csvfile:
+        return sum(1 for _ in csv.DictReader(csvfile, delimiter=delimiter))
+
+
+def is_file_name(name: str) -> bool:
+    """ Return whether the `name` value of the filename field, without its
+    spaces, can name a badge file in the output folder.
+    """
+    return name not in ('', '.', '..') and not NOT_FILE_NAME_CHARS.search(name)
+
+
+def _line_limit(field: str, max_lengths: Dict[str, int]):
+    """ Return the field `max_lengths` applies to for `field`, or one of its
+    lines `field1`, `field2`...
+    """
+    if field in max_lengths:
+        return field
+    base = field.rstrip('0123456789')
+    return base if base != field and base in max_lengths else None
+
+
+def _examples(items: List) -> str:
+    shown = ', '.join(str(item) for item in items[:EXAMPLES])
+    return shown + (f' and {len(items) - EXAMPLES} more' if len(items) > EXAMPLES else '')
+
+
+def validate_badges(role_files: Dict[str, Tuple[str, str]], filename_field: str,
+                    max_lengths: Dict[str, int] = None, expected_rows: int = None, strict: bool = False):
+    """ Check the `role_files` {role: (CSV file, template file)} before the
+    badges are rendered, docstamp names each badge after its template and
+    `filename_field`. The values longer than `max_lengths` {column: number
+    of characters} are reported, unless the table has the font size column
+    of a fitted field. `expected_rows` is the number of attendees that were
+    split in the role files.
+    """
+    start = time.perf_counter()
+    max_lengths = {field.replace(' ', '_'): length for field, length in (max_lengths or {}).items()}
+
+    errors = []
+    warnings = []
+    output_files = {}
+    case_collisions = []
+    total_rows = 0
+
+    for role, (input_file, template_file) in role_files.items():
+        if not os.path.exists(input_file):
+            errors.append(f'{role}: the attendees file {input_file} does not exist, run `split_users_csv` first.')
+            continue
+
+        with open(input_file, newline='', encoding='utf-8') as csvfile:
+            reader = csv.DictReader(csvfile)
+            columns = reader.fieldnames or []
+            rows = list(reader)
+        total_rows += len(rows)
+        if not rows:
+            continue
+
+        if not os.path.exists(template_file):
+            errors.append(f'{role}: {len(rows)} attendees and no badge template {template_file}.')
+            continue
+
+        placeholders = template_placeholders(template_file)
+        missing = [name for name, optional in placeholders.items() if not optional and name not in columns]
+        if missing:
+            errors.append(f'{role}: {template_file} has the placeholders {missing} '
+                          f'and {input_file} no such columns, they would be printed empty.')
+
+        if filename_field not in columns:
+            errors.append(f'{role}: {input_file} has no column {filename_field} to name the badge files.')
+            continue
+
+        basename = os.path.splitext(os.path.basename(template_file))[0]
+        printed = [name for name in placeholders if name in columns]
+        limits = {name: _line_limit(name, max_lengths) for name in printed}
+        # the fields fitted by `text_layout` have a font size column and are measured, not counted
+        limits = {name: field for name, field in limits.items()
+                  if field is not None and f'{field}_font_size' not in columns}
+
+        empty_names, bad_names, collisions = [], [], []
+        invalid_chars, entities, overflows, shortened = [], [], [], []
+        for line, row in enumerate(rows, start=2):
+            where = f'{input_file}:{line}'
+            name = (row[filename_field] or '').replace(' ', '')
+            if not name:
+                empty_names.append(where)
+            elif not is_file_name(name):
+                bad_names.append(f'{where} {name!r}')
+            else:
+                output_file = f'{basename}_{name}'
+                if output_file in output_files:
+                    collisions.append(f'{where} and {output_files[output_file]} ({output_file})')
+                else:
+                    output_files[output_file] = where
+                    case_collisions.append((output_file.lower(), where))
+
+            for column in printed:
+                value = row[column] or ''
+                if INVALID_XML_CHARS.search(value):
+                    invalid_chars.append(f'{where} {column}')
+                if '&' in value and XML_ENTITY.search(value):
+                    entities.append(f'{where} {column}={value!r}')
+                if value.endswith(ELLIPSIS):
+                    shortened.append(f'{where} {column}={value!r}')
+                field = limits.get(column)
+                if field is not None and len(value) > max_lengths[field]:
+                    overflows.append(f'{where} {column}={value!r} ({len(value)} > {max_lengths[field]})')
+
+        if empty_names:
+            errors.append(f'{role}: {len(empty_names)} attendees with an empty {filename_field}, '
+                          f'their badges would overwrite each other: {_examples(empty_names)}.')
+        if bad_names:
+            errors.append(f'{role}: {len(bad_names)} {filename_field} values are not file names: '
+                          f'{_examples(bad_names)}.')
+        if collisions:
+            errors.append(f'{role}: {len(collisions)} badges would overwrite another one: {_examples(collisions)}.')
+        if invalid_chars:
+            errors.append(f'{role}: {len(invalid_chars)} values with characters not allowed in SVG: '
+                          f'{_examples(invalid_chars)}.')
+        if entities:
+            warnings.append(f'{role}: {len(entities)} values are already XML escaped and would be printed '
+                            f'with the entity: {_examples(entities)}.')
+        if overflows:
+            warnings.append(f'{role}: {len(overflows)} values are longer than their text box: '
+                            f'{_examples(overflows)}.')
+        if shortened:
+            warnings.append(f'{role}: {len(shortened)} values were shortened to fit their text box: '
+                            f'{_examples(shortened)}.')
+
+    # the files of names differing only in case overwrite each other on macOS and Windows
+    by_lower_name = defaultdict(list)
+    for lower_name, where in case_collisions:
+        by_lower_name[lower_name].append(where)
+    same_names = [' and '.join(wheres) for wheres in by_lower_name.values() if len(wheres) > 1]
+    if same_names:
+        warnings.append(f'{len(same_names)} badge file names only differ in case: {_examples(same_names)}.')
+
+    if expected_rows is not None and expected_rows > total_rows:
+        warnings.append(f'{expected_rows - total_rows} of {expected_rows} attendees are in no role file, '
+                        f'their tags match no role, they get no badge.')
+
+    if strict:
+        errors.extend(warnings)
+    else:
+        for warning in warnings:
+            logger.warning(warning)
+
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    if errors:
+        raise ValidationError(f'{len(errors)} problems found in the attendees of {len(role_files)} roles:\n'
+                              + '\n'.join(errors))
+    logger.info(f'Validated {total_rows} attendees of {len(role_files)} roles in {elapsed_ms:.0f} ms.')
+
+
+def role_files_of(roles: List[str], input_file, template_file) -> Dict[str, Tuple[str, str]]:
+    """ Return {role: (input_file(role), template_file(role))} in the order of `roles`. """
+    return OrderedDict((role, (input_file(role), template_file(role))) for role in roles)
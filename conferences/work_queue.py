@@ -0,0 +1,426 @@
+"""
+Work queue on a shared filesystem, to render one run on several machines.
+
+The coordinator (`inv all --queue-dir /shared/queue`) runs the CSV stages,
+splits the role files in units of `UNIT_SIZE` attendees and publishes them
+as files in the queue folder, then waits until they are all rendered:
+
+    queue/
+        queue.json                   written once all the units are published
+        units/<unit>.csv             the attendees of each unit
+        pending/<unit>.json          the units waiting for a worker
+        leased/<unit>@<worker>.json  the units being rendered
+        done/<unit>.json
+        failed/<unit>.json
+        errors/<unit>@<worker>-*.txt why an attempt failed
+
+Workers on any number of machines that mount the queue and the output
+folder at the same paths claim the units:
+
+    inv render-worker --queue-dir /shared/queue --workers 8
+
+A worker claims a unit by renaming it from `pending` to `leased`, a rename
+only one of them can do, and keeps the lease by touching the file while it
+renders. A lease not touched for `lease_seconds` expired: its worker died or
+hangs, the file is renamed back to `pending` and another worker renders the
+unit again. The age of a lease is measured with the clock of the shared
+filesystem, which sets the times of the files, not with the clocks of the
+machines. The outputs are renamed into place when complete under the same
+names, so a unit rendered twice is harmless. A unit that failed
+`MAX_ATTEMPTS` times is moved to `failed`.
+
+The coordinator records the units done in the render journal under the
+digest of their attendees and template, and with `--resume` it does not
+publish them again.
+"""
+import csv
+import hashlib
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from glob import glob
+from typing import Dict, List, Optional, Tuple
+from uuid import uuid4
+
+from conferences import checkpoint
+from conferences.instrument import task
+
+logger = logging.getLogger(__name__)
+
+UNIT_SIZE = 200
+
+LEASE_SECONDS = 300
+
+MAX_ATTEMPTS = 3
+
+POLL_SECONDS = 1.0
+
+QUEUE_FILE = 'queue.json'
+
+# the stage of the units done in the render journal
+JOURNAL_STAGE = 'queued'
+
+STATES = ('pending', 'leased', 'done', 'failed')
+
+
+def worker_name() -> str:
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+def _write_json(path: str, content: dict):
+    partial = checkpoint.partial_file(path)
+    with open(partial, 'w', encoding='utf-8') as output:
+        json.dump(content, output)
+    os.replace(partial, path)
+
+
+def _read_json(path: str) -> dict:
+    with open(path, encoding='utf-8') as content:
+        return json.load(content)
+
+
+def unit_key(role: str, unit_file: str, template_file: str) -> str:
+    """ Return the journal name of the unit of `role` rendering `unit_file`
+    with `template_file`, the same in the next run if they did not change.
+    """
+    digest = hashlib.sha256(os.path.abspath(template_file).encode('utf-8'))
+    with open(unit_file, 'rb') as content:
+        digest.update(content.read())
+    return f'{role}-{digest.hexdigest()[:16]}'
+
+
+def split_csv(input_file: str, unit_size: int, output_dir: str, prefix: str) -> List[str]:
+    """ Write the rows of `input_file` in files of `unit_size` rows with its
+    header to `output_dir`, and return their paths.
+    """
+    unit_files = []
+    with open(input_file, newline='', encoding='utf-8') as csvfile:
+        reader = csv.reader(csvfile)
+        header = next(reader, None)
+        rows = []
+        for row in reader:
+            rows.append(row)
+            if len(rows) == unit_size:
+                unit_files.append(_write_unit(output_dir, prefix, len(unit_files) + 1, header, rows))
+                rows = []
+        if rows:
+            unit_files.append(_write_unit(output_dir, prefix, len(unit_files) + 1, header, rows))
+    return unit_files
+
+
+def _write_unit(output_dir: str, prefix: str, number: int, header: List[str], rows: List[List[str]]) -> str:
+    unit_file = os.path.join(output_dir, f'{prefix}-{number:05d}.csv')
+    with open(unit_file, 'w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(header)
+        writer.writerows(rows)
+    return unit_file
+
+
+class Lease:
+    """ A unit claimed by a worker. """
+    def __init__(self, path: str, unit: dict):
+        self.path = path
+        self.unit = unit
+        self.lost = False
+
+
+class WorkQueue:
+    """ The units of a run, as files in the folders of `queue_dir`. """
+    def __init__(self, queue_dir: str):
+        self.queue_dir = queue_dir
+
+    def path(self, *parts) -> str:
+        return os.path.join(self.queue_dir, *parts)
+
+    def now(self) -> float:
+        """ Return the time of the filesystem of the queue, the clock the
+        leases are touched with, by touching a probe file.
+        """
+        probe_file = self.path(f'.clock-{worker_name()}-{threading.get_ident()}')
+        with open(probe_file, 'a'):
+            pass
+        os.utime(probe_file)
+        return os.path.getmtime(probe_file)
+
+    def settings(self) -> Optional[dict]:
+        """ Return the settings of the published queue, None until it is published. """
+        try:
+            return _read_json(self.path(QUEUE_FILE))
+        except FileNotFoundError:
+            return None
+
+    def reset(self):
+        """ Remove the units of the previous run. """
+        if os.path.exists(self.path(QUEUE_FILE)):
+            os.remove(self.path(QUEUE_FILE))
+        for probe_file in glob(self.path('.clock-*')):
+            os.remove(probe_file)
+        for folder in ('units', 'errors') + STATES:
+            shutil.rmtree(self.path(folder), ignore_errors=True)
+            os.makedirs(self.path(folder))
+
+    def publish(self, conference: str, role_files: Dict[str, Tuple[str, str]], outdir: str,
+                unit_size: int = UNIT_SIZE, lease_seconds: int = LEASE_SECONDS) -> int:
+        """ Publish the attendees of `role_files` {role: (CSV file, template
+        file)} in units of `unit_size` rows, to be rendered to `outdir` by
+        the `render_unit` function of the `conference` module, or by
+        `render_badges`. The units the render journal has done are skipped.
+        Return the number of units published.
+        """
+        self.reset()
+        os.makedirs(outdir, exist_ok=True)
+        units = 0
+        skipped = 0
+        for role, (input_file, template_file) in role_files.items():
+            for unit_file in split_csv(input_file, unit_size, self.path('units'), role):
+                key = unit_key(role, unit_file, template_file)
+                if checkpoint.done(JOURNAL_STAGE, key):
+                    os.remove(unit_file)
+                    skipped += 1
+                    continue
+
+                unit_id = os.path.splitext(os.path.basename(unit_file))[0]
+                _write_json(self.path('pending', f'{unit_id}.json'), {
+                    'id': unit_id,
+                    'key': key,
+                    'conference': conference,
+                    'role': role,
+                    'input_file': os.path.abspath(unit_file),
+                    'template_file': os.path.abspath(template_file),
+                    'outdir': os.path.abspath(outdir),
+                })
+                units += 1
+
+        _write_json(self.path(QUEUE_FILE), {'conference': conference, 'units': units,
+                                            'lease_seconds': lease_seconds})
+        if skipped:
+            logger.info(f'Skipped {skipped} units done in the render journal.')
+        logger.info(f'Published {units} units of {unit_size} attendees to {self.queue_dir}.')
+        return units
+
+    def counts(self) -> Dict[str, int]:
+        return OrderedDict((state, len(glob(self.path(state, '*.json')))) for state in STATES)
+
+    def claim(self, worker: str) -> Optional[Lease]:
+        """ Return the lease of a pending unit for `worker`, None if there is none. """
+        for pending_file in sorted(glob(self.path('pending', '*.json'))):
+            unit_id = os.path.splitext(os.path.basename(pending_file))[0]
+            lease_file = self.path('leased', f'{unit_id}@{worker}.json')
+            try:
+                # touched first, a worker reaping the expired leases must not take it back
+                os.utime(pending_file)
+                os.rename(pending_file, lease_file)
+            except FileNotFoundError:
+                # claimed by another worker
+                continue
+            return Lease(lease_file, _read_json(lease_file))
+        return None
+
+    def renew(self, lease: Lease) -> bool:
+        """ Extend `lease`, return False if it expired and was taken back. """
+        try:
+            os.utime(lease.path)
+        except FileNotFoundError:
+            lease.lost = True
+        return not lease.lost
+
+    def complete(self, lease: Lease, outputs: List[str], worker: str, seconds: float) -> bool:
+        """ Move the unit of `lease` to `done`, return False if the lease was lost. """
+        done_file = self.path('done', f'{lease.unit["id"]}.json')
+        try:
+            os.rename(lease.path, done_file)
+        except FileNotFoundError:
+            lease.lost = True
+            return False
+        _write_json(done_file, dict(lease.unit, worker=worker, outputs=len(outputs), seconds=round(seconds, 3)))
+        return True
+
+    def attempts(self, unit_id: str) -> int:
+        return len(glob(self.path('errors', f'{unit_id}@*.txt')))
+
+    def _give_back(self, lease_file: str, unit_id: str, worker: str, error: str) -> str:
+        """ Record why `worker` did not render the unit, and move it back to
+        `pending`, or to `failed` after `MAX_ATTEMPTS`. Return the new state.
+        """
+        with open(self.path('errors', f'{unit_id}@{worker}-{uuid4().hex[:8]}.txt'), 'w') as error_file:
+            error_file.write(error)
+        state = 'failed' if self.attempts(unit_id) >= MAX_ATTEMPTS else 'pending'
+        try:
+            os.rename(lease_file, self.path(state, f'{unit_id}.json'))
+        except FileNotFoundError:
+            # given back by someone else already
+            return 'leased'
+        return state
+
+    def fail(self, lease: Lease, worker: str, error: str) -> str:
+        return self._give_back(lease.path, lease.unit['id'], worker, error)
+
+    def reap(self, lease_seconds: float) -> int:
+        """ Move the units of the expired leases back to `pending`, return how many. """
+        expired = 0
+        now = self.now()
+        for lease_file in glob(self.path('leased', '*.json')):
+            try:
+                if now - os.path.getmtime(lease_file) < lease_seconds:
+                    continue
+            except FileNotFoundError:
+                continue
+            unit_id, worker = os.path.splitext(os.path.basename(lease_file))[0].rsplit('@', 1)
+            state = self._give_back(lease_file, unit_id, worker, f'The lease of {worker} expired.')
+            if state != 'leased':
+                logger.warning(f'The lease of {worker} on {unit_id} expired, the unit is {state}.')
+                expired += 1
+        return expired
+
+    def journal_done(self, recorded: set):
+        """ Record the units done and not in `recorded` yet in the render journal. """
+        for done_file in glob(self.path('done', '*.json')):
+            if done_file in recorded:
+                continue
+            unit = _read_json(done_file)
+            if unit.get('key') and not checkpoint.done(JOURNAL_STAGE, unit['key']):
+                checkpoint.record(JOURNAL_STAGE, unit['key'])
+            recorded.add(done_file)
+
+    def wait(self, poll: float = POLL_SECONDS) -> Dict[str, int]:
+        """ Wait until no unit is pending or leased, reaping the expired leases
+        and journaling the units done.
+        """
+        lease_seconds = self.settings()['lease_seconds']
+        last_counts = None
+        recorded = set()
+        while True:
+            self.reap(lease_seconds)
+            self.journal_done(recorded)
+            counts = self.counts()
+            if counts != last_counts:
+                logger.info(', '.join(f'{count} {state}' for state, count in counts.items()))
+                last_counts = counts
+            if not counts['pending'] and not counts['leased']:
+                break
+            time.sleep(poll)
+        self.journal_done(recorded)
+
+        if counts['failed']:
+            raise RuntimeError(f'{counts["failed"]} units failed, see {self.path("failed")} '
+                               f'and the errors in {self.path("errors")}.')
+        return counts
+
+
+def render_badges(ctx, conference, input_file: str, template_file: str, outdir: str) -> List[str]:
+    """ Render the badges of `input_file` with the stages of the `conference`
+    module, move the joined faces to `outdir` and return their paths.
+    """
+    work_dir = tempfile.mkdtemp(prefix=checkpoint.PARTIAL_PREFIX, dir=outdir)
+    try:
+        conference.create_badge_set(input_file=input_file, outdir=work_dir, template_file=template_file)
+        conference.convert_badges_to_cmyk(ctx, stamped_dir=work_dir)
+        conference.make_badge_faces(ctx, stamped_dir=work_dir, cleanup=True)
+
+        outputs = []
+        for pdf_file in glob(os.path.join(work_dir, '*joined.pdf')):
+            output_file = os.path.join(outdir, os.path.basename(pdf_file))
+            os.replace(pdf_file, output_file)
+            outputs.append(output_file)
+        return outputs
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def render(ctx, unit: dict) -> List[str]:
+    conference = importlib.import_module(unit['conference'])
+    render_unit = getattr(conference, 'render_unit', None)
+    if render_unit is not None:
+        return render_unit(ctx, unit['input_file'], unit['template_file'], unit['outdir'])
+    return render_badges(ctx, conference, unit['input_file'], unit['template_file'], unit['outdir'])
+
+
+def run_worker(queue_dir: str, worker: str = None, poll: float = POLL_SECONDS) -> int:
+    """ Render the units of the queue in `queue_dir` until none is pending or
+    leased, and return the number of units rendered.
+    """
+    from invoke import Context
+
+    ctx = Context()
+    worker = worker or worker_name()
+    queue = WorkQueue(queue_dir)
+    rendered = 0
+    while True:
+        settings = queue.settings()
+        if settings is None:
+            time.sleep(poll)
+            continue
+
+        lease = queue.claim(worker)
+        if lease is None:
+            queue.reap(settings['lease_seconds'])
+            counts = queue.counts()
+            if not counts['pending'] and not counts['leased']:
+                break
+            time.sleep(poll)
+            continue
+
+        stop = threading.Event()
+
+        def keep_lease():
+            while not stop.wait(settings['lease_seconds'] / 3):
+                if not queue.renew(lease):
+                    logger.warning(f'{worker} lost the lease on {lease.unit["id"]}.')
+                    return
+
+        heartbeat = threading.Thread(target=keep_lease, daemon=True)
+        heartbeat.start()
+        start = time.perf_counter()
+        try:
+            outputs = render(ctx, lease.unit)
+        except Exception:
+            stop.set()
+            state = queue.fail(lease, worker, traceback.format_exc())
+            logger.exception(f'{worker} failed to render {lease.unit["id"]}, the unit is {state}.')
+            continue
+        finally:
+            stop.set()
+            heartbeat.join()
+
+        seconds = time.perf_counter() - start
+        if queue.complete(lease, outputs, worker, seconds):
+            rendered += 1
+            logger.info(f'{worker} rendered {lease.unit["id"]}: {len(outputs)} files in {seconds:.1f} s.')
+        else:
+            logger.warning(f'{worker} rendered {lease.unit["id"]} after its lease expired.')
+
+    logger.info(f'{worker} is done, it rendered {rendered} units.')
+    return rendered
+
+
+def distribute(queue_dir: str, conference: str, role_files: Dict[str, Tuple[str, str]], outdir: str,
+               unit_size: int = UNIT_SIZE, lease_seconds: int = LEASE_SECONDS):
+    """ Publish `role_files` to the queue in `queue_dir` and wait for the workers. """
+    queue = WorkQueue(queue_dir)
+    queue.publish(conference, role_files, outdir, unit_size=unit_size, lease_seconds=lease_seconds)
+    queue.wait()
+
+
+@task
+def render_worker(ctx, queue_dir='queue', workers=1):
+    """ Render the units of the shared queue in `queue_dir` with `workers` processes. """
+    if workers == 1:
+        run_worker(queue_dir)
+        return
+
+    processes = [multiprocessing.Process(target=run_worker, args=(queue_dir, f'{worker_name()}-{idx}'))
+                 for idx in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
@@ -1,9 +1,37 @@
+import importlib
+import logging
 import os
+import sys
 
-from invoke import task
+from invoke import Task, task
 
-# from conferences.euroscipy2019 import *
-# from conferences.euroscipy2019_certificates import *
+from conferences.attendee_index import find_attendee, index_attendees
+from conferences.badge_server import serve_badges
+from conferences.batch import batch
+from conferences.packaging import package_outputs
+from conferences.pdf_optimize import bundle_badges
+from conferences.proofs import proof_badges
+from conferences.render_cache import render_cache
+from conferences.tito_api import ingest_tickets, serve_tito_fixtures
+from conferences.work_queue import render_worker
+
+# The modules of `conferences/` only get their loggers, the records of all of them are
+# printed here, once.
+logger = logging.getLogger('conferences')
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(sys.stdout)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+# The conference module in `conferences/` whose tasks are loaded, e.g.:
+# DOCSTAMP_CONFERENCE=euroscipy2019_certificates inv certificates
+# The conference modules only import pandas and docstamp inside the tasks.
+CONFERENCE = os.environ.get('DOCSTAMP_CONFERENCE', 'euroscipy2019')
+
+if CONFERENCE:
+    conference = importlib.import_module(f'conferences.{CONFERENCE}')
+    globals().update({name: obj for name, obj in vars(conference).items() if isinstance(obj, Task)})
 
 
 @task
@@ -18,10 +46,33 @@ def docker_launch(ctx):
 
 @task
 def docker_run(ctx):
-    ctx.run('docker exec -t docstamp sh -c "pipenv run inv all"')
+    ctx.run(f'docker exec -e DOCSTAMP_CONFERENCE={CONFERENCE} -t docstamp sh -c "pipenv run inv all"')
     ctx.run('docker stop docstamp')
 
 
 @task
 def docker_clean(ctx):
     ctx.run('docker rmi docstamp')
+
+
+@task
+def bench(ctx, rows='1000,10000,100000', conferences='', render='stub', compare=''):
+    cmd = 'python -m benchmarks.run_benchmarks '
+    cmd += f'--rows {rows.replace(",", " ")} '
+    cmd += f'--render {render} '
+    if conferences:
+        cmd += f'--conferences {conferences.replace(",", " ")} '
+    if compare:
+        cmd += f'--compare "{compare}" '
+    ctx.run(cmd)
+
+
+@task
+def bench_backends(ctx, backends='', reference='inkscape', repeat=5, diff_dir=''):
+    cmd = 'python -m benchmarks.compare_backends '
+    cmd += f'--reference {reference} --repeat {repeat} '
+    if backends:
+        cmd += f'--backends {backends.replace(",", " ")} '
+    if diff_dir:
+        cmd += f'--diff-dir "{diff_dir}" '
+    ctx.run(cmd)